@@ -7,9 +7,11 @@
 
 
 # ##############################################################################
+from   time import perf_counter
+START_TIME = perf_counter()   # to report the time to first scan
+# ..............................................................................
 import argparse
 import numbers
-import os
 import sys
 from   logging.handlers import RotatingFileHandler
 import logging as lg
@@ -17,10 +19,29 @@ import asyncio
 import signal
 import platform
 import functools
+from   contextlib import nullcontext
 # ..............................................................................
 import bleak
 # ..............................................................................
-from   bthome_decoder import get_bthome_devices_from_yaml_file, create_bthome_decoder
+from   bthome_decoder import get_bthome_devices_from_yaml_file, create_bthome_decoder, PayloadCache, \
+                              DecryptionStage, DeviceRegistry, JSON_ENCODERS, use_json_encoder
+from   bthome_mqtt import BrokerPool, PublishQueue, OVERFLOW_POLICIES
+from   bthome_log import HOT_LOG, AsyncLogOutput
+from   bthome_metrics import METRICS, MetricsServer, StatsPublisher, stats_collector
+from   bthome_scan import ScanScheduler, AdapterMerger
+from   bthome_split import DEFAULT_DISCOVERY_PREFIX
+from   bthome_aggregate import Aggregator
+from   bthome_state import create_state_store
+# ##############################################################################
+
+
+
+# some globals  ################################################################
+# system (Linux, Windows...) the program runs on
+platform_system = platform.system()
+# log output from a background thread (see --async-log), if any, stopped after
+# main() returns
+async_log_output: AsyncLogOutput | None = None
 # ##############################################################################
 
 
@@ -28,6 +49,7 @@ from   bthome_decoder import get_bthome_devices_from_yaml_file, create_bthome_de
 # ##############################################################################
 async def main():
   '''Simply... main()'''
+  global async_log_output
 
 
   # process command line arguments  ********************************************
@@ -38,11 +60,25 @@ async def main():
     help =  'file describing the BTHome devices to monitor and where to send (MQTT) '\
             'their measurements. Defaults to "bthome_devices.yaml".',
     dest = 'config_file_name')
-  arg_parser.add_argument('-a', '--adapter', action = 'store',
+  arg_parser.add_argument('--config-cache', action = 'store',
+    default = None,
+    help =  'file where the parsed configuration is cached, so that the YAML configuration '\
+            'file is only parsed again when changed. Defaults to CONFIG_FILE + ".cache".',
+    dest = 'config_cache_file_name')
+  arg_parser.add_argument('--no-config-cache', action = 'store_false',
+    help = 'always parse the YAML configuration file, without caching it.',
+    dest = 'config_cache')
+  arg_parser.add_argument('-a', '--adapter', action = 'append',
     default = None,
     help =  'Bluetooth HCI adapter to use (hci0, hci1, ...). Used only in Linux/BlueZ. '\
-            'If not specified, uses system default.',
-    dest = 'adapter')
+            'If not specified, uses system default. Repeat to scan with several adapters '\
+            'at once.',
+    dest = 'adapters')
+  arg_parser.add_argument('--merge-window', action = 'store',
+    default = 0.1, type = float,
+    help =  'time (in s) to wait for copies of an advertisement heard by several adapters, '\
+            'to publish it once (with the best RSSI). Defaults to 0.1.',
+    dest = 'merge_window')
   arg_parser.add_argument('-s', '--scan_time', action = 'store',
     default = 0, type = float,
     help =  'BLE scan time (in s). Defaults to 0. A <= 0 number is treated as '\
@@ -52,10 +88,152 @@ async def main():
     default = 1, type = float,
     help = 'pause time between scans (in s). Defaults to 1. Ignored if SCAN_TIME <= 0.',
     dest = 'scan_pause')
+  arg_parser.add_argument('--adaptive-scan', action = 'store_true',
+    help =  'restart scans (without pauses) only when the BLE backend stops reporting '\
+            'devices, instead of every SCAN_TIME s (then the max. scan time, if > 0).',
+    dest = 'adaptive_scan')
+  arg_parser.add_argument('--queue-size', action = 'store',
+    default = 1000, type = int,
+    help = 'max. number of measurements waiting to be published to each broker. Defaults to 1000.',
+    dest = 'queue_size')
+  arg_parser.add_argument('--max-inflight', action = 'store',
+    default = 64, type = int,
+    help =  'max. number of measurements being published at once to each broker (QoS > 0 '\
+            'ones waiting for acknowledgement). Defaults to 64.',
+    dest = 'max_inflight')
+  arg_parser.add_argument('--batch-size', action = 'store',
+    default = 64, type = int,
+    help = 'max. number of queued measurements sent together to a broker. Defaults to 64.',
+    dest = 'batch_size')
+  arg_parser.add_argument('--batch-delay', action = 'store',
+    default = 0.0, type = float,
+    help =  'max. time (in s) to wait for a batch of measurements to fill before sending '\
+            'it. Defaults to 0: what is queued is sent right away.',
+    dest = 'batch_delay')
+  arg_parser.add_argument('--overflow-policy', action = 'store',
+    default = 'drop-oldest',
+    choices = OVERFLOW_POLICIES,
+    help =  'what to do with new measurements when a broker publish queue is full. '\
+            'Defaults to "drop-oldest".',
+    dest = 'overflow_policy')
+  arg_parser.add_argument('--no-coalesce', action = 'store_false',
+    help =  'publish every queued measurement, instead of only the latest one from each '\
+            'device (measurements with button/dimmer events are never coalesced).',
+    dest = 'coalesce')
+  arg_parser.add_argument('--outbox-dir', action = 'store',
+    default = None,
+    help =  'directory where the outboxes of the brokers with "outbox: yes" store the '\
+            'messages not delivered yet. Defaults to CONFIG_FILE + ".outbox".',
+    dest = 'outbox_dir')
+  arg_parser.add_argument('--outbox-bytes', action = 'store',
+    default = 64 << 20, type = int,
+    help =  'max. size (in bytes) of the outbox of each broker, the oldest messages are '\
+            'evicted beyond. Defaults to 64 MiB.',
+    dest = 'outbox_bytes')
+  arg_parser.add_argument('--outbox-rate', action = 'store',
+    default = 50, type = float,
+    help =  'max. number of messages per second replayed from the outbox of each broker. '\
+            'Defaults to 50.',
+    dest = 'outbox_rate')
+  arg_parser.add_argument('--deadband', action = 'store',
+    default = 1, type = int,
+    help =  'min. change (in steps of the resolution of each property) of numeric '\
+            'properties to be published to brokers with "split: yes". Defaults to 1.',
+    dest = 'deadband')
+  arg_parser.add_argument('--discovery-prefix', action = 'store',
+    default = DEFAULT_DISCOVERY_PREFIX,
+    help =  'topic prefix of Home Assistant MQTT discovery configurations, published to '\
+            f'brokers with "discovery: yes". Defaults to "{DEFAULT_DISCOVERY_PREFIX}".',
+    dest = 'discovery_prefix')
+  arg_parser.add_argument('--cache-entries', action = 'store',
+    default = 1024, type = int,
+    help =  'max. number of distinct payloads whose decoded measurements are cached, 0 '\
+            'disables the cache. Defaults to 1024.',
+    dest = 'cache_entries')
+  arg_parser.add_argument('--cache-bytes', action = 'store',
+    default = 262144, type = int,
+    help = 'max. size (in bytes) of the cached payloads. Defaults to 262144.',
+    dest = 'cache_bytes')
+  arg_parser.add_argument('--json-encoder', action = 'store',
+    default = 'json', choices = JSON_ENCODERS,
+    help =  'JSON encoder of measurements: "json" (standard library) or "fast" (orjson, if '\
+            'installed, otherwise a hand-rolled one with the same output as json). '\
+            'Defaults to "json".',
+    dest = 'json_encoder')
+  arg_parser.add_argument('--decrypt-threads', action = 'store',
+    default = 0, type = int,
+    help =  'number of threads decrypting encrypted advertisements (in batches). Defaults to 0, '\
+            'this is, decrypt in the main thread.',
+    dest = 'decrypt_threads')
+  arg_parser.add_argument('--decrypt-batch', action = 'store',
+    default = 64, type = int,
+    help = 'max. number of advertisements per decryption batch. Defaults to 64.',
+    dest = 'decrypt_batch')
+  arg_parser.add_argument('--max-promiscuous', action = 'store',
+    default = 1000, type = int,
+    help =  'max. number of devices tracked in promiscuous mode, the least recently seen are '\
+            'forgotten first. Defaults to 1000.',
+    dest = 'max_promiscuous')
+  arg_parser.add_argument('--promiscuous-ttl', action = 'store',
+    default = 3600, type = float,
+    help =  'time (in s) after which idle devices tracked in promiscuous mode are forgotten. '\
+            'Defaults to 3600.',
+    dest = 'promiscuous_ttl')
+  arg_parser.add_argument('--state-store', action = 'store',
+    default = None,
+    help =  'state store shared with other instances (nodes) of this program, so that each '\
+            'reading is published only once: "sqlite:FILE" or '\
+            '"mqtt[s]://[USER[:PASSWORD]@]HOST[:PORT][/PREFIX]". Defaults to none.',
+    dest = 'state_store_url')
+  arg_parser.add_argument('--node', action = 'store',
+    default = platform.node(),
+    help = 'name of this node, unique among those sharing a state store. Defaults to the host name.',
+    dest = 'node')
+  arg_parser.add_argument('--state-ttl', action = 'store',
+    default = 10, type = float,
+    help =  'time (in s) after which readings claimed in the state store may be claimed '\
+            'again. Defaults to 10.',
+    dest = 'state_ttl')
+  arg_parser.add_argument('--metrics-port', action = 'store',
+    default = 0, type = int,
+    help =  'TCP port where to export metrics (Prometheus text format, at /metrics). Defaults '\
+            'to 0, this is, do not export metrics.',
+    dest = 'metrics_port')
+  arg_parser.add_argument('--metrics-address', action = 'store',
+    default = '127.0.0.1',
+    help = 'address where to export metrics. Defaults to "127.0.0.1".',
+    dest = 'metrics_address')
+  arg_parser.add_argument('--stats-topic', action = 'store',
+    default = None,
+    help =  'MQTT topic under which to periodically publish metrics to all brokers, one value '\
+            'per subtopic. If not set, metrics are not published.',
+    dest = 'stats_topic')
+  arg_parser.add_argument('--stats-interval', action = 'store',
+    default = 60, type = float,
+    help = 'interval (in s) between metrics publishments. Defaults to 60.',
+    dest = 'stats_interval')
+  arg_parser.add_argument('--record', action = 'store',
+    default = None,
+    help =  'file where to record (append) all received BTHome advertisements, for later '\
+            'replay (see bthome_capture.py). If not set, advertisements are not recorded.',
+    dest = 'record_file_name')
+  arg_parser.add_argument('--record-max-bytes', action = 'store',
+    default = 10000000, type = int,
+    help =  'size (in bytes) from which the record file is rotated (5 backups are kept). '\
+            'Defaults to 10000000.',
+    dest = 'record_max_bytes')
   arg_parser.add_argument('-l', '--log-file', action = 'store',
     default = None,
     help = 'file where to write log messages. If not set, outputs messages to standard error.',
     dest = 'log_file_name')
+  arg_parser.add_argument('--async-log', action = 'store_true',
+    help =  'write log messages from a background thread, so that (file) writes never stall '\
+            'BLE/MQTT processing. Messages are dropped if more than LOG_QUEUE_SIZE are pending.',
+    dest = 'async_log')
+  arg_parser.add_argument('--log-queue-size', action = 'store',
+    default = 10000, type = int,
+    help = 'max. number of log messages pending to be written. Defaults to 10000.',
+    dest = 'log_queue_size')
   arg_parser.add_argument('-m', '--measurements_as_info', action = 'store_true',
     help = 'log measurements as INFO, instead of as DEBUG.',
     dest = 'log_measurements_as_info')
@@ -73,10 +251,51 @@ async def main():
 
   args = arg_parser.parse_args()
   config_file_name = args.config_file_name
-  adapter = args.adapter
+  config_cache_file_name = args.config_cache_file_name
+  if config_cache_file_name is None:
+    config_cache_file_name = config_file_name + '.cache'
+  #: endif
+  if not args.config_cache:
+    config_cache_file_name = None
+  #: endif
+  outbox_dir = args.outbox_dir
+  if outbox_dir is None:
+    outbox_dir = config_file_name + '.outbox'
+  #: endif
+  outbox_bytes = args.outbox_bytes
+  outbox_rate = args.outbox_rate
+  deadband = args.deadband
+  discovery_prefix = args.discovery_prefix
+  adapters = list(dict.fromkeys(args.adapters or [None]))   # unique, in order
+  merge_window = args.merge_window
   scan_time = args.scan_time
   scan_pause = args.scan_pause
+  adaptive_scan = args.adaptive_scan
+  queue_size = args.queue_size
+  max_inflight = args.max_inflight
+  batch_size = args.batch_size
+  batch_delay = args.batch_delay
+  overflow_policy = args.overflow_policy
+  coalesce = args.coalesce
+  cache_entries = args.cache_entries
+  cache_bytes = args.cache_bytes
+  json_encoder = args.json_encoder
+  decrypt_threads = args.decrypt_threads
+  decrypt_batch = args.decrypt_batch
+  max_promiscuous = args.max_promiscuous
+  promiscuous_ttl = args.promiscuous_ttl
+  state_store_url = args.state_store_url
+  node = args.node
+  state_ttl = args.state_ttl
+  metrics_port = args.metrics_port
+  metrics_address = args.metrics_address
+  stats_topic = args.stats_topic
+  stats_interval = args.stats_interval
+  record_file_name = args.record_file_name
+  record_max_bytes = args.record_max_bytes
   log_file_name = args.log_file_name
+  async_log = args.async_log
+  log_queue_size = args.log_queue_size
   log_level = getattr(lg, args.log_level)
   log_measurements_as_info = args.log_measurements_as_info
   log_date = args.log_date
@@ -94,6 +313,11 @@ async def main():
           + '%(levelname)s: %(message)s',
       datefmt = '%Y-%m-%dT%H:%M:%S' if log_date else '%H:%M:%S',
       level = log_level)
+  HOT_LOG.refresh()   # log levels changed
+  if async_log and log_queue_size > 0:
+    async_log_output = AsyncLogOutput(log_queue_size)
+    async_log_output.start()
+  #: endif
   meas_log_lvl = lg.INFO if log_measurements_as_info else lg.DEBUG
   lg.info('%s', f'{__file__} started.')
   lg.info('%s', f'Log level = {args.log_level}')
@@ -110,35 +334,141 @@ async def main():
                       f'"scan_pause". Exiting.')
     return
   #: endif
+  if merge_window < 0:
+    lg.critical('%s', f'Invalid value {merge_window} for command line argument '\
+                      f'"merge_window". Exiting.')
+    return
+  #: endif
+  if log_queue_size <= 0:
+    lg.critical('%s', f'Invalid value {log_queue_size} for command line argument '\
+                      f'"log_queue_size". Exiting.')
+    return
+  #: endif
+  if queue_size <= 0:
+    lg.critical('%s', f'Invalid value {queue_size} for command line argument '\
+                      f'"queue_size". Exiting.')
+    return
+  #: endif
+  if max_inflight <= 0:
+    lg.critical('%s', f'Invalid value {max_inflight} for command line argument '\
+                      f'"max_inflight". Exiting.')
+    return
+  #: endif
+  if batch_size <= 0:
+    lg.critical('%s', f'Invalid value {batch_size} for command line argument '\
+                      f'"batch_size". Exiting.')
+    return
+  #: endif
+  if batch_delay < 0:
+    lg.critical('%s', f'Invalid value {batch_delay} for command line argument '\
+                      f'"batch_delay". Exiting.')
+    return
+  #: endif
+  if outbox_bytes <= 0:
+    lg.critical('%s', f'Invalid value {outbox_bytes} for command line argument '\
+                      f'"outbox_bytes". Exiting.')
+    return
+  #: endif
+  if outbox_rate <= 0:
+    lg.critical('%s', f'Invalid value {outbox_rate} for command line argument '\
+                      f'"outbox_rate". Exiting.')
+    return
+  #: endif
+  if deadband < 1:
+    lg.critical('%s', f'Invalid value {deadband} for command line argument '\
+                      f'"deadband". Exiting.')
+    return
+  #: endif
+  if not discovery_prefix.strip('/'):
+    lg.critical('%s', f'Invalid value "{discovery_prefix}" for command line argument '\
+                      f'"discovery_prefix". Exiting.')
+    return
+  #: endif
+  if cache_entries < 0 or cache_bytes < 0:
+    lg.critical('%s', f'Invalid value {min(cache_entries, cache_bytes)} for command line '\
+                      f'argument "cache_entries" or "cache_bytes". Exiting.')
+    return
+  #: endif
+  if decrypt_threads < 0:
+    lg.critical('%s', f'Invalid value {decrypt_threads} for command line argument '\
+                      f'"decrypt_threads". Exiting.')
+    return
+  #: endif
+  if decrypt_batch <= 0:
+    lg.critical('%s', f'Invalid value {decrypt_batch} for command line argument '\
+                      f'"decrypt_batch". Exiting.')
+    return
+  #: endif
+  if max_promiscuous <= 0:
+    lg.critical('%s', f'Invalid value {max_promiscuous} for command line argument '\
+                      f'"max_promiscuous". Exiting.')
+    return
+  #: endif
+  if promiscuous_ttl <= 0:
+    lg.critical('%s', f'Invalid value {promiscuous_ttl} for command line argument '\
+                      f'"promiscuous_ttl". Exiting.')
+    return
+  #: endif
+  if state_ttl <= 0:
+    lg.critical('%s', f'Invalid value {state_ttl} for command line argument '\
+                      f'"state_ttl". Exiting.')
+    return
+  #: endif
+  state_store = None
+  if state_store_url is not None:
+    state_store = create_state_store(state_store_url, node, state_ttl)
+    if state_store is None:
+      lg.critical('%s', f'Invalid value {state_store_url} for command line argument '\
+                        f'"state_store". Exiting.')
+      return
+    #: endif
+  #: endif
+  if not 0 <= metrics_port <= 65535:
+    lg.critical('%s', f'Invalid value {metrics_port} for command line argument '\
+                      f'"metrics_port". Exiting.')
+    return
+  #: endif
+  if stats_topic is not None and (not stats_topic.strip('/') or stats_interval <= 0):
+    lg.critical('%s', f'Invalid value "{stats_topic}" or {stats_interval} for command line '\
+                      f'argument "stats_topic" or "stats_interval". Exiting.')
+    return
+  #: endif
+  if record_max_bytes <= 0:
+    lg.critical('%s', f'Invalid value {record_max_bytes} for command line argument '\
+                      f'"record_max_bytes". Exiting.')
+    return
+  #: endif
   if scan_time <= 0:
     scan_time = sys.float_info.max
     scan_pause = 0.1
-  #: endif  ////////////////////////////////////////////////////////////////////
+  #: endif
+  lg.info('%s', f'Encoding measurements with the {use_json_encoder(json_encoder)} JSON encoder.')
+  # ////////////////////////////////////////////////////////////////////////////
 
 
   # Read config file  **********************************************************
-  bthome_devices = get_bthome_devices_from_yaml_file(config_file_name)
+  bthome_devices = get_bthome_devices_from_yaml_file(config_file_name, config_cache_file_name)
   if bthome_devices is None:
     return
   #: endif  ////////////////////////////////////////////////////////////////////
 
 
-  # manage program termination  ************************************************
+  # manage program termination and configuration reload  ***********************
   stop_event = asyncio.Event()
+  reload_event = asyncio.Event()
   loop = asyncio.get_event_loop()
 
   # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
   def signal_handler(signal_name_or_number, loop_or_frame):
-    global reload
     if platform_system == 'Windows':
       lg.warning('%s', f'Caught signal {signal.Signals(signal_name_or_number).name}, terminating.')
+    elif signal_name_or_number == 'SIGHUP':
+      # to reload when running as a daemon
+      lg.warning('%s', f'Caught signal {signal_name_or_number}, reloading configuration.')
+      reload_event.set()
+      return
     else:
       lg.warning('%s', f'Caught signal {signal_name_or_number}, terminating.')
-      # to reload when running as a daemon
-      if signal_name_or_number == 'SIGHUP':
-        reload = True
-        lg.info('%s', 'Will reload due to signal HUP.')
-      #: endif
     #: endif
     stop_event.set()
   #: enddef signal_handler  ----------------------------------------------------
@@ -166,7 +496,7 @@ async def main():
   match platform_system:
     case 'Windows':
       scanning_mode = 'passive'
-      adapter = None
+      adapters = [None]
     case 'Linux':
       from bleak.backends.bluezdbus.scanner import BlueZScannerArgs
       from bleak.backends.bluezdbus.advertisement_monitor import OrPattern
@@ -176,7 +506,7 @@ async def main():
           or_patterns = [OrPattern(0, AdvertisementDataType.SERVICE_DATA_UUID16, b"\xd2\xfc")])
     case 'Darwin':  # not tested !!!
       scanning_mode = 'active'
-      adapter = None
+      adapters = [None]
     case _:
       lg.critical('%s', f'System "{platform_system}" not supported. Exiting.')
       return
@@ -187,35 +517,196 @@ async def main():
   # ////////////////////////////////////////////////////////////////////////////
 
 
+  # record advertisements  *****************************************************
+  capture_writer = None
+  if record_file_name is not None:
+    from bthome_capture import CaptureWriter    # only needed when recording
+    capture_writer = CaptureWriter(record_file_name, record_max_bytes,
+                                   adapter=adapters[0] or '')
+    try:
+      capture_writer.start()
+    except OSError as e:
+      lg.critical('%s', f'Cannot record to "{record_file_name}". {e}. Exiting.')
+      return
+    #: endtry
+    lg.info('%s', f'Recording advertisements to "{record_file_name}".')
+  #: endif  ////////////////////////////////////////////////////////////////////
+
+
+  # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+  async def reload_configuration(device_registry: DeviceRegistry, broker_pool: BrokerPool,
+                                 publish_queue: PublishQueue):
+    '''Re-reads the YAML configuration file (from a thread) whenever signal HUP
+        arrives, and swaps in the changed devices and brokers, keeping the BLE
+        scanner, the connections to unchanged brokers and the state of all
+        devices'''
+    while True:
+      await reload_event.wait()
+      reload_event.clear()
+      try:
+        # parsed in a thread (it may take seconds), so that advertisements are
+        # still handled meanwhile, then swapped in here
+        bthome_devices = await asyncio.to_thread(get_bthome_devices_from_yaml_file,
+                                                 config_file_name, config_cache_file_name)
+      except Exception as e:
+        lg.error('%s', f'Unmanaged exception "{e}" reading the configuration file.')
+        bthome_devices = None
+      #: endtry
+      if bthome_devices is None:
+        lg.error('%s', 'Configuration not reloaded, going on with the former one.')
+        continue
+      #: endif
+      # outboxes of new brokers are open before publishing to them
+      await broker_pool.open_outboxes(broker for config in bthome_devices.values()
+                                      for broker in config.brokers)
+      counts = device_registry.reload(bthome_devices)
+      # publishments already queued to removed brokers are done first
+      brokers = device_registry.brokers()
+      await publish_queue.close_unused(brokers)
+      await broker_pool.close_unused(brokers)
+      lg.info('%s', f'Configuration reloaded: {counts["added"]} devices added, '\
+                    f'{counts["changed"]} changed and {counts["removed"]} removed.')
+    #: endwhile
+  #: enddef reload_configuration -----------------------------------------------
+
+
+  # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+  def decode_in_task(ble_device, advertisement_data):
+    '''Detection callback of a single scanner, decoding each advertisement in
+        its own task (as the scanner would do), but keeping track of it, so
+        that decoding is done before the pipeline is closed'''
+    task = asyncio.create_task(bthome_decoder(ble_device, advertisement_data))
+    decode_tasks.add(task)
+    task.add_done_callback(decode_tasks.discard)
+  #: enddef decode_in_task -----------------------------------------------------
+
+
+  # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+  async def scan_with_adapter(adapter: str | None, scan_scheduler: ScanScheduler,
+                              callback):
+    '''Scans with the BLE adapter (the system default one, if None) until
+        stop_event is set, then sets it, so that the scanners of other
+        adapters stop too if this one fails'''
+    try:
+      async with bleak.BleakScanner(
+          scan_scheduler.wrap(callback),
+          scanning_mode = scanning_mode,
+          bluez = bluez_args,
+          adapter = adapter) as scanner:
+        scan_mode = ('restarted when needed' if adaptive_scan
+                     else f'{scan_time} s on / {scan_pause} s off')
+        lg.info('%s', f'{scan_scheduler.name} started ({scan_mode}), '\
+                      f'{perf_counter() - START_TIME:.2f} s after startup.')
+        await scan_scheduler.run(scanner, stop_event)
+      #: endwith scanner
+    finally:
+      stop_event.set()
+    #: endtry
+    lg.info('%s', f'{scan_scheduler.name} restarted {scan_scheduler.restarts} times, '\
+                  f'{scan_scheduler.dead_time:.1f} s dead time '\
+                  f'({scan_scheduler.duty_cycle:.2%} duty cycle).')
+  #: enddef scan_with_adapter --------------------------------------------------
+
+
   # scan  **********************************************************************
   lg.info('%s', 'Starting BLE scanner.')
+  decryption_stage = DecryptionStage(decrypt_threads, decrypt_batch) if decrypt_threads else None
+  adapter_merger = None
+  decode_tasks: set[asyncio.Task] = set()
   try:
-    bthome_decoder = create_bthome_decoder(bthome_devices, meas_log_lvl)
-    async with bleak.BleakScanner(
-        bthome_decoder,
-        scanning_mode = scanning_mode,
-        bluez = bluez_args,
-        adapter = adapter) as scanner:
-      lg.info('%s', f'BLE scanner started ({scan_time} s on / {scan_pause} s off).')
-      while True:
-        try:
-          await asyncio.wait_for(stop_event.wait(), scan_time)
-        except TimeoutError:
-          await scanner.stop()
-          lg.debug('BLE scanner stopped.')
-        else:
-          break
-        #: endtry
-        try:
-          await asyncio.wait_for(stop_event.wait(), scan_pause)
-        except TimeoutError:
-          lg.debug('BLE scanner restarted.')
-          await scanner.start()
-        else:
-          break
-        #: endtry
-      #: endwhile
-    #: endwith scanner
+    async with (BrokerPool(max_inflight, outbox_dir, outbox_bytes, outbox_rate, deadband,
+                           discovery_prefix) as broker_pool,
+                PublishQueue(broker_pool, queue_size, max_inflight, overflow_policy,
+                             coalesce, batch_size, batch_delay) as publish_queue,
+                Aggregator(publish_queue) as aggregator,
+                MetricsServer(METRICS, metrics_address, metrics_port)
+                    if metrics_port else nullcontext(),
+                StatsPublisher(METRICS, broker_pool, stats_topic, stats_interval)
+                    if stats_topic else nullcontext(),
+                state_store if state_store is not None else nullcontext()):
+      device_registry = DeviceRegistry(bthome_devices, max_promiscuous, promiscuous_ttl)
+      await broker_pool.open_outboxes(device_registry.brokers())
+      payload_cache = (PayloadCache(cache_entries, cache_bytes)
+                       if cache_entries and cache_bytes else None)
+      # instrument the pipeline only if metrics are exported
+      if metrics_port or stats_topic:
+        METRICS.enabled = True
+        METRICS.add_collector(stats_collector('bthome_mqtt_connection', broker_pool.stats,
+                                              'broker'))
+        METRICS.add_collector(stats_collector('bthome_publish_queue', publish_queue.stats,
+                                              'broker'))
+        METRICS.add_collector(stats_collector('bthome_outbox', broker_pool.outbox_stats,
+                                              'broker'))
+        METRICS.add_collector(stats_collector('bthome_split', broker_pool.split_stats,
+                                              'broker'))
+        METRICS.add_collector(stats_collector('bthome_aggregate', aggregator.stats))
+        METRICS.add_collector(stats_collector('bthome_devices', device_registry.stats))
+        if payload_cache is not None:
+          METRICS.add_collector(stats_collector('bthome_payload_cache', payload_cache.stats))
+        #: endif
+        if decryption_stage is not None:
+          METRICS.add_collector(stats_collector('bthome_decryption', decryption_stage.stats))
+        #: endif
+        if async_log_output is not None:
+          METRICS.add_collector(stats_collector('bthome_log_queue', async_log_output.stats))
+        #: endif
+        if capture_writer is not None:
+          METRICS.add_collector(stats_collector('bthome_record', capture_writer.stats))
+        #: endif
+        if state_store is not None:
+          METRICS.add_collector(stats_collector('bthome_state', state_store.stats))
+        #: endif
+      #: endif
+      bthome_decoder = create_bthome_decoder(
+          device_registry, meas_log_lvl, publish_queue, payload_cache, decryption_stage,
+          None if capture_writer is None else capture_writer.record, state_store, aggregator)
+      if state_store is not None:
+        lg.info('%s', f'Sharing state as node "{node}" thru "{state_store.name}".')
+      #: endif
+      reloader = asyncio.create_task(
+          reload_configuration(device_registry, broker_pool, publish_queue))
+      # one scanner per adapter, merging what they hear if several
+      scan_schedulers = {adapter: ScanScheduler(scan_time, scan_pause, adaptive_scan,
+                                                'BLE scanner' if adapter is None
+                                                else f'BLE scanner {adapter}')
+                         for adapter in adapters}
+      if len(adapters) > 1:
+        adapter_merger = AdapterMerger(bthome_decoder, merge_window)
+      #: endif
+      if METRICS.enabled:
+        METRICS.add_collector(stats_collector('bthome_scan', lambda: {
+            adapter or 'default': scan_scheduler.stats()
+            for adapter, scan_scheduler in scan_schedulers.items()}, 'adapter'))
+        if adapter_merger is not None:
+          METRICS.add_collector(stats_collector('bthome_adapter_merge', adapter_merger.stats))
+          METRICS.add_collector(stats_collector('bthome_adapter', adapter_merger.adapter_stats,
+                                                'adapter'))
+        #: endif
+      #: endif
+      results = await asyncio.gather(
+          *(scan_with_adapter(adapter, scan_scheduler,
+                              decode_in_task if adapter_merger is None
+                              else adapter_merger.wrap(adapter))
+            for adapter, scan_scheduler in scan_schedulers.items()),
+          return_exceptions = True)
+      # advertisements already heard reach the publish queue (and claims the
+      # state store) before the pipeline is closed
+      reloader.cancel()
+      await asyncio.gather(reloader, return_exceptions=True)
+      if adapter_merger is not None:
+        await adapter_merger.close()
+      #: endif
+      await asyncio.gather(*decode_tasks, return_exceptions=True)
+      for result in results:
+        if isinstance(result, BaseException):
+          raise result
+        #: endif
+      #: endfor result
+      if state_store is not None:
+        lg.info('%s', f'{state_store.won} readings claimed, {state_store.lost} claimed '\
+                      f'by other nodes, {state_store.failed} claims failed.')
+      #: endif
+    #: endwith broker_pool, publish_queue, aggregator, metrics, state_store
   except OSError as e:
     lg.critical('%s', f'OS error "{e}" (BLE adapter not ready/enabled?), terminating.')
   except Exception as e:
@@ -223,6 +714,14 @@ async def main():
   else: # normal termination
     lg.info('BLE scanner stopped.')
   finally:
+    if decryption_stage is not None:
+      decryption_stage.close()
+    #: endif
+    if capture_writer is not None:
+      capture_writer.close()
+      lg.info('%s', f'{capture_writer.recorded} advertisements recorded '\
+                    f'({capture_writer.dropped} dropped).')
+    #: endif
     lg.info('Exiting.')
   #: endtry ////////////////////////////////////////////////////////////////////
 
@@ -233,15 +732,13 @@ async def main():
 
 # ##############################################################################
 if __name__ == '__main__':
-  reload = False
-  platform_system = platform.system()
   if platform_system == "Windows":
     # required by aiomqtt
     asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
   #: endif
   asyncio.run(main())
-  # reload daemon (if signal HUP arrived)
-  if reload:
-    os.execv(sys.executable, [sys.executable] + sys.argv)
+  # write pending log messages (if logging asynchronously)
+  if async_log_output is not None:
+    async_log_output.stop()
   #: endif
 #: endif  ######################################################################
@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''Aggregation (downsampling) of the measurements of BTHome v2 devices over
+    tumbling time windows, before publishing them.'''
+
+
+
+# ##############################################################################
+import  logging as lg
+import  asyncio
+from    time import time
+# ..............................................................................
+from    bthome_decoder import BTHomeDevice, encode_measurements, holds_events, is_event
+from    bthome_mqtt import PublishQueue
+from    bthome_split import resolution
+# ##############################################################################
+
+
+
+# ##############################################################################
+class _Accumulator:
+  '''Aggregates of the values of a numeric property over a window (number,
+      sum, min., max. and last of them, and last unit), updated in O(1) per
+      value'''
+  __slots__ = ('count', 'total', 'low', 'high', 'last', 'extra')
+
+
+  # ****************************************************************************
+  def __init__(self, value: float, extra):
+    self.count = 1
+    self.total = self.low = self.high = self.last = value
+    self.extra = extra
+  #: enddef __init__ ///////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  def add(self, value: float, extra):
+    '''Adds a value'''
+    self.count += 1
+    self.total += value
+    if value < self.low:
+      self.low = value
+    elif value > self.high:
+      self.high = value
+    #: endif
+    self.last = value
+    self.extra = extra
+  #: enddef add ////////////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  def result(self, function: str) -> float:
+    '''Returns an aggregate (see bthome_decoder.AGGREGATE_FUNCTIONS)'''
+    match function:
+      case 'min':
+        return self.low
+      case 'max':
+        return self.high
+      case 'last':
+        return self.last
+      case _:
+        return self.total / self.count
+    #: endmatch
+  #: enddef result /////////////////////////////////////////////////////////////
+
+
+#: endclass _Accumulator #######################################################
+
+
+
+# ##############################################################################
+class _Window:
+  '''Aggregation window of a device, still open'''
+  __slots__ = ('device', 'end', 'numbers', 'texts', 'timer')
+
+
+  # ****************************************************************************
+  def __init__(self, device: BTHomeDevice, end: float):
+    self.device = device
+    self.end = end                                      # time() when closed
+    self.numbers: dict[str, _Accumulator] = {}          # indexed by property
+    self.texts: dict[str, tuple[str, None | str | int]] = {}  # last ones
+    self.timer: asyncio.TimerHandle | None = None
+  #: enddef __init__ ///////////////////////////////////////////////////////////
+
+
+#: endclass _Window ############################################################
+
+
+
+# ##############################################################################
+class Aggregator:
+  '''Aggregation stage, between the decoder and the publish queue, for devices
+      with an aggregation window (see DeviceConfig.window). Their binary
+      properties and events are published right away, while numbers are
+      accumulated and texts (as firmware version) remembered, until the end
+      of the window (windows are aligned to multiples of their length, e.g.
+      to each minute). Then, a single reading is published, with the last
+      texts and the aggregates of each number, as configured for its
+      property (see DeviceConfig.aggregates): the first one named after the
+      property, the other ones suffixed with "_<function>" (e.g.
+      "temperature_max"). Means are rounded to the resolution of their
+      property. Windows still open when the aggregator is closed are
+      published then.'''
+
+
+  # ****************************************************************************
+  def __init__(self, publish_queue: PublishQueue):
+    self._publish_queue = publish_queue
+    self._windows: dict[str, _Window] = {}    # open windows, indexed by MAC address
+    # counters
+    self.samples = 0        # readings aggregated
+    self.passed = 0         # readings with binary properties or events, passed thru
+    self.published = 0      # aggregated readings published
+  #: enddef __init__ ///////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  def submit(self, device: BTHomeDevice,
+             measurements: dict[str, tuple[bool | str | float, None | str | int]]):
+    '''Aggregates the measurements of a device with an aggregation window,
+        publishing its binary properties and events right away'''
+    now = time()
+    window = self._windows.get(device.mac)
+    if window is not None and now >= window.end:
+      self._close(device.mac, window.end)   # its timer did not fire yet
+      window = None
+    #: endif
+    if window is None:
+      length = device.config.window
+      end = (now // length + 1) * length
+      window = self._windows[device.mac] = _Window(device, end)
+      window.timer = asyncio.get_running_loop().call_later(end - now, self._close,
+                                                           device.mac, end)
+    #: endif
+    window.device = device
+    self.samples += 1
+    numbers = window.numbers
+    passed: dict | None = None
+    for key, (value, extra) in measurements.items():
+      if isinstance(value, bool) or is_event(key):
+        if passed is None:
+          passed = {}
+        #: endif
+        passed[key] = (value, extra)
+      elif isinstance(value, str):
+        window.texts[key] = (value, extra)
+      else:
+        accumulator = numbers.get(key)
+        if accumulator is None:
+          numbers[key] = _Accumulator(value, extra)
+        else:
+          accumulator.add(value, extra)
+        #: endif
+      #: endif
+    #: endfor key, (value, extra)
+    if passed is not None:
+      self.passed += 1
+      self._publish_queue.submit(device, passed, encode_measurements(passed),
+                                 not holds_events(passed))
+    #: endif
+  #: enddef submit /////////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  def _close(self, mac: str, end: float):
+    '''Closes the window of a device ending at a time, if still open,
+        publishing its aggregates'''
+    window = self._windows.get(mac)
+    if window is None or window.end != end:
+      return
+    #: endif
+    del self._windows[mac]
+    if window.timer is not None:
+      window.timer.cancel()
+    #: endif
+    aggregates = dict(window.device.config.aggregates)
+    default = aggregates.get('*', ('mean', ))
+    measurements: dict[str, tuple[bool | str | float, None | str | int]] = {}
+    for key, accumulator in window.numbers.items():
+      functions = aggregates.get(key) or aggregates.get(key.partition('_')[0]) or default
+      for i, function in enumerate(functions):
+        value = accumulator.result(function)
+        if function == 'mean':
+          value = round(value, resolution(key)[1])
+        #: endif
+        measurements[key if i == 0 else f'{key}_{function}'] = (value, accumulator.extra)
+      #: endfor i, function
+    #: endfor key, accumulator
+    measurements.update(window.texts)
+    if measurements:
+      self.published += 1
+      self._publish_queue.submit(window.device, measurements,
+                                 encode_measurements(measurements))
+    #: endif
+  #: enddef _close /////////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  def stats(self) -> dict[str, int]:
+    '''Returns the number of readings aggregated, passed thru and published,
+        and of open windows'''
+    return {'samples': self.samples, 'passed': self.passed, 'published': self.published,
+            'windows': len(self._windows)}
+  #: enddef stats //////////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  async def close(self):
+    '''Publishes the aggregates of all open windows'''
+    for mac, window in list(self._windows.items()):
+      self._close(mac, window.end)
+    #: endfor mac, window
+    if self.samples:
+      lg.info('%s', f'{self.samples} readings aggregated into {self.published} '\
+                    f'({self.passed} passed thru).')
+    #: endif
+  #: enddef close //////////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  async def __aenter__(self):
+    return self
+  #: enddef __aenter__ /////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  async def __aexit__(self, exc_type, exc, tb):
+    await self.close()
+  #: enddef __aexit__ //////////////////////////////////////////////////////////
+
+
+#: endclass Aggregator #########################################################
@@ -0,0 +1,920 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''Micro-benchmarks for the BTHome v2 decoding pipeline.'''
+
+
+
+# ##############################################################################
+import  argparse
+import  os
+import  sys
+import  subprocess
+import  tempfile
+import  re
+import  struct
+import  asyncio
+import  tracemalloc
+import  logging as lg
+from    time import perf_counter, process_time, time
+# ..............................................................................
+import  yaml                                # pyyaml + types-PyYAML
+from    Cryptodome.Cipher import AES        # pycryptodome[x]
+from    bleak.backends.device import BLEDevice
+from    bleak.backends.scanner import AdvertisementData
+# ..............................................................................
+from    bthome_constants import SENSOR
+from    bthome_decoder import Broker, BTHomeDevice, create_bthome_decoder, DeviceConfig, \
+                                get_bthome_devices_from_yaml_file, encode_measurements, \
+                                PayloadCache, _encode_json, _encode_fast
+from    bthome_mqtt import PublishQueue
+from    bthome_log import HOT_LOG
+from    bthome_capture import CapturedAdvertisement, LatencyProbe, LoopbackBrokerPool, \
+                              replay, to_bleak
+from    bthome_aggregate import Aggregator
+# ##############################################################################
+
+
+
+# some constants  ##############################################################
+# payloads (without the device info byte) recorded from real and example
+# BTHome v2 devices
+RECORDED_PAYLOADS = [bytes.fromhex(payload) for payload in (
+  '0011016402ca0903bf13',                     # H&T: packet id, battery, temp., hum.
+  '0a138a140b02b4000c8c0c',                   # plug: energy, power, voltage
+  '4787564b138a14',                           # meter: volume, gas
+  '01642d013f0201',                           # window: battery, window, rotation
+  '002101643a013a003a023a04',                 # 4 buttons: packet id, battery, events
+  '3c0103',                                   # dimmer: event with steps
+  '530d48656c6c6f2c20576f726c6421',           # text
+  'f00100f104030201',                         # device type id, firmware version
+  '016402ca0903bf1304138a0105138a14450401',   # weather station
+)]
+# MAC address and key of the device used when benchmarking decryption
+_MAC = 'A4C138000000'
+_KEY = bytes.fromhex('231d39c1d7cc1ab1aee224cd096db932')
+# replay scenarios: (kind of devices, number of devices)
+_SCENARIOS = (('plain', 10), ('encrypted', 10), ('plain', 100), ('encrypted', 100),
+              ('plain', 1000), ('encrypted', 1000), ('promiscuous', 1000))
+# publish scenarios: (kind of device, number of topics per broker)
+_PUBLISH_SCENARIOS = (('configured', 1), ('configured', 3), ('promiscuous', 1),
+                      ('promiscuous', 3))
+# burst scenarios: (name, max. inflight publishments, batch delay in s), the
+#   first one as the former 2 publishing workers per broker
+_BURST_SCENARIOS = (('2 workers', 2, 0.0), ('pipelined', 64, 0.0), ('pipelined', 64, 0.005),
+                    ('pipelined', 256, 0.0))
+# aggregation scenarios: aggregate functions of all properties
+_AGGREGATE_SCENARIOS = (('last', ), ('mean', ), ('mean', 'min', 'max'))
+# modules imported on demand: (module, when)
+_DEFERRED_MODULES = (('aiomqtt', 'first MQTT connection'),
+                     ('Cryptodome.Cipher.AES', 'first device with a key'))
+# ##############################################################################
+
+
+
+# ##############################################################################
+def _reference_parse(self: BTHomeDevice, payload: bytes) -> dict | None:
+  '''BTHomeDevice.parse as it was before the precompiled decoding table, kept
+      as a reference for benchmarking.'''
+  value: bool | str | float = ''
+  measurements: dict[str, tuple[bool | str | float, None | str | int]] = {}
+  event_type: str | None = None
+  event_property: int | None = None
+  # to manage same kind of measurements from same sensor
+  measurement_counter = bytearray(b'\00' * 256)
+  # walk the payload
+  while len(payload) > 1:
+    sensor_id = payload[0]
+    sensor = SENSOR.get(sensor_id)
+    if sensor is None:
+      break   # unknown sensor, can't do anymore
+    #: endif
+    payload = payload[1:]
+    property_name = sensor.property
+    n_bytes = sensor.bytes
+    if sensor.events:
+      # is an event sensor
+      event_type = sensor.events.get(payload[0])
+      event_property = int(payload[1]) if n_bytes == 2 else None
+    elif n_bytes:
+      # has a fixed size value length
+      value_i = int.from_bytes(payload[:n_bytes], byteorder='little', signed=sensor.signed)
+      value = float(value_i * sensor.factor)
+      # manage packet id
+      if sensor_id == 0:
+        new_timestamp = time()
+        packet_id = self.packet_id
+        if not ((new_timestamp > self.timestamp + 4.0)
+            or (value_i > packet_id and value_i - packet_id < 64)
+            or (value_i < packet_id and value_i + 256 - packet_id < 64)
+            or (value_i == packet_id and not self.config.deduplicate)):
+          measurements = {}   # reject measurements
+          break
+        #: endif
+        self.timestamp = new_timestamp
+        self.packet_id = value_i
+      #: endif
+      if sensor.binary:
+        # is a binary sensor
+        value = bool(value_i)
+      elif 0xF1 <= sensor_id <= 0xF2:
+        # is firmware version
+        value = f'{value_i:0{2 * n_bytes}x}'
+      #: endif
+    else:
+      # has a variable value length (text 0x53, raw 0x54)
+      n_bytes, payload = payload[0], payload[1:]
+      value_b: bytes = payload[:n_bytes]
+      value = value_b.decode() if sensor_id == 0x53 else value_b.hex()
+    #: endif
+    payload = payload[n_bytes:]   # skip to next sensor
+    # increase the measurements counter for each sensor
+    measurement_counter[sensor_id] = cnt = measurement_counter[sensor_id] + 1
+    # manage sensor names in case of > 1 measurements from same sensor
+    if cnt > 1:
+      property_name += '_' + str(cnt)
+    #: endif
+    if event_type is not None:
+      measurements[property_name] = (event_type, event_property)
+    elif (not sensor.events) and (sensor_id != 0):  # do not report packet id
+      measurements[property_name] = (value, sensor.unit)
+    #: endif
+  #: endwhile (data available)
+  return measurements if measurements else None
+#: enddef _reference_parse #####################################################
+
+
+
+# ##############################################################################
+def _reference_decrypt(self: BTHomeDevice, ciphertext: bytes) -> bytes | None:
+  '''BTHomeDevice.decrypt as it was before caching the AES cipher state, kept
+      as a reference for benchmarking.'''
+  if len(ciphertext) <= 9:
+    return None
+  #: endif
+  if self.config.key == b'':
+    return None
+  #: endif
+  if self.config.deduplicate and hash(ciphertext) == self.ciphertext_hash:
+    return None
+  #: endif
+  new_counter_b = ciphertext[-8:-4]
+  new_counter = int.from_bytes(new_counter_b, byteorder='little', signed=False)
+  # protect against replay attacks
+  if ((0x100 <= new_counter < self.counter)
+      and (self.ciphertext_hash is not None)):
+    return None
+  #: endif
+  nonce = bytes.fromhex(self.mac) + b'\xd2\xfc' + ciphertext[0:1] + new_counter_b
+  mic = ciphertext[-4:]
+  cipher = AES.new(self.config.key, AES.MODE_CCM, nonce=nonce, mac_len=4)
+  try:
+    payload = cipher.decrypt_and_verify(ciphertext[1:-8], mic)
+  except ValueError:
+    return None
+  #: endtry
+  self.ciphertext_hash = hash(ciphertext)
+  self.counter = new_counter
+  return payload
+#: enddef _reference_decrypt ###################################################
+
+
+
+# ##############################################################################
+async def _reference_publish_to_broker(self: BTHomeDevice, broker: Broker,
+                                       mqtt_payload: str | bytes, broker_pool):
+  '''BTHomeDevice.publish_to_broker as it was before resolving topics once, kept
+      as a reference for benchmarking (but logging, metrics and errors).'''
+
+  # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+  async def publish_to_topic(topic: str):
+    full_topic = topic + '/' + self.mac if self.config.promiscuous else topic
+    full_topic = re.sub('/+', '/', full_topic)
+    if HOT_LOG.debug:
+      pass
+    #: endif
+    await connection.publish(full_topic, mqtt_payload, timeout=10)
+  #: enddef publish_to_topic ---------------------------------------------------
+
+  connection = broker_pool.get(broker)
+  async with asyncio.TaskGroup() as tg_topic:
+    for topic in broker.topics:
+      tg_topic.create_task(publish_to_topic(topic))
+    #: endfor topic
+  #: endwith tg_topic
+#: enddef _reference_publish_to_broker #########################################
+
+
+
+# ##############################################################################
+def encrypt(mac: str, key: bytes, payload: bytes, counter: int) -> bytes:
+  '''Encrypts a payload as a BTHome v2 device would. Returns the service data
+      (device info byte, ciphertext, counter and MIC).'''
+  device_info = b'\x41'   # BTHome v2, encrypted
+  counter_b = counter.to_bytes(4, byteorder='little')
+  nonce = bytes.fromhex(mac) + b'\xd2\xfc' + device_info + counter_b
+  ciphertext, mic = AES.new(key, AES.MODE_CCM, nonce=nonce, mac_len=4).encrypt_and_digest(payload)
+  return device_info + ciphertext + counter_b + mic
+#: enddef encrypt ##############################################################
+
+
+
+# ##############################################################################
+def _compare(implementations: dict, run, n_packets: int, args: argparse.Namespace):
+  '''Prints the packets/s of each implementation (a name indexed dict), as
+      measured by run(implementation), best of args.repeat.'''
+  results = dict.fromkeys(implementations, 0.0)
+  for _ in range(args.repeat):
+    # interleaved, so that all suffer alike from any load on the machine
+    for name, implementation in implementations.items():
+      start = perf_counter()
+      run(implementation)
+      results[name] = max(results[name], n_packets / (perf_counter() - start))
+    #: endfor name, implementation
+  #: endfor _
+  for name, packets_per_second in results.items():
+    print(f'  {name:<10} {packets_per_second:>12,.0f} packets/s')
+  #: endfor name, packets_per_second
+  reference, new = results.values()
+  print(f'  speedup    {new / reference:>12.2f} x')
+#: enddef _compare #############################################################
+
+
+
+# ##############################################################################
+def benchmark_parse(args: argparse.Namespace):
+  '''Compares the packets/s of BTHomeDevice.parse against the reference
+      implementation, on the recorded payloads.'''
+  payloads = RECORDED_PAYLOADS
+  # packet ids are accepted again and again, as the device does not deduplicate
+  device = BTHomeDevice(DeviceConfig(mac='A4C138000000', deduplicate=False))
+  for payload in payloads:
+    new, reference = BTHomeDevice.parse(device, payload), _reference_parse(device, payload)
+    if new != reference:
+      print(f'Payload {payload.hex()} decodes differently:\n'\
+            f'  parse:     {new}\n  reference: {reference}')
+    #: endif
+  #: endfor payload
+
+  # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+  def run(parse):
+    for _ in range(args.rounds):
+      for payload in payloads:
+        parse(device, payload)
+      #: endfor payload
+    #: endfor _
+  #: enddef run ----------------------------------------------------------------
+
+  print(f'Parsing {len(payloads)} recorded payloads, {args.rounds} rounds, best of {args.repeat}:')
+  _compare({'reference': _reference_parse, 'parse': BTHomeDevice.parse}, run,
+           args.rounds * len(payloads), args)
+#: enddef benchmark_parse ######################################################
+
+
+
+# ##############################################################################
+def benchmark_decrypt(args: argparse.Namespace):
+  '''Compares the packets/s of BTHomeDevice.decrypt against the reference
+      implementation, on the recorded payloads encrypted with increasing
+      counters.'''
+  packets = [encrypt(_MAC, _KEY, payload, counter)
+             for counter, payload in enumerate(RECORDED_PAYLOADS * 10, start=0x100)]
+  device = BTHomeDevice(DeviceConfig(mac=_MAC, key=_KEY))
+  for packet in packets:
+    # both must accept every packet and decrypt it alike
+    device.counter, device.ciphertext_hash = -1, None
+    reference = _reference_decrypt(device, packet)
+    device.counter, device.ciphertext_hash = -1, None
+    new = BTHomeDevice.decrypt(device, packet)
+    if not reference or new != reference:
+      print(f'Packet {packet.hex()} decrypts differently.')
+    #: endif
+  #: endfor packet
+
+  # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+  def run(decrypt):
+    for _ in range(args.rounds):
+      # restart replay protection
+      device.counter, device.ciphertext_hash = -1, None
+      for packet in packets:
+        decrypt(device, packet)
+      #: endfor packet
+    #: endfor _
+  #: enddef run ----------------------------------------------------------------
+
+  print(f'Decrypting {len(packets)} packets, {args.rounds} rounds, best of {args.repeat}:')
+  _compare({'reference': _reference_decrypt, 'decrypt': BTHomeDevice.decrypt}, run,
+           args.rounds * len(packets), args)
+#: enddef benchmark_decrypt ####################################################
+
+
+
+# ##############################################################################
+class _NullPublishQueue:
+  '''Stand-in for bthome_mqtt.PublishQueue, discarding all measurements'''
+  def submit(self, *args):
+    pass
+  #: enddef submit /////////////////////////////////////////////////////////////
+#: endclass _NullPublishQueue ##################################################
+
+
+
+# ##############################################################################
+def _run_decoder(decoder, ble_device: BLEDevice, advertisement_data: AdvertisementData):
+  '''Runs a decoder callback to completion, without an event loop (it never
+      suspends unless using a decryption stage)'''
+  try:
+    decoder(ble_device, advertisement_data).send(None)
+  except StopIteration:
+    pass
+  #: endtry
+#: enddef _run_decoder #########################################################
+
+
+
+# ##############################################################################
+def benchmark_log(args: argparse.Namespace):
+  '''Measures the CPU time per advertisement of the whole decoder callback
+      (decryption, parsing, encoding), with the log level at INFO and at DEBUG,
+      on advertisements from plain and encrypted devices. Log records go to
+      the null device.'''
+  devices: dict[str, DeviceConfig] = {}
+  advertisements: list[tuple[BLEDevice, AdvertisementData]] = []
+  for i, payload in enumerate(RECORDED_PAYLOADS):
+    for key in (b'', _KEY):
+      mac = _MAC[:-4] + f'{int(bool(key)):02X}{i:02X}'
+      # every advertisement is accepted again and again
+      devices[mac] = DeviceConfig(mac=mac, key=key, deduplicate=False)
+      data = encrypt(mac, key, payload, 0x100) if key else b'\x40' + payload
+      advertisements.append(to_bleak(CapturedAdvertisement(0.0, mac, -60, data)))
+    #: endfor key
+  #: endfor i, payload
+  decoder = create_bthome_decoder(devices, lg.DEBUG, _NullPublishQueue())
+  handler = lg.StreamHandler(open(os.devnull, 'w', encoding='utf-8'))
+  handler.setFormatter(lg.Formatter('%(levelname)s: %(message)s'))
+  lg.getLogger().addHandler(handler)
+  n_packets = args.rounds * len(advertisements)
+  print(f'Decoding {len(advertisements)} advertisements ({len(advertisements) // 2} encrypted), '
+        f'{args.rounds} rounds, best of {args.repeat}:')
+  for level in ('INFO', 'DEBUG'):
+    lg.getLogger().setLevel(level)
+    HOT_LOG.refresh()   # log levels changed
+    best = float('inf')
+    for _ in range(args.repeat):
+      start = process_time()
+      for _ in range(args.rounds):
+        for ble_device, advertisement_data in advertisements:
+          _run_decoder(decoder, ble_device, advertisement_data)
+        #: endfor ble_device, advertisement_data
+      #: endfor _
+      best = min(best, process_time() - start)
+    #: endfor _
+    print(f'  {level:<10} {best / n_packets * 1e6:>12.2f} us CPU/advertisement')
+  #: endfor level
+  lg.getLogger().removeHandler(handler)
+  handler.close()
+#: enddef benchmark_log ########################################################
+
+
+
+# ##############################################################################
+def synthesize_capture(kind: str, n_devices: int, rounds: int, interval: float = 10.0,
+                       repeats: int = 3) -> tuple[dict[str, DeviceConfig],
+                                                  list[CapturedAdvertisement]]:
+  '''Returns the configuration of n_devices thermometers of a kind (plain,
+      encrypted or promiscuous, this is, plain but not configured) and their
+      advertisements along rounds: each round, every device advertises a new
+      reading (with a new packet id), repeated a few times, at a regular
+      interval.'''
+  broker = Broker(hostname='loopback', port=1883, topics=('bthome/sensors', ), encrypt=False)
+  key = _KEY if kind == 'encrypted' else b''
+  macs = [f'{_MAC[:6]}{device:06X}' for device in range(n_devices)]
+  if kind == 'promiscuous':
+    devices = {'PROMISCUOUS': DeviceConfig(mac='PROMISCUOUS', brokers=(broker, ))}
+  else:
+    devices = {mac: DeviceConfig(mac=mac, key=key, brokers=(broker, )) for mac in macs}
+  #: endif
+  advertisements = []
+  for round_ in range(rounds):
+    for device, mac in enumerate(macs):
+      # packet id, battery, temperature, humidity
+      payload = struct.pack('<BBBBBhBH', 0x00, round_ & 0xFF, 0x01, 100 - device % 50,
+                            0x02, 2000 + (device * 7 + round_) % 500, 0x03, 5000 + round_ % 100)
+      data = encrypt(mac, key, payload, 0x100 + round_) if key else b'\x40' + payload
+      timestamp = round_ * interval + device * interval / n_devices
+      for repeat in range(repeats):
+        advertisements.append(CapturedAdvertisement(timestamp + repeat * 0.01, mac,
+                                                    -60 - device % 30, data))
+      #: endfor repeat
+    #: endfor device, mac
+  #: endfor round_
+  advertisements.sort(key=lambda advertisement: advertisement.timestamp)
+  return devices, advertisements
+#: enddef synthesize_capture ###################################################
+
+
+
+# ##############################################################################
+async def _replay_scenario(devices: dict[str, DeviceConfig],
+                           advertisements: list[tuple[float, BLEDevice, AdvertisementData]]
+    ) -> tuple[float, LatencyProbe, int]:
+  '''Replays advertisements at max speed thru a fresh pipeline, publishing to
+      the loopback MQTT stand-in. Returns the time taken (until all is
+      published), the latency probe and the number of publishments.'''
+  probe = LatencyProbe()
+  broker_pool = LoopbackBrokerPool(on_publish=probe.on_publish)
+  async with broker_pool, PublishQueue(broker_pool) as publish_queue:
+    probe.publish_queue = publish_queue
+    decoder = create_bthome_decoder(devices, lg.DEBUG, probe,   # type: ignore[arg-type]
+                                    PayloadCache())
+    start = perf_counter()
+    await replay(advertisements, decoder)
+    await publish_queue.join()
+    elapsed = perf_counter() - start
+    published = sum(connection.published for connection in broker_pool.connections())
+  #: endwith broker_pool, publish_queue
+  return elapsed, probe, published
+#: enddef _replay_scenario #####################################################
+
+
+
+# ##############################################################################
+def benchmark_replay(args: argparse.Namespace):
+  '''Replays synthetic captures of several scenarios (number and kind of
+      devices) at max speed thru the whole pipeline (but BLE and MQTT),
+      reporting advertisements/s, end-to-end latency percentiles and peak
+      memory allocated while replaying.'''
+  print(f'Replaying ~{args.advertisements} advertisements per scenario (each reading '
+        f'advertised 3 times), best of {args.repeat}:')
+  print(f'  {"scenario":<12} {"devices":>7} {"adverts/s":>12} {"published":>10} '
+        f'{"p50 ms":>8} {"p99 ms":>8} {"peak MiB":>9}')
+  for kind, n_devices in _SCENARIOS:
+    if args.scenario and kind not in args.scenario:
+      continue
+    #: endif
+    rounds = max(1, args.advertisements // (3 * n_devices))
+    devices, capture = synthesize_capture(kind, n_devices, rounds)
+    advertisements = [(advertisement.timestamp, *to_bleak(advertisement))
+                      for advertisement in capture]
+    best: tuple | None = None
+    for _ in range(args.repeat):
+      elapsed, probe, published = asyncio.run(_replay_scenario(devices, advertisements))
+      if best is None or elapsed < best[0]:
+        best = (elapsed, probe, published)
+      #: endif
+    #: endfor _
+    assert best is not None
+    elapsed, probe, published = best
+    # memory is measured apart, as tracing slows everything down
+    tracemalloc.start()
+    asyncio.run(_replay_scenario(devices, advertisements))
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    print(f'  {kind:<12} {n_devices:>7} {len(advertisements) / elapsed:>12,.0f} '
+          f'{published:>10} {probe.percentile(50) * 1000:>8.3f} '
+          f'{probe.percentile(99) * 1000:>8.3f} {peak / 2**20:>9.2f}')
+  #: endfor kind, n_devices
+#: enddef benchmark_replay #####################################################
+
+
+
+# ##############################################################################
+def _import_times(modules: str) -> list[tuple[int, int, str]]:
+  '''Imports modules (comma separated) in a fresh interpreter, as
+      python -X importtime would. Returns the self and cumulative import
+      times (us) of every imported module, and its name (indented by
+      nesting level), in import order.'''
+  result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {modules}'],
+                          cwd=os.path.dirname(os.path.abspath(__file__)),
+                          capture_output=True, text=True, check=True)
+  times = []
+  for line in result.stderr.splitlines():
+    if not line.startswith('import time:'):
+      continue
+    #: endif
+    self_us, cumulative_us, name = line[len('import time:'):].split('|')
+    if self_us.strip().isdigit():   # not the header
+      times.append((int(self_us), int(cumulative_us), name.rstrip()[1:]))
+    #: endif
+  #: endfor line
+  return times
+#: enddef _import_times ########################################################
+
+
+
+# ##############################################################################
+def benchmark_startup(args: argparse.Namespace):
+  '''Measures the import time of bthome2mqtt (most of the time to first scan)
+      in fresh interpreters, reporting the slowest modules, and the import
+      time of the modules deferred until needed.'''
+  best: list[tuple[int, int, str]] = []
+  best_wall = float('inf')
+  for _ in range(args.repeat):
+    start = perf_counter()
+    times = _import_times('bthome2mqtt')
+    best_wall = min(best_wall, perf_counter() - start)
+    if not best or times[-1][1] < best[-1][1]:
+      best = times
+    #: endif
+  #: endfor _
+  print(f'Importing bthome2mqtt in a fresh interpreter, best of {args.repeat}:')
+  print(f'  {"total":<40} {best[-1][1] / 1000:>8.1f} ms')
+  print(f'  {"interpreter startup and imports":<40} {best_wall * 1000:>8.1f} ms')
+  print('  slowest modules (self time):')
+  for self_us, cumulative_us, name in sorted(best, reverse=True)[:args.top]:
+    print(f'    {name.strip():<38} {self_us / 1000:>8.1f} ms')
+  #: endfor self_us, cumulative_us, name
+  print('  deferred modules (cumulative time, when imported):')
+  imported = {name.strip() for _, _, name in best}
+  for module, when in _DEFERRED_MODULES:
+    if module in imported:
+      print(f'    {module:<38} imported at startup')
+      continue
+    #: endif
+    cumulative = min(_import_times(f'bthome2mqtt, {module}')[-1][1]
+                     for _ in range(args.repeat))
+    print(f'    {module:<38} {cumulative / 1000:>8.1f} ms  ({when})')
+  #: endfor module, when
+#: enddef benchmark_startup ####################################################
+
+
+
+# ##############################################################################
+def synthesize_config(n_devices: int) -> str:
+  '''Returns a YAML configuration file for n_devices devices (half of them
+      encrypted), each publishing to two brokers'''
+  lines = []
+  for device in range(n_devices):
+    lines.append(f'{_MAC[:6]}{device:06X}:')
+    if device % 2:
+      lines.append(f'  key: {_KEY.hex()}')
+    #: endif
+    lines += ['  deduplicate: yes',
+              '  brokers:',
+              '    - hostname: 127.0.0.1',
+              '      port: 1883',
+              '      encrypt: no',
+              f'      topics: [bthome/{device}, logger/{device}]',
+              '    - hostname: my.mqtt.broker.xyz',
+              '      user: my_username',
+              '      password: my_password',
+              f'      topics: [sensors/thermo_{device}]']
+  #: endfor device
+  return '\n'.join(lines) + '\n'
+#: enddef synthesize_config ####################################################
+
+
+
+# ##############################################################################
+def benchmark_config(args: argparse.Namespace):
+  '''Measures the time to read a synthetic YAML configuration file: parsed by
+      the pure Python and libyaml (if available) YAML loaders, and loaded
+      from the configuration cache'''
+  text = synthesize_config(args.devices)
+  lg.getLogger().setLevel(lg.WARNING)
+
+  # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+  def best_of(run) -> float:
+    best = float('inf')
+    for _ in range(args.repeat):
+      start = perf_counter()
+      run()
+      best = min(best, perf_counter() - start)
+    #: endfor _
+    return best
+  #: enddef best_of ------------------------------------------------------------
+
+  print(f'Reading a configuration of {args.devices} devices ({len(text) / 1024:.0f} KiB), '
+        f'best of {args.repeat}:')
+  print(f'  {"yaml.SafeLoader":<36} {best_of(lambda: yaml.load(text, yaml.SafeLoader)):>8.3f} s')
+  if hasattr(yaml, 'CSafeLoader'):
+    print(f'  {"yaml.CSafeLoader":<36} '
+          f'{best_of(lambda: yaml.load(text, yaml.CSafeLoader)):>8.3f} s')
+  else:
+    print(f'  {"yaml.CSafeLoader":<36} not available (pyyaml without libyaml)')
+  #: endif
+  with tempfile.TemporaryDirectory() as directory:
+    config_file_name = os.path.join(directory, 'bthome_devices.yaml')
+    cache_file_name = config_file_name + '.cache'
+    with open(config_file_name, 'wt', encoding='utf-8') as config_file:
+      config_file.write(text)
+    #: endwith config_file
+    devices = get_bthome_devices_from_yaml_file(config_file_name)
+    assert devices is not None and len(devices) == args.devices
+    print(f'  {"loader, no cache":<36} '
+          f'{best_of(lambda: get_bthome_devices_from_yaml_file(config_file_name)):>8.3f} s')
+
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    def load_cached(touch: bool = False):
+      if touch:
+        os.utime(config_file_name)  # modified, but same contents
+      #: endif
+      cached = get_bthome_devices_from_yaml_file(config_file_name, cache_file_name)
+      assert cached == devices
+    #: enddef load_cached ------------------------------------------------------
+
+    print(f'  {"loader, cache hit":<36} {best_of(load_cached):>8.3f} s')
+    print(f'  {"loader, cache hit (touched file)":<36} '
+          f'{best_of(lambda: load_cached(True)):>8.3f} s')
+  #: endwith directory
+#: enddef benchmark_config #####################################################
+
+
+
+# ##############################################################################
+def benchmark_publish(args: argparse.Namespace):
+  '''Measures the CPU time per message of the publishing path: JSON encoding of
+      measurements (with each encoder, installed or not), then publishment to the topics of a
+      broker (against the reference implementation), to a loopback
+      connection.'''
+  device = BTHomeDevice(DeviceConfig(mac=_MAC, deduplicate=False))
+  readings = [measurements for measurements in map(device.parse, RECORDED_PAYLOADS)
+              if measurements]
+  encoders = {'json': _encode_json, 'hand-rolled': _encode_fast}
+  try:
+    import  orjson                          # optional
+    encoders['orjson'] = orjson.dumps
+  except ImportError:
+    pass
+  #: endtry
+  print(f'JSON encoding {len(readings)} decoded payloads, {args.rounds} rounds, '
+        f'best of {args.repeat}:')
+  for name, encode in encoders.items():
+    for measurements in readings:
+      # orjson output is compact, and UTF-8 encoded
+      if name != 'orjson' and encode(measurements) != _encode_json(measurements):
+        print(f'Measurements {measurements} encode differently with {name}.')
+      #: endif
+    #: endfor measurements
+    best = float('inf')
+    for _ in range(args.repeat):
+      start = process_time()
+      for _ in range(args.rounds):
+        for measurements in readings:
+          encode(measurements)
+        #: endfor measurements
+      #: endfor _
+      best = min(best, process_time() - start)
+    #: endfor _
+    print(f'  {name:<12} {best / args.rounds / len(readings) * 1e6:>10.2f} us CPU/message')
+  #: endfor name, encode
+  mqtt_payload = encode_measurements(readings[0])
+  broker_pool = LoopbackBrokerPool()
+
+  # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+  async def run(publish_to_broker, device: BTHomeDevice, broker: Broker) -> float:
+    start = process_time()
+    for _ in range(args.rounds):
+      await publish_to_broker(device, broker, mqtt_payload, broker_pool)
+    #: endfor _
+    return process_time() - start
+  #: enddef run ----------------------------------------------------------------
+
+  print(f'Publishing {args.rounds} messages to the topics of a broker, best of {args.repeat}:')
+  print(f'  {"device":<12} {"topics":>6} {"reference us":>13} {"new us":>8} {"speedup":>8}')
+  for kind, n_topics in _PUBLISH_SCENARIOS:
+    broker = Broker(hostname='loopback', port=1883, encrypt=False,
+                    topics=tuple(f'bthome/sensors_{topic}' for topic in range(n_topics)))
+    config = DeviceConfig(mac=_MAC, brokers=(broker, ), promiscuous=kind == 'promiscuous')
+    device = BTHomeDevice(config)
+    results = {}
+    for publish_to_broker in (_reference_publish_to_broker, BTHomeDevice.publish_to_broker):
+      results[publish_to_broker] = min(asyncio.run(run(publish_to_broker, device, broker))
+                                       for _ in range(args.repeat)) / args.rounds * 1e6
+    #: endfor publish_to_broker
+    reference, new = results.values()
+    print(f'  {kind:<12} {n_topics:>6} {reference:>13.2f} {new:>8.2f} {reference / new:>7.2f}x')
+  #: endfor kind, n_topics
+#: enddef benchmark_publish ####################################################
+
+
+
+# ##############################################################################
+async def _drain_burst(devices: list[BTHomeDevice], mqtt_payload: bytes, round_trip: float,
+                       max_inflight: int, batch_delay: float) -> float:
+  '''Queues a reading of each device at once, as after a scan restart, then
+      returns the time taken to publish them all to a loopback broker with
+      some round trip time'''
+  broker_pool = LoopbackBrokerPool(delay=round_trip)
+  async with broker_pool, PublishQueue(broker_pool, len(devices), max_inflight,
+                                       batch_delay=batch_delay) as publish_queue:
+    start = perf_counter()
+    for device in devices:
+      publish_queue.submit(device, {}, mqtt_payload)
+    #: endfor device
+    await publish_queue.join()
+    return perf_counter() - start
+  #: endwith broker_pool, publish_queue
+#: enddef _drain_burst #########################################################
+
+
+
+# ##############################################################################
+def benchmark_burst(args: argparse.Namespace):
+  '''Measures the time to publish a burst of readings (one per device) to a
+      broker with some round trip time, publishing (as formerly) 2 readings at
+      once, or pipelining them.'''
+  broker = Broker(hostname='loopback', port=1883, encrypt=False, qos=1,
+                  topics=('bthome/sensors', ))
+  config = DeviceConfig(mac='PROMISCUOUS', brokers=(broker, ), promiscuous=True)
+  devices = [BTHomeDevice(config, f'{_MAC[:6]}{device:06X}') for device in range(args.devices)]
+  mqtt_payload = encode_measurements({'temperature': (20.5, '°C')})
+  print(f'Publishing a burst of {args.devices} readings, {args.round_trip * 1000:g} ms broker '
+        f'round trip, best of {args.repeat}:')
+  print(f'  {"scenario":<12} {"inflight":>8} {"batch ms":>9} {"drain ms":>9}')
+  for name, max_inflight, batch_delay in _BURST_SCENARIOS:
+    elapsed = min(asyncio.run(_drain_burst(devices, mqtt_payload, args.round_trip,
+                                           max_inflight, batch_delay))
+                  for _ in range(args.repeat))
+    print(f'  {name:<12} {max_inflight:>8} {batch_delay * 1000:>9g} {elapsed * 1000:>9.1f}')
+  #: endfor name, max_inflight, batch_delay
+#: enddef benchmark_burst ######################################################
+
+
+
+# ##############################################################################
+class _CountingPublishQueue:
+  '''Stand-in for bthome_mqtt.PublishQueue, only counting measurements'''
+  def __init__(self):
+    self.submitted = 0
+  #: enddef __init__ ///////////////////////////////////////////////////////////
+  def submit(self, *args):
+    self.submitted += 1
+  #: enddef submit /////////////////////////////////////////////////////////////
+#: endclass _CountingPublishQueue ##############################################
+
+
+
+# ##############################################################################
+async def _aggregate(devices: list[BTHomeDevice], rounds: int) -> tuple[float, int]:
+  '''Aggregates rounds of readings of thermometers (as their measurements,
+      without events), then closes the windows. Returns the CPU time taken
+      to aggregate and the number of messages published.'''
+  publish_queue = _CountingPublishQueue()
+  aggregator = Aggregator(publish_queue)  # type: ignore[arg-type]
+  start = process_time()
+  for round_ in range(rounds):
+    for device in devices:
+      aggregator.submit(device, {'battery': (80.0, '%'),
+                                 'temperature': (20.0 + round_ % 100 * 0.01, '°C'),
+                                 'humidity': (50.0 + round_ % 7 * 0.01, '%'),
+                                 'RSSI': (-60.0 - round_ % 5, 'dBm')})
+    #: endfor device
+  #: endfor round_
+  elapsed = process_time() - start
+  await aggregator.close()
+  return elapsed, publish_queue.submitted
+#: enddef _aggregate ###########################################################
+
+
+
+# ##############################################################################
+def benchmark_aggregate(args: argparse.Namespace):
+  '''Measures the CPU time per reading of the aggregation stage, for
+      thermometers with 60 s windows aggregated with several functions, and
+      the messages published instead of one per reading'''
+  print(f'Aggregating {args.rounds} readings from each of {args.devices} thermometers, '
+        f'best of {args.repeat}:')
+  print(f'  {"functions":<16} {"us CPU/reading":>14} {"readings":>9} {"published":>10}')
+  for functions in _AGGREGATE_SCENARIOS:
+    config = DeviceConfig(mac='PROMISCUOUS', promiscuous=True, window=60.0,
+                          aggregates=(('*', functions), ))
+    devices = [BTHomeDevice(config, f'{_MAC[:6]}{device:06X}')
+               for device in range(args.devices)]
+    elapsed, published = min(asyncio.run(_aggregate(devices, args.rounds))
+                             for _ in range(args.repeat))
+    readings = args.rounds * args.devices
+    print(f'  {"/".join(functions):<16} {elapsed / readings * 1e6:>14.2f} {readings:>9} '
+          f'{published:>10}')
+  #: endfor functions
+#: enddef benchmark_aggregate ##################################################
+
+
+
+# ##############################################################################
+def main():
+  '''Runs the benchmark selected from the command line'''
+  arg_parser = argparse.ArgumentParser(
+      description = 'Micro-benchmarks for the BTHome v2 decoding pipeline.')
+  subparsers = arg_parser.add_subparsers(required = True, dest = 'benchmark')
+  parse_parser = subparsers.add_parser('parse',
+      help = 'payload parsing (packets/s), against the reference implementation.')
+  parse_parser.add_argument('-r', '--rounds', action = 'store',
+    default = 20000, type = int,
+    help = 'rounds over all recorded payloads. Defaults to 20000.',
+    dest = 'rounds')
+  parse_parser.add_argument('-n', '--repeat', action = 'store',
+    default = 5, type = int,
+    help = 'repetitions, the best one is reported. Defaults to 5.',
+    dest = 'repeat')
+  parse_parser.set_defaults(run = benchmark_parse)
+  decrypt_parser = subparsers.add_parser('decrypt',
+      help = 'payload decryption (packets/s), against the reference implementation.')
+  decrypt_parser.add_argument('-r', '--rounds', action = 'store',
+    default = 200, type = int,
+    help = 'rounds over all encrypted packets. Defaults to 200.',
+    dest = 'rounds')
+  decrypt_parser.add_argument('-n', '--repeat', action = 'store',
+    default = 5, type = int,
+    help = 'repetitions, the best one is reported. Defaults to 5.',
+    dest = 'repeat')
+  decrypt_parser.set_defaults(run = benchmark_decrypt)
+  log_parser = subparsers.add_parser('log',
+      help = 'CPU time per advertisement of the decoder callback, at INFO and DEBUG log levels.')
+  log_parser.add_argument('-r', '--rounds', action = 'store',
+    default = 2000, type = int,
+    help = 'rounds over all advertisements. Defaults to 2000.',
+    dest = 'rounds')
+  log_parser.add_argument('-n', '--repeat', action = 'store',
+    default = 5, type = int,
+    help = 'repetitions, the best one is reported. Defaults to 5.',
+    dest = 'repeat')
+  log_parser.set_defaults(run = benchmark_log)
+  replay_parser = subparsers.add_parser('replay',
+      help = 'whole pipeline (advertisements/s, latency, memory), replaying synthetic captures.')
+  replay_parser.add_argument('-a', '--advertisements', action = 'store',
+    default = 15000, type = int,
+    help = 'approx. number of advertisements per scenario. Defaults to 15000.',
+    dest = 'advertisements')
+  replay_parser.add_argument('-s', '--scenario', action = 'append',
+    default = [], choices = sorted({kind for kind, _ in _SCENARIOS}),
+    help = 'only run scenarios of this kind (may be repeated). Defaults to all of them.',
+    dest = 'scenario')
+  replay_parser.add_argument('-n', '--repeat', action = 'store',
+    default = 3, type = int,
+    help = 'repetitions, the best one is reported. Defaults to 3.',
+    dest = 'repeat')
+  replay_parser.set_defaults(run = benchmark_replay)
+  startup_parser = subparsers.add_parser('startup',
+      help = 'import time of bthome2mqtt (as python -X importtime), in fresh interpreters.')
+  startup_parser.add_argument('-t', '--top', action = 'store',
+    default = 10, type = int,
+    help = 'number of slowest modules reported. Defaults to 10.',
+    dest = 'top')
+  startup_parser.add_argument('-n', '--repeat', action = 'store',
+    default = 5, type = int,
+    help = 'repetitions, the best one is reported. Defaults to 5.',
+    dest = 'repeat')
+  startup_parser.set_defaults(run = benchmark_startup)
+  config_parser = subparsers.add_parser('config',
+      help = 'reading of a YAML configuration file, parsed or loaded from its cache.')
+  config_parser.add_argument('-d', '--devices', action = 'store',
+    default = 2000, type = int,
+    help = 'number of devices in the configuration file. Defaults to 2000.',
+    dest = 'devices')
+  config_parser.add_argument('-n', '--repeat', action = 'store',
+    default = 5, type = int,
+    help = 'repetitions, the best one is reported. Defaults to 5.',
+    dest = 'repeat')
+  config_parser.set_defaults(run = benchmark_config)
+  publish_parser = subparsers.add_parser('publish',
+      help = 'CPU time per message of JSON encoding and publishing, to a loopback connection.')
+  publish_parser.add_argument('-r', '--rounds', action = 'store',
+    default = 20000, type = int,
+    help = 'rounds (messages per scenario). Defaults to 20000.',
+    dest = 'rounds')
+  publish_parser.add_argument('-n', '--repeat', action = 'store',
+    default = 5, type = int,
+    help = 'repetitions, the best one is reported. Defaults to 5.',
+    dest = 'repeat')
+  publish_parser.set_defaults(run = benchmark_publish)
+  burst_parser = subparsers.add_parser('burst',
+      help = 'time to publish a burst of readings to a loopback broker with some round trip.')
+  burst_parser.add_argument('-d', '--devices', action = 'store',
+    default = 200, type = int,
+    help = 'number of readings (one per device) in the burst. Defaults to 200.',
+    dest = 'devices')
+  burst_parser.add_argument('-t', '--round-trip', action = 'store',
+    default = 0.01, type = float,
+    help = 'broker round trip time (in s). Defaults to 0.01.',
+    dest = 'round_trip')
+  burst_parser.add_argument('-n', '--repeat', action = 'store',
+    default = 3, type = int,
+    help = 'repetitions, the best one is reported. Defaults to 3.',
+    dest = 'repeat')
+  burst_parser.set_defaults(run = benchmark_burst)
+  aggregate_parser = subparsers.add_parser('aggregate',
+      help = 'CPU time per reading of the aggregation stage, and messages published.')
+  aggregate_parser.add_argument('-d', '--devices', action = 'store',
+    default = 300, type = int,
+    help = 'number of devices. Defaults to 300.',
+    dest = 'devices')
+  aggregate_parser.add_argument('-r', '--rounds', action = 'store',
+    default = 60, type = int,
+    help = 'readings of each device (in a window). Defaults to 60.',
+    dest = 'rounds')
+  aggregate_parser.add_argument('-n', '--repeat', action = 'store',
+    default = 5, type = int,
+    help = 'repetitions, the best one is reported. Defaults to 5.',
+    dest = 'repeat')
+  aggregate_parser.set_defaults(run = benchmark_aggregate)
+  args = arg_parser.parse_args()
+  args.run(args)
+#: enddef main #################################################################
+
+
+
+# ##############################################################################
+if __name__ == '__main__':
+  main()
+#: endif  ######################################################################
@@ -0,0 +1,593 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''Captures of BTHome v2 advertisements, and their offline replay thru the
+    decoder, without a BLE adapter nor MQTT brokers.'''
+
+
+
+# ##############################################################################
+import  argparse
+import  os
+import  struct
+import  asyncio
+import  contextvars
+import  threading
+import  queue
+import  logging as lg
+from    dataclasses import dataclass
+from    time import perf_counter, monotonic
+from    typing import BinaryIO, Callable, Iterable, Iterator
+# ..............................................................................
+from    bleak.backends.device import BLEDevice
+from    bleak.backends.scanner import AdvertisementData
+# ..............................................................................
+from    bthome_decoder import get_bthome_devices_from_yaml_file, create_bthome_decoder, \
+                              PayloadCache
+from    bthome_mqtt import BrokerPool, PublishQueue
+from    bthome_split import SplitState
+# ##############################################################################
+
+
+
+# some constants  ##############################################################
+# first bytes of a capture file (format version 1)
+CAPTURE_MAGIC = b'BTHCAP\x01\n'
+# full BTHome service data UUID
+BTHOME_SERVICE_UUID = '0000fcd2-0000-1000-8000-00805f9b34fb'
+# capture record: length (of the rest of the record), timestamp (s), RSSI (dBm),
+# MAC address, length of the adapter name; then the adapter name and the
+# service data (device info byte and payload)
+_RECORD = struct.Struct('<Hdb6sB')
+# BTHome service data UUID, as a 16 bit UUID
+_BTHOME_UUID = 'fcd2'
+# max. time (in s) recorded advertisements may wait to be flushed to disk
+_FLUSH_INTERVAL = 1.0
+# ##############################################################################
+
+
+
+# ##############################################################################
+@dataclass
+class CapturedAdvertisement:
+  '''BTHome service data received from a BLE device'''
+  timestamp: float          # monotonic time of reception (s)
+  mac: str                  # BLE device MAC address (12 hex digits, uppercase)
+  rssi: int                 # received signal strength (dBm)
+  data: bytes               # BTHome service data (device info byte and payload)
+  adapter: str = ''         # Bluetooth adapter (empty if system default)
+#: endclass CapturedAdvertisement ##############################################
+
+
+
+# ##############################################################################
+def pack_advertisement(advertisement: CapturedAdvertisement) -> bytes:
+  '''Returns the capture record of an advertisement'''
+  adapter = advertisement.adapter.encode()
+  length = _RECORD.size - 2 + len(adapter) + len(advertisement.data)
+  return (_RECORD.pack(length, advertisement.timestamp, advertisement.rssi,
+                       bytes.fromhex(advertisement.mac), len(adapter))
+          + adapter + advertisement.data)
+#: enddef pack_advertisement ###################################################
+
+
+
+# ##############################################################################
+def write_capture(file_name: str, advertisements: Iterable[CapturedAdvertisement]):
+  '''Writes advertisements to a (new) capture file'''
+  with open(file_name, 'wb') as capture:
+    capture.write(CAPTURE_MAGIC)
+    for advertisement in advertisements:
+      capture.write(pack_advertisement(advertisement))
+    #: endfor advertisement
+  #: endwith capture
+#: enddef write_capture ########################################################
+
+
+
+# ##############################################################################
+def read_capture(file_name: str) -> Iterator[CapturedAdvertisement]:
+  '''Reads the advertisements of a capture file. A truncated last record (the
+      capture was not properly closed) is ignored. Raises ValueError if not a
+      capture file.'''
+  with open(file_name, 'rb') as capture:
+    if capture.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+      raise ValueError(f'"{file_name}" is not a BTHome capture file')
+    #: endif
+    yield from _read_records(capture)
+  #: endwith capture
+#: enddef read_capture #########################################################
+
+
+
+# ##############################################################################
+def _read_records(capture: BinaryIO) -> Iterator[CapturedAdvertisement]:
+  '''Reads capture records up to the end of a file'''
+  header_size = _RECORD.size
+  while True:
+    header = capture.read(header_size)
+    if len(header) < header_size:
+      return
+    #: endif
+    length, timestamp, rssi, mac, adapter_length = _RECORD.unpack(header)
+    rest = capture.read(length - header_size + 2)
+    if len(rest) < length - header_size + 2:
+      return
+    #: endif
+    yield CapturedAdvertisement(timestamp, mac.hex().upper(), rssi, rest[adapter_length:],
+                                rest[:adapter_length].decode(errors='replace'))
+  #: endwhile
+#: enddef _read_records ########################################################
+
+
+
+# ##############################################################################
+class CaptureWriter:
+  '''Records advertisements to a capture file, from a background thread, so
+      that recording never blocks the event loop: record() only queues the
+      advertisement (dropping it, and counting it, if too many are pending).
+      The thread writes them in batches, flushing to disk at least every
+      second, and rotates the capture file (as logging.RotatingFileHandler
+      does) when it grows over max_bytes.'''
+
+
+  # ****************************************************************************
+  def __init__(self, file_name: str, max_bytes: int = 10000000, backup_count: int = 5,
+               adapter: str = '', maxsize: int = 10000):
+    self.file_name = file_name
+    self.adapter = adapter      # recorded adapter, unless told otherwise
+    self._max_bytes = max_bytes
+    self._backup_count = backup_count
+    self._queue: queue.Queue = queue.Queue(maxsize)
+    self._thread: threading.Thread | None = None
+    self._capture: BinaryIO | None = None
+    self._size = 0
+    # counters
+    self.recorded = 0
+    self.dropped = 0
+    self.rotations = 0
+  #: enddef __init__ ///////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  def start(self):
+    '''Opens the capture file (appending to it, if already a capture file) and
+        launches the writer thread. Raises OSError if it cannot be opened.'''
+    self._open()
+    self._thread = threading.Thread(target=self._run, name='capture', daemon=True)
+    self._thread.start()
+  #: enddef start //////////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  def record(self, ble_device, advertisement_data, adapter: str | None = None):
+    '''Queues the BTHome service data of an advertisement (as received from
+        bleak) for recording. Never blocks.'''
+    timestamp = monotonic()
+    for uuid, data in advertisement_data.service_data.items():
+      if uuid[4:8].lower() != _BTHOME_UUID:
+        continue
+      #: endif
+      try:
+        self._queue.put_nowait((timestamp, ble_device.address, advertisement_data.rssi, data,
+                                self.adapter if adapter is None else adapter))
+      except queue.Full:
+        self.dropped += 1
+      #: endtry
+    #: endfor uuid, data
+  #: enddef record /////////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  def stats(self) -> dict[str, int]:
+    '''Returns the recording counters'''
+    return {'queued': self._queue.qsize(), 'recorded': self.recorded,
+            'dropped': self.dropped, 'rotations': self.rotations}
+  #: enddef stats //////////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  def close(self):
+    '''Writes all pending advertisements, then closes the capture file'''
+    if self._thread is not None:
+      self._queue.put(None)
+      self._thread.join()
+      self._thread = None
+    #: endif
+  #: enddef close //////////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  def _open(self):
+    '''Opens the capture file, rotating it away if not a capture file'''
+    try:
+      with open(self.file_name, 'rb') as capture:
+        magic = capture.read(len(CAPTURE_MAGIC))
+      #: endwith capture
+    except FileNotFoundError:
+      magic = b''
+    #: endtry
+    if magic and magic != CAPTURE_MAGIC:
+      self._rotate()
+    #: endif
+    self._capture = open(self.file_name, 'ab', buffering=65536)
+    self._size = self._capture.tell()
+    if not self._size:
+      self._capture.write(CAPTURE_MAGIC)
+      self._size = len(CAPTURE_MAGIC)
+    #: endif
+  #: enddef _open //////////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  def _rotate(self):
+    '''Renames the capture file to <file>.1 (and <file>.1 to <file>.2...)'''
+    if self._capture is not None:
+      self._capture.close()
+      self._capture = None
+    #: endif
+    if self._backup_count > 0:
+      for i in range(self._backup_count - 1, 0, -1):
+        if os.path.exists(f'{self.file_name}.{i}'):
+          os.replace(f'{self.file_name}.{i}', f'{self.file_name}.{i + 1}')
+        #: endif
+      #: endfor i
+      os.replace(self.file_name, f'{self.file_name}.1')
+    else:
+      os.remove(self.file_name)
+    #: endif
+    self.rotations += 1
+  #: enddef _rotate ////////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  def _run(self):
+    '''Writer thread'''
+    stopping = False
+    while not stopping:
+      # wait for a first advertisement, then take all the pending ones
+      try:
+        items = [self._queue.get(timeout=_FLUSH_INTERVAL)]
+      except queue.Empty:
+        continue
+      #: endtry
+      deadline = monotonic() + _FLUSH_INTERVAL
+      while items[-1] is not None and len(items) < 1000 and monotonic() < deadline:
+        try:
+          items.append(self._queue.get(timeout=max(0.0, deadline - monotonic())))
+        except queue.Empty:
+          break
+        #: endtry
+      #: endwhile
+      if items[-1] is None:
+        items.pop()
+        stopping = True
+      #: endif
+      try:
+        self._write(items)
+      except (OSError, ValueError) as e:
+        self.dropped += len(items)
+        lg.error('Cannot record to "%s". %s.', self.file_name, e)
+      #: endtry
+    #: endwhile
+    if self._capture is not None:
+      self._capture.close()
+      self._capture = None
+    #: endif
+  #: enddef _run ///////////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  def _write(self, items: list[tuple]):
+    '''Writes a batch of advertisements and flushes them to disk'''
+    if self._capture is None:
+      self._open()
+    #: endif
+    for timestamp, address, rssi, data, adapter in items:
+      mac = address.replace(':', '')
+      try:
+        if len(mac) != 12:
+          raise ValueError(f'"{address}" is not a MAC address')   # e.g. a UUID, on macOS
+        #: endif
+        record = pack_advertisement(CapturedAdvertisement(
+            timestamp, mac, max(-128, min(127, int(rssi))), data, adapter))
+      except (ValueError, struct.error) as e:
+        self.dropped += 1   # only this advertisement, not the batch
+        lg.debug('Cannot record advertisement. %s.', e)
+        continue
+      #: endtry
+      if self._size + len(record) > self._max_bytes and self._size > len(CAPTURE_MAGIC):
+        self._rotate()
+        self._open()
+      #: endif
+      assert self._capture is not None
+      self._capture.write(record)
+      self._size += len(record)
+      self.recorded += 1
+    #: endfor timestamp, address, rssi, data, adapter
+    assert self._capture is not None
+    self._capture.flush()
+  #: enddef _write /////////////////////////////////////////////////////////////
+
+
+#: endclass CaptureWriter ######################################################
+
+
+
+# ##############################################################################
+def to_bleak(advertisement: CapturedAdvertisement) -> tuple[BLEDevice, AdvertisementData]:
+  '''Returns the arguments bleak would pass to the decoder callback for an
+      advertisement'''
+  mac = advertisement.mac
+  address = ':'.join(mac[i:i + 2] for i in range(0, 12, 2))
+  return (BLEDevice(address, None, {'adapter': advertisement.adapter}),
+          AdvertisementData(None, {}, {BTHOME_SERVICE_UUID: advertisement.data}, [],
+                            None, advertisement.rssi, ()))
+#: enddef to_bleak #############################################################
+
+
+
+# ##############################################################################
+class LoopbackConnection:
+  '''In-process stand-in for bthome_mqtt.BrokerConnection: publishments are
+      only counted (and handed over to on_publish, if any), after an optional
+      delay simulating the broker round trip.'''
+
+
+  # ****************************************************************************
+  def __init__(self, name: str, delay: float = 0.0, on_publish: Callable | None = None):
+    self.name = name
+    self.connected = True
+    self.outbox = None
+    self.split: SplitState | None = None
+    self.published = 0
+    self._delay = delay
+    self._on_publish = on_publish
+  #: enddef __init__ ///////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  async def publish(self, topic: str, payload: str | bytes, timeout: float = 0.0,
+                    qos: int = 0, retain: bool = False):
+    '''Publishes a payload to a topic (see BrokerConnection.publish)'''
+    if self._delay:
+      await asyncio.sleep(self._delay)
+    #: endif
+    self.published += 1
+    if self._on_publish is not None:
+      self._on_publish(topic, payload)
+    #: endif
+  #: enddef publish ////////////////////////////////////////////////////////////
+
+
+#: endclass LoopbackConnection #################################################
+
+
+
+# ##############################################################################
+class LoopbackBrokerPool(BrokerPool):
+  '''In-process stand-in for bthome_mqtt.BrokerPool, holding loopback
+      connections'''
+
+
+  # ****************************************************************************
+  def __init__(self, delay: float = 0.0, on_publish: Callable | None = None):
+    super().__init__()
+    self._delay = delay
+    self._on_publish = on_publish
+  #: enddef __init__ ///////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  def get(self, broker) -> LoopbackConnection:   # type: ignore[override]
+    '''Returns the connection to a broker, creating it if needed'''
+    key = (broker.hostname, broker.port)
+    connection = self._connections.get(key)
+    if connection is None:
+      connection = LoopbackConnection(f'{broker.hostname}:{broker.port}', self._delay,
+                                      self._on_publish)
+      self._connections[key] = connection   # type: ignore[assignment]
+    #: endif
+    if broker.split and connection.split is None:
+      connection.split = SplitState(self._deadband, self._discovery_prefix)
+    #: endif
+    return connection   # type: ignore[return-value]
+  #: enddef get ////////////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  async def close(self):
+    '''Forgets all connections'''
+    self._connections.clear()
+  #: enddef close //////////////////////////////////////////////////////////////
+
+
+#: endclass LoopbackBrokerPool #################################################
+
+
+
+# ##############################################################################
+class LatencyProbe:
+  '''Measures the end-to-end latency of the pipeline, from the reception of an
+      advertisement (see replay) to the publishment of its measurements: sits
+      between the decoder and the publish queue, and its on_publish method
+      must be called by the (loopback) connections. Superseded (coalesced) and
+      dropped measurements are not measured.'''
+  # reception time of the advertisement being decoded, as each decoder callback
+  # runs in its own task (and so, context)
+  arrival: contextvars.ContextVar[float] = contextvars.ContextVar('arrival')
+
+
+  # ****************************************************************************
+  def __init__(self):
+    self.publish_queue: PublishQueue | None = None
+    self.latencies: list[float] = []
+    # reception time of queued payloads, indexed by their id()
+    self._pending: dict[int, tuple[bytes, float]] = {}
+  #: enddef __init__ ///////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  def submit(self, device, measurements: dict, mqtt_payload: bytes, coalescible: bool = True):
+    '''See PublishQueue.submit'''
+    # the payload is kept (not only its id) so that ids are not reused
+    self._pending[id(mqtt_payload)] = (mqtt_payload, self.arrival.get(perf_counter()))
+    assert self.publish_queue is not None
+    self.publish_queue.submit(device, measurements, mqtt_payload, coalescible)
+  #: enddef submit /////////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  def on_publish(self, topic: str, payload: bytes):
+    '''Records the latency of the first publishment of a payload'''
+    pending = self._pending.pop(id(payload), None)
+    if pending is not None:
+      self.latencies.append(perf_counter() - pending[1])
+    #: endif
+  #: enddef on_publish /////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  def percentile(self, percent: float) -> float:
+    '''Returns a percentile of the measured latencies (s), 0 if none'''
+    if not self.latencies:
+      return 0.0
+    #: endif
+    latencies = sorted(self.latencies)
+    return latencies[min(len(latencies) - 1, int(len(latencies) * percent / 100))]
+  #: enddef percentile /////////////////////////////////////////////////////////
+
+
+#: endclass LatencyProbe #######################################################
+
+
+
+# ##############################################################################
+async def replay(advertisements: list[tuple[float, BLEDevice, AdvertisementData]], decoder,
+                 speed: float | None = None) -> float:
+  '''Feeds advertisements (reception timestamp and decoder callback arguments,
+      see to_bleak) to a decoder callback, running each one in its own task,
+      as bleak does. At max speed (speed None) the next advertisement is fed as
+      soon as the previous one is processed or waiting, otherwise at their
+      original pace (sped up by speed). Returns the time taken (s), once all
+      callbacks are done.'''
+  tasks: set[asyncio.Task] = set()
+  first = advertisements[0][0] if advertisements else 0.0
+  start = perf_counter()
+  for timestamp, ble_device, advertisement_data in advertisements:
+    if speed is not None:
+      delay = (timestamp - first) / speed - (perf_counter() - start)
+      if delay > 0:
+        await asyncio.sleep(delay)
+      #: endif
+    #: endif
+    LatencyProbe.arrival.set(perf_counter())
+    task = asyncio.create_task(decoder(ble_device, advertisement_data))
+    tasks.add(task)
+    task.add_done_callback(tasks.discard)
+    if speed is None:
+      await asyncio.sleep(0)  # let the callback run
+    #: endif
+  #: endfor timestamp, ble_device, advertisement_data
+  if tasks:
+    await asyncio.gather(*tasks)
+  #: endif
+  return perf_counter() - start
+#: enddef replay ###############################################################
+
+
+
+# ##############################################################################
+async def _replay_capture(args: argparse.Namespace):
+  '''Replays a capture file thru the devices of a YAML configuration file'''
+  bthome_devices = get_bthome_devices_from_yaml_file(args.config_file_name)
+  if bthome_devices is None:
+    return
+  #: endif
+  advertisements = [(advertisement.timestamp, *to_bleak(advertisement))
+                    for advertisement in read_capture(args.capture_file_name)]
+  probe = LatencyProbe()
+  broker_pool = (BrokerPool() if args.brokers
+                 else LoopbackBrokerPool(args.delay, probe.on_publish))
+  async with broker_pool, PublishQueue(broker_pool) as publish_queue:
+    probe.publish_queue = publish_queue
+    decoder = create_bthome_decoder(bthome_devices, lg.DEBUG, probe,   # type: ignore[arg-type]
+                                    PayloadCache())
+    start = perf_counter()
+    elapsed = await replay(advertisements, decoder, None if args.max_speed else args.speed)
+    await publish_queue.join()
+    total = perf_counter() - start
+    published = sum(getattr(connection, 'published', 0)
+                    for connection in broker_pool.connections())
+  #: endwith broker_pool, publish_queue
+  print(f'{len(advertisements)} advertisements replayed in {elapsed:.3f} s '
+        f'({len(advertisements) / max(elapsed, 1e-9):,.0f} advertisements/s).')
+  if not args.brokers:
+    print(f'{published} publishments, all published in {total:.3f} s; latency: '
+          f'p50 {probe.percentile(50) * 1000:.3f} ms, p99 {probe.percentile(99) * 1000:.3f} ms.')
+  #: endif
+#: enddef _replay_capture ######################################################
+
+
+
+# ##############################################################################
+def _dump_capture(args: argparse.Namespace):
+  '''Prints the advertisements of a capture file'''
+  first = None
+  for advertisement in read_capture(args.capture_file_name):
+    first = advertisement.timestamp if first is None else first
+    print(f'{advertisement.timestamp - first:12.6f} {advertisement.mac} '
+          f'{advertisement.rssi:4d} dBm {advertisement.adapter or "-":<6} '
+          f'{advertisement.data.hex()}')
+  #: endfor advertisement
+#: enddef _dump_capture ########################################################
+
+
+
+# ##############################################################################
+def main():
+  '''Runs the command selected from the command line'''
+  arg_parser = argparse.ArgumentParser(
+      description = 'Inspect and replay captures of BTHome v2 advertisements.')
+  subparsers = arg_parser.add_subparsers(required = True, dest = 'command')
+  dump_parser = subparsers.add_parser('dump',
+      help = 'print the advertisements of a capture file.')
+  dump_parser.add_argument('capture_file_name', help = 'capture file.')
+  dump_parser.set_defaults(run = _dump_capture)
+  replay_parser = subparsers.add_parser('replay',
+      help = 'replay a capture file thru the decoder, publishing to an in-process loopback '\
+             'MQTT stand-in (or to the configured brokers).')
+  replay_parser.add_argument('capture_file_name', help = 'capture file.')
+  replay_parser.add_argument('-c', '--config-file', action = 'store',
+    default = 'bthome_devices.yaml',
+    help = 'file describing the BTHome devices. Defaults to "bthome_devices.yaml".',
+    dest = 'config_file_name')
+  replay_parser.add_argument('--speed', action = 'store',
+    default = 1.0, type = float,
+    help = 'replay speed, relative to the original pace. Defaults to 1 (real time).',
+    dest = 'speed')
+  replay_parser.add_argument('--max-speed', action = 'store_true',
+    help = 'replay as fast as possible.',
+    dest = 'max_speed')
+  replay_parser.add_argument('--delay', action = 'store',
+    default = 0.0, type = float,
+    help = 'simulated loopback broker round trip (in s). Defaults to 0.',
+    dest = 'delay')
+  replay_parser.add_argument('--brokers', action = 'store_true',
+    help = 'publish to the configured MQTT brokers, instead of to the loopback stand-in.',
+    dest = 'brokers')
+  replay_parser.set_defaults(run = lambda args: asyncio.run(_replay_capture(args)))
+  args = arg_parser.parse_args()
+  if args.command == 'replay' and args.speed <= 0:
+    arg_parser.error(f'invalid speed {args.speed}')
+  #: endif
+  lg.basicConfig(format = '%(levelname)s: %(message)s', level = lg.WARNING)
+  args.run(args)
+#: enddef main #################################################################
+
+
+
+# ##############################################################################
+if __name__ == '__main__':
+  main()
+#: endif  ######################################################################
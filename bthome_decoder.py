@@ -6,20 +6,33 @@
 
 
 # ##############################################################################
+import  os
 import  re
-from    dataclasses import dataclass, field
+import  struct
+import  marshal
+import  hashlib
+import  hmac
+import  functools
+from    dataclasses import dataclass, replace
 import  logging as lg
-from    time import time
-from    copy import deepcopy
-import  ssl
+from    time import time, perf_counter
 import  asyncio
 import  json
+from    collections import OrderedDict
+from    concurrent.futures import ThreadPoolExecutor
+from    typing import TYPE_CHECKING, Callable, Iterable
 # ..............................................................................
 import  yaml                                # pyyaml + types-PyYAML
-from    Cryptodome.Cipher import AES        # pycryptodome[x]
-import  aiomqtt                             # aiomqtt
 # ..............................................................................
 from    bthome_constants import SENSOR
+from    bthome_mqtt import AIOMQTT_TIMEOUT, BrokerPool, PublishQueue
+from    bthome_log import HOT_LOG
+from    bthome_metrics import METRICS
+if TYPE_CHECKING:
+  from    bthome_state import StateStore  # imports this module
+  from    bthome_outbox import Outbox
+  from    bthome_aggregate import Aggregator  # imports this module
+#: endif
 # ##############################################################################
 
 
@@ -27,21 +40,174 @@ from    bthome_constants import SENSOR
 # some constants  ##############################################################
 # matches the BLE BTHome data UUID
 _BTHOME_UUID = 'fcd2'
-# timeouts
-_AIOMQTT_TIMEOUT = 10  # s
-try:
-  import  certifi                           # certifi needed on MSYS2
-  _CAFILE: str | None = certifi.where()
-except ImportError:
-  _CAFILE = None
-#: endtry
+# YAML loader, based on libyaml if available (much faster)
+_YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+# format version of configuration cache files
+_CONFIG_CACHE_VERSION = 6
 # matches one or more slashes
 _SLASHES_RE = re.compile('/+')
+# JSON encoders of measurements (see use_json_encoder)
+JSON_ENCODERS = ('json', 'fast')
+# functions aggregating numeric properties over a window (see bthome_aggregate)
+AGGREGATE_FUNCTIONS = ('mean', 'min', 'max', 'last')
+# escapes strings as JSON, as json.dumps does
+_encode_string = json.encoder.encode_basestring_ascii
+# JSON encoding of special float values, as json.dumps does
+_FLOAT_SPECIALS = {'nan': 'NaN', 'inf': 'Infinity', '-inf': '-Infinity'}
+# properties of event sensors (button, dimmer)
+_EVENT_PROPERTIES = frozenset(sensor.property for sensor in SENSOR.values() if sensor.events)
+# kinds of BTHome objects, as decoded by BTHomeDevice.parse
+_NUMBER, _PACKET_ID, _BINARY, _FIRMWARE, _EVENT, _TEXT, _RAW = range(7)
+# struct formats for little endian integers, indexed by (bytes, signed), 3 byte
+# integers are unpacked as a 2 byte low part and a 1 byte high part
+_INT_FORMAT = {
+  (1, False): '<B', (2, False): '<H', (3, False): '<HB', (4, False): '<I',
+  (1, True):  '<b', (2, True):  '<h', (3, True):  '<Hb', (4, True):  '<i'
+}
 # ##############################################################################
 
 
 
-@dataclass  # ##################################################################
+# ##############################################################################
+def _build_decode_table() -> list[tuple | None]:
+  '''Precompiles SENSOR into a table, indexed by object id, of tuples (kind,
+      bit, property, bytes, unpack, factor, unit, events), where bit is the
+      object id as a bit mask and unpack is the unpack_from method of a
+      struct.Struct (None for variable length and event objects). Unknown
+      object ids are None.'''
+  table: list[tuple | None] = [None] * 256
+  for object_id, sensor in SENSOR.items():
+    if sensor.events:
+      kind = _EVENT
+    elif sensor.bytes == 0:
+      kind = _TEXT if object_id == 0x53 else _RAW
+    elif object_id == 0x00:
+      kind = _PACKET_ID
+    elif sensor.binary:
+      kind = _BINARY
+    elif 0xF1 <= object_id <= 0xF2:
+      kind = _FIRMWARE
+    else:
+      kind = _NUMBER
+    #: endif
+    unpack = None
+    if sensor.bytes and not sensor.events:
+      unpack = struct.Struct(_INT_FORMAT[(sensor.bytes, sensor.signed)]).unpack_from
+    #: endif
+    table[object_id] = (kind, 1 << object_id, sensor.property, sensor.bytes, unpack,
+                        sensor.factor, sensor.unit, sensor.events)
+  #: endfor object_id, sensor
+  return table
+#: enddef _build_decode_table ##################################################
+# decoding table for BTHome objects
+_DECODE_TABLE = _build_decode_table()
+
+
+
+# ##############################################################################
+class PayloadCache:
+  '''LRU cache, bounded both in entries and in bytes, mapping payloads (minus
+      their packet id) to their measurements and JSON encoding, so that
+      repeated payloads are neither parsed nor encoded again.'''
+
+
+  # ****************************************************************************
+  def __init__(self, max_entries: int = 1024, max_bytes: int = 262144):
+    self._max_entries = max_entries
+    self._max_bytes = max_bytes
+    self._entries: OrderedDict[bytes, tuple[dict, bytes]] = OrderedDict()
+    self._bytes = 0   # size of keys and JSON encodings
+    # counters
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+  #: enddef __init__ ///////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  def get(self, key: bytes) -> tuple[dict, bytes] | None:
+    '''Returns the (measurements, JSON encoding) cached for a key, if any. The
+        measurements must not be modified.'''
+    entry = self._entries.get(key)
+    if entry is None:
+      self.misses += 1
+    else:
+      self.hits += 1
+      self._entries.move_to_end(key)
+    #: endif
+    return entry
+  #: enddef get ////////////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  def put(self, key: bytes, measurements: dict, encoded: bytes):
+    '''Caches measurements and their JSON encoding, evicting the least recently
+        used entries to stay within bounds'''
+    size = len(key) + len(encoded)
+    if size > self._max_bytes:
+      return    # would not fit, even alone
+    #: endif
+    self._entries[key] = (measurements, encoded)
+    self._bytes += size
+    while len(self._entries) > self._max_entries or self._bytes > self._max_bytes:
+      old_key, (_, old_encoded) = self._entries.popitem(last=False)
+      self._bytes -= len(old_key) + len(old_encoded)
+      self.evictions += 1
+    #: endwhile
+  #: enddef put ////////////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  def stats(self) -> dict[str, int]:
+    '''Returns the cache size and counters'''
+    return {'entries': len(self._entries), 'bytes': self._bytes, 'hits': self.hits,
+            'misses': self.misses, 'evictions': self.evictions}
+  #: enddef stats //////////////////////////////////////////////////////////////
+
+
+#: endclass PayloadCache #######################################################
+
+
+
+# ##############################################################################
+@functools.lru_cache(maxsize=1024)
+def _aes_ecb(key: bytes):
+  '''Returns an AES-ECB cipher (with its key already expanded) for a key,
+      shared by all devices using it. ECB is stateless, so the same cipher
+      serves every packet. pycryptodome is only imported if some device has a
+      key.'''
+  from    Cryptodome.Cipher import AES      # pycryptodome[x]
+  return AES.new(key, AES.MODE_ECB)
+#: enddef _aes_ecb #############################################################
+
+
+
+# ##############################################################################
+def _ccm_decrypt(ecb, nonce: bytes, ciphertext: bytes, mic: bytes) -> bytes | None:
+  '''AES-CCM decryption (RFC 3610), as used by BTHome v2: 13 byte nonce, 4 byte
+      MIC and no associated data, on top of a reusable AES-ECB cipher. Returns
+      the payload, or None if the MIC does not match.'''
+  n_bytes = len(ciphertext)
+  n_blocks = (n_bytes + 15) // 16
+  # key stream S_0 .. S_n: counter blocks A_i (flags = L - 1 = 1) encrypted at once
+  stream = ecb.encrypt(b''.join(b'\x01' + nonce + i.to_bytes(2, 'big')
+                                for i in range(n_blocks + 1)))
+  payload = (int.from_bytes(ciphertext, 'big')
+             ^ int.from_bytes(stream[16:16 + n_bytes], 'big')).to_bytes(n_bytes, 'big')
+  # CBC-MAC of B_0 (flags = 8 * (M - 2) / 2 + L - 1 = 9) and the zero padded payload
+  x = ecb.encrypt(b'\x09' + nonce + n_bytes.to_bytes(2, 'big'))
+  padded = payload + bytes(16 * n_blocks - n_bytes)
+  for i in range(0, 16 * n_blocks, 16):
+    x = ecb.encrypt((int.from_bytes(x, 'big')
+                     ^ int.from_bytes(padded[i:i + 16], 'big')).to_bytes(16, 'big'))
+  #: endfor i
+  tag = (int.from_bytes(x[:4], 'big') ^ int.from_bytes(stream[:4], 'big')).to_bytes(4, 'big')
+  return payload if hmac.compare_digest(tag, mic) else None
+#: enddef _ccm_decrypt #########################################################
+
+
+
+@dataclass(frozen=True, slots=True)  # #########################################
 class Broker:
   '''Class describing an MQTT broker where to publish to'''
   hostname: str = '127.0.0.1'
@@ -50,71 +216,229 @@ class Broker:
   password: str = ''
   encrypt: bool = True
   insecure: bool = False  # true to accept invalid certificates
-  topics: list[str] = field(default_factory=lambda: ([]))
+  qos: int = 0            # MQTT QoS level of publishments (0, 1 or 2)
+  retain: bool = False    # true to publish retained messages
+  outbox: bool = False    # true to store undelivered messages, to be replayed
+  split: bool = False     # true to publish each property to its own subtopic
+  discovery: bool = False # true to publish Home Assistant discovery (split mode)
+  topics: tuple[str, ...] = ()
 # endclass Broker ##############################################################
 
 
 
-@dataclass  # ##################################################################
-class BTHomeDevice:
-  '''Class describing a BTHome v2 device'''
+@dataclass(frozen=True, slots=True)  # #########################################
+class DeviceConfig:
+  '''Class describing the configuration of a BTHome v2 device. Immutable, so
+      it is shared (never copied), e.g. by all devices added in promiscuous
+      mode.'''
   mac: str = ''             # BLE device MAC address
   key: bytes = b''          # decryption key
   deduplicate: bool = True  # accept (False) or not duplicated packets
   # brokers where to publish measurements
-  brokers: list[Broker] = field(default_factory=lambda: ([]))
-  counter: int = -1         # AES decryption counter
-  ciphertext: bytes = b''   # last valid ciphertext
-  payload: bytes = b''      # last valid payload
-  packet_id: int = -1       # last packet ID
-  timestamp: float = 0.0    # timestamp of last valid payload
-  promiscuous: bool = False # device added in promiscuous mode (True)
+  brokers: tuple[Broker, ...] = ()
+  promiscuous: bool = False # devices added in promiscuous mode (True)
+  window: float = 0.0       # length (in s) of aggregation windows, 0 if none
+  # aggregate functions, indexed by property ('*' for the rest), when aggregated
+  aggregates: tuple[tuple[str, tuple[str, ...]], ...] = (('*', ('mean', )), )
 
 
   # ****************************************************************************
-  def decrypt(self, ciphertext: bytes) -> bool:
-    '''Decrypts a BTHome v2 encrypted payload. Returns True on success'''
-    lg.debug('%s', f'Decrypting ciphertext "{ciphertext!r}" for device "{self.mac}".')
-    if len(ciphertext) <= 9:
-      lg.warning('%s', f'Ciphertext "{ciphertext!r}" for device "{self.mac}" too short.')
-      return False
+  def __post_init__(self):
+    '''Precomputes the (shared) key-expanded AES cipher'''
+    if self.key:
+      _aes_ecb(self.key)
     #: endif
-    if self.key == b'':
-      lg.warning('%s', f'Decryption key not specified for device {self.mac}.')
-      return False
+  #: enddef __post_init__ //////////////////////////////////////////////////////
+
+
+#: endclass DeviceConfig #######################################################
+
+
+
+# ##############################################################################
+class BTHomeDevice:
+  '''Class describing a BTHome v2 device being listened to: its (shared)
+      configuration and its runtime state. Former ciphertexts and payloads
+      are only kept as hashes, enough to tell duplicates.'''
+  __slots__ = ('config', 'mac', 'label', 'nonce_prefix', 'topics', 'counter',
+               'ciphertext_hash', 'payload_hash', 'packet_id', 'timestamp')
+
+
+  # ****************************************************************************
+  def __init__(self, config: DeviceConfig, mac: str | None = None):
+    '''The MAC address defaults to the configured one'''
+    self.mac: str = config.mac if mac is None else mac  # BLE device MAC address
+    self.counter = -1                         # AES decryption counter
+    self.ciphertext_hash: int | None = None   # hash of last valid ciphertext
+    self.payload_hash: int | None = None      # hash of last unencrypted payload
+    self.packet_id = -1                       # last packet ID
+    self.timestamp = 0.0                      # timestamp of last valid payload
+    self.configure(config)
+  #: enddef __init__ ///////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  def configure(self, config: DeviceConfig):
+    '''Sets the configuration of the device (e.g. on a configuration reload),
+        keeping its runtime state, but the decryption state if the key
+        changes'''
+    if getattr(self, 'config', config).key != config.key:
+      self.counter = -1
+      self.ciphertext_hash = None
     #: endif
-    if self.deduplicate and self.ciphertext == ciphertext:
-      lg.debug('%s', f'Skipping duplicated ciphertext for device {self.mac}.')
+    self.config = config
+    # device label of metrics: devices added in promiscuous mode come and go
+    # (see DeviceRegistry), so they share one, to keep metrics bounded
+    self.label = 'promiscuous' if config.promiscuous else self.mac
+    # binary MAC address and BTHome UUID, prefix of all decryption nonces
+    try:
+      self.nonce_prefix = bytes.fromhex(self.mac) + b'\xd2\xfc' if config.key else b''
+    except ValueError:
+      self.nonce_prefix = b''   # not a MAC address
+    #: endtry
+    # topics where to publish, for each broker, resolved once: those of the
+    # brokers (None), but in promiscuous mode, where they end in the MAC address
+    self.topics = (tuple(tuple(_SLASHES_RE.sub('/', f'{topic}/{self.mac}')
+                               for topic in broker.topics)
+                         for broker in config.brokers)
+                   if config.promiscuous else None)
+  #: enddef configure //////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  @property
+  def brokers(self) -> tuple[Broker, ...]:
+    '''Brokers where to publish measurements'''
+    return self.config.brokers
+  #: enddef brokers ////////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  def topics_of(self, broker: Broker) -> tuple[str, ...]:
+    '''Topics where to publish measurements to one of the brokers'''
+    if self.topics is None:
+      return broker.topics
+    #: endif
+    for configured, topics in zip(self.config.brokers, self.topics):
+      if configured is broker:
+        return topics
+      #: endif
+    #: endfor configured, topics
+    # broker no longer configured (the configuration was reloaded)
+    return tuple(_SLASHES_RE.sub('/', f'{topic}/{self.mac}') for topic in broker.topics)
+  #: enddef topics_of //////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  def check_payload(self, payload: bytes) -> bool:
+    '''Checks an unencrypted payload against the device state (duplicated
+        payloads). Returns False if it must be rejected.'''
+    payload_hash = hash(payload)
+    if self.config.deduplicate and payload_hash == self.payload_hash:
+      if METRICS.enabled:
+        METRICS.skipped.inc('duplicate', self.label)
+      #: endif
       return False
     #: endif
-    new_counter_b = ciphertext[-8:-4]
-    new_counter = int.from_bytes(new_counter_b, byteorder='little', signed=False)
+    self.payload_hash = payload_hash
+    return True
+  #: enddef check_payload //////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  def decrypt(self, ciphertext: bytes) -> bytes | None:
+    '''Decrypts a BTHome v2 encrypted payload. Returns the payload, or None on
+        failure'''
+    if HOT_LOG.debug:
+      lg.debug('Decrypting ciphertext "%r" for device "%s".', ciphertext, self.mac)
+    #: endif
+    new_counter = self.check_ciphertext(ciphertext)
+    if new_counter is None:
+      return None
+    #: endif
+    return self.accept_payload(ciphertext, new_counter,
+                               _ccm_decrypt(*self.decryption_job(ciphertext)))
+  #: enddef decrypt ////////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  def check_ciphertext(self, ciphertext: bytes) -> int | None:
+    '''First step of decryption: checks an encrypted payload against the device
+        state (duplicated ciphertexts, replay attacks). Returns its counter, or
+        None if it must be rejected.'''
+    if len(ciphertext) <= 9:
+      lg.warning('Ciphertext "%r" for device "%s" too short.', ciphertext, self.mac)
+      if METRICS.enabled:
+        METRICS.skipped.inc('too_short', self.label)
+      #: endif
+      return None
+    #: endif
+    config = self.config
+    if config.key == b'':
+      lg.warning('Decryption key not specified for device %s.', self.mac)
+      if METRICS.enabled:
+        METRICS.skipped.inc('no_key', self.label)
+      #: endif
+      return None
+    #: endif
+    if config.deduplicate and hash(ciphertext) == self.ciphertext_hash:
+      if HOT_LOG.debug:
+        lg.debug('Skipping duplicated ciphertext for device %s.', self.mac)
+      #: endif
+      if METRICS.enabled:
+        METRICS.skipped.inc('duplicate', self.label)
+      #: endif
+      return None
+    #: endif
+    new_counter = int.from_bytes(ciphertext[-8:-4], byteorder='little', signed=False)
     # protect against replay attacks
     if ((0x100 <= new_counter < self.counter)
-        and (self.ciphertext != b'')):
-      lg.warning('%s', f'Encrypted packet rejected for device "{self.mac}" (decreasing counter).')
-      return False
+        and (self.ciphertext_hash is not None)):
+      lg.warning('Encrypted packet rejected for device "%s" (decreasing counter).', self.mac)
+      if METRICS.enabled:
+        METRICS.skipped.inc('replayed', self.label)
+      #: endif
+      return None
     #: endif
-    nonce = bytes.fromhex(self.mac) + b'\xd2\xfc' + ciphertext[0:1] + new_counter_b
-    mic = ciphertext[-4:]
-    cipher = AES.new(self.key, AES.MODE_CCM, nonce=nonce, mac_len=4)
-    try:
-      payload = cipher.decrypt_and_verify(ciphertext[1:-8], mic)
-    except ValueError:
-      lg.warning('%s', f'Error decrypting payload "{ciphertext!r}" for device "{self.mac}".')
-      return False
-    #: endtry
-    self.ciphertext = ciphertext
+    return new_counter
+  #: enddef check_ciphertext ///////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  def decryption_job(self, ciphertext: bytes) -> tuple:
+    '''Second step of decryption: returns the arguments of _ccm_decrypt for an
+        encrypted payload. As _ccm_decrypt does not depend on the device state,
+        it can be run in any thread.'''
+    nonce = self.nonce_prefix + ciphertext[0:1] + ciphertext[-8:-4]
+    return _aes_ecb(self.config.key), nonce, ciphertext[1:-8], ciphertext[-4:]
+  #: enddef decryption_job /////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  def accept_payload(self, ciphertext: bytes, new_counter: int, payload: bytes | None
+      ) -> bytes | None:
+    '''Last step of decryption: updates the device state with a decrypted
+        payload (None if decryption failed). Returns the payload on success.'''
+    if payload is None:
+      lg.warning('Error decrypting payload "%r" for device "%s".', ciphertext, self.mac)
+      if METRICS.enabled:
+        METRICS.skipped.inc('decrypt_failed', self.label)
+      #: endif
+      return None
+    #: endif
+    self.ciphertext_hash = hash(ciphertext)
     self.counter = new_counter
-    self.payload = payload
-    lg.debug('%s',  f'Decrypted ciphertext "{ciphertext!r}" for device "{self.mac}" gives '\
-                    f'payload "{self.payload!r}".')
-    return True
-  #: enddef decrypt ////////////////////////////////////////////////////////////
+    if HOT_LOG.debug:
+      lg.debug('Decrypted ciphertext "%r" for device "%s" gives payload "%r".',
+               ciphertext, self.mac, payload)
+    #: endif
+    return payload
+  #: enddef accept_payload /////////////////////////////////////////////////////
 
 
   # ****************************************************************************
-  def parse(self) -> dict[str, tuple[bool | str | float, None | str | int]] | None:
+  def parse(self, payload_bytes: bytes
+      ) -> dict[str, tuple[bool | str | float, None | str | int]] | None:
     '''Parses a BTHome v2 payload. Returns a dict with measurements, indexed by
         their property name and containing a 2 element tuple with any of:
           1.  (bool, None):   [True/False] for binary sensors
@@ -124,286 +448,1090 @@ class BTHomeDevice:
           4.  (type, value):  [str, int] for event sensors with event property
           5.  (value, unit):  [float, str] for remaining sensors,
                               unit may be None
-        May return None in case there is no valid data.'''
-    value: bool | str | float = ''
+        May return None in case there is no valid data.
+        The payload is walked with an offset over a memoryview (no copies),
+        decoding each object thru the precompiled _DECODE_TABLE.'''
     measurements: dict[str, tuple[bool | str | float, None | str | int]] = {}
-    event_type: str | None = None
-    event_property: int | None = None
-    payload = self.payload
-    # to manage same kind of measurements from same sensor
-    measurement_counter = bytearray(b'\00' * 256)
+    decode_table = _DECODE_TABLE    # local, for speed
+    payload = memoryview(payload_bytes)
+    end = len(payload)
+    i = 0
+    # to manage same kind of measurements from same sensor: a bit mask of the
+    # object ids already found, and counters only for the repeated ones
+    seen = 0
+    counters: dict[int, int] | None = None
     # walk the payload
-    while len(payload) > 1:
-      sensor_id = payload[0]
-      sensor = SENSOR.get(sensor_id)
-      if sensor is None:
+    while i < end - 1:
+      object_id = payload[i]
+      decoder = decode_table[object_id]
+      if decoder is None:
         break   # unknown sensor, can't do anymore
       #: endif
-      payload = payload[1:]
-      property_name = sensor.property
-      n_bytes = sensor.bytes
-      if sensor.events:
-        # is an event sensor
-        event_type = sensor.events.get(payload[0])
-        event_property = int(payload[1]) if n_bytes == 2 else None
-      elif n_bytes:
+      kind, bit, property_name, n_bytes, unpack, factor, unit, events = decoder
+      i += 1
+      if not n_bytes:
+        # has a variable value length (text 0x53, raw 0x54)
+        n_bytes = payload[i]
+        i += 1
+      #: endif
+      if i + n_bytes > end:
+        if HOT_LOG.debug:
+          lg.debug('Truncated payload for device %s.', self.mac)
+        #: endif
+        break   # truncated object, can't do anymore
+      #: endif
+      value: tuple[bool | str | float, None | str | int] | None = None
+      if unpack is not None:
         # has a fixed size value length
-        value_i = int.from_bytes(payload[:n_bytes], byteorder='little', signed=sensor.signed)
-        value = float(value_i * sensor.factor)
-        # manage packet id
-        if sensor_id == 0:
-          new_timestamp = time()
-          packet_id = self.packet_id
-          # only accept payloads that are more than 4 seconds from prior ones
-          # or with an increasing packet_id, or with same packet_id and not
-          # deduplicating
-          if not ((new_timestamp > self.timestamp + 4.0)
-              or (value_i > packet_id and value_i - packet_id < 64)
-              or (value_i < packet_id and value_i + 256 - packet_id < 64)
-              or (value_i == packet_id and not self.deduplicate)):
-            lg.debug('%s', f'Packet rejected for device {self.mac} (timestamp or packet_id).')
-            measurements = {}   # reject measurements
-            break
-          #: endif
-          self.timestamp = new_timestamp
-          self.packet_id = value_i
+        if n_bytes == 3:
+          low, high = unpack(payload, i)
+          value_i = low | (high << 16)
+        else:
+          value_i = unpack(payload, i)[0]
         #: endif
-        if sensor.binary:
-          # is a binary sensor
-          value = bool(value_i)
-        elif 0xF1 <= sensor_id <= 0xF2:
-          # is firmware version
-          value = f'{value_i:0{2 * n_bytes}x}'
+        if not kind:  # _NUMBER
+          value = (value_i * factor, unit)
+        elif kind == _BINARY:
+          value = (bool(value_i), unit)
+        elif kind == _FIRMWARE:
+          value = (f'{value_i:0{2 * n_bytes}x}', unit)
+        elif not self._accept_packet_id(value_i):
+          return None   # reject measurements
         #: endif
+      elif kind == _EVENT:
+        event_type = events.get(payload[i])
+        if event_type is not None:
+          value = (event_type, payload[i + 1] if n_bytes == 2 else None)
+        #: endif
+      elif kind == _TEXT:
+        value = (str(payload[i:i + n_bytes], 'utf-8'), unit)
       else:
-        # has a variable value length (text 0x53, raw 0x54)
-        n_bytes, payload = payload[0], payload[1:]
-        value_b: bytes = payload[:n_bytes]
-        value = value_b.decode() if sensor_id == 0x53 else value_b.hex()
+        value = (payload[i:i + n_bytes].hex(), unit)
       #: endif
-      payload = payload[n_bytes:]   # skip to next sensor
-      # increase the measurements counter for each sensor
-      measurement_counter[sensor_id] = cnt = measurement_counter[sensor_id] + 1
+      i += n_bytes   # skip to next sensor
       # manage sensor names in case of > 1 measurements from same sensor
-      if cnt > 1:
+      if seen & bit:
+        if counters is None:
+          counters = {}
+        #: endif
+        counters[object_id] = cnt = counters.get(object_id, 1) + 1
         property_name += '_' + str(cnt)
+      else:
+        seen |= bit
       #: endif
-      if event_type is not None:
-        measurements[property_name] = (event_type, event_property)
-      elif (not sensor.events) and (sensor_id != 0):  # do not report packet id
-        measurements[property_name] = (value, sensor.unit)
+      # packet id and None events are not reported
+      if value is not None:
+        measurements[property_name] = value
       #: endif
     #: endwhile (data available)
-    return measurements if measurements else None
+    if not measurements:
+      if METRICS.enabled:
+        METRICS.skipped.inc('no_data', self.label)
+      #: endif
+      return None
+    #: endif
+    return measurements
   #: enddef parse //////////////////////////////////////////////////////////////
 
 
   # ****************************************************************************
-  async def publish(self, measurements: dict[str, tuple[bool | str | float, None | str | int]]):
-    '''Publishes measurements to MQTT brokers of a BTHome v2 device'''
+  def _accept_packet_id(self, packet_id: int) -> bool:
+    '''Manages the packet id. Returns False if the payload must be rejected'''
+    new_timestamp = time()
+    last_packet_id = self.packet_id
+    # only accept payloads that are more than 4 seconds from prior ones
+    # or with an increasing packet_id, or with same packet_id and not
+    # deduplicating
+    if not ((new_timestamp > self.timestamp + 4.0)
+        or (packet_id > last_packet_id and packet_id - last_packet_id < 64)
+        or (packet_id < last_packet_id and packet_id + 256 - last_packet_id < 64)
+        or (packet_id == last_packet_id and not self.config.deduplicate)):
+      if HOT_LOG.debug:
+        lg.debug('Packet rejected for device %s (timestamp or packet_id).', self.mac)
+      #: endif
+      if METRICS.enabled:
+        METRICS.skipped.inc('packet_id', self.label)
+      #: endif
+      return False
+    #: endif
+    self.timestamp = new_timestamp
+    self.packet_id = packet_id
+    return True
+  #: enddef _accept_packet_id //////////////////////////////////////////////////
 
-    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
-    async def connect_to_broker(broker: Broker):
-      '''Connects to a broker and spawns publishments on all of its topics'''
-      lg.debug('%s', f'({self.mac} => {broker.hostname}) Connecting to MQTT broker.')
-      try:
-        ssl_context = None
-        if broker.encrypt:
-          ssl_context = ssl.create_default_context(cafile=_CAFILE, purpose=ssl.Purpose.SERVER_AUTH)
-        else:
-          broker.insecure = False
+
+  # ****************************************************************************
+  def decode(self, payload: bytes, payload_cache: PayloadCache | None = None
+      ) -> tuple[dict, bytes] | None:
+    '''Parses a payload (see parse) and JSON encodes the measurements, thru the
+        payload cache, if any. Returns the measurements (that can be freely
+        modified) and their JSON encoding, or None in case there is no valid
+        data.'''
+    # the packet id, if any, is the first object (objects are sorted by id)
+    has_packet_id = payload[:1] == b'\x00' and len(payload) > 1
+    key = payload[2:] if has_packet_id else payload
+    if payload_cache is not None:
+      cached = payload_cache.get(key)
+      if cached is not None:
+        if has_packet_id and not self._accept_packet_id(payload[1]):
+          return None
         #: endif
-        lg.debug('%s',  f'({self.mac} => {broker.hostname}) Connecting '\
-                        f'({"with" if broker.encrypt else "without"} encryption, '\
-                        f'{"insecure, " if broker.encrypt and broker.insecure else ""}'\
-                        f'{"with" if broker.user != "" else "without"} authentication) '\
-                        f'to MQTT broker "{broker.hostname}:{broker.port}".')
-        async with aiomqtt.Client(
-            hostname = broker.hostname,
-            username = broker.user,
-            password = broker.password,
-            port = broker.port,
-            tls_context = ssl_context,
-            tls_insecure = broker.insecure,
-            timeout = _AIOMQTT_TIMEOUT
-        ) as peer:
-          async with asyncio.TaskGroup() as tg_topic:
-            for topic in broker.topics:
-              tg_topic.create_task(publish_to_broker(peer, topic))
-            #: endfor topic
-          #: endwith tg_topic
-        #: endwith peer
-      except (aiomqtt.MqttError, aiomqtt.MqttCodeError) as e:
-        lg.error('%s', f'({self.mac} => {broker.hostname}) MQTT connect error. {e}.')
-        return
-      #: endtry
-      lg.debug('%s', f'({self.mac} => {broker.hostname}) Done with MQTT broker.')
-    #: enddef connect_to_broker ------------------------------------------------
+        return dict(cached[0]), cached[1]
+      #: endif
+    #: endif
+    measurements = self.parse(payload)
+    if measurements is None:
+      return None
+    #: endif
+    encoded = encode_measurements(measurements)
+    if payload_cache is not None:
+      payload_cache.put(key, measurements, encoded)
+      measurements = dict(measurements)
+    #: endif
+    return measurements, encoded
+  #: enddef decode /////////////////////////////////////////////////////////////
 
-    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
-    async def publish_to_broker(peer: aiomqtt.client.Client, topic: str):
-      '''MQTT publish to topic of an already connected broker.'''
-      full_topic = topic + '/' + self.mac if self.promiscuous else topic
-      # remode duplicated '/', just in case...
-      full_topic = re.sub(_SLASHES_RE, '/', full_topic)
-      lg.debug('%s',  f'({self.mac} => {broker.hostname}) MQTT publishment with payload '\
-                      f'\'{mqtt_payload}\' to topic "{full_topic}".')
-      try:
-        await peer.publish(topic=full_topic, payload=mqtt_payload, timeout=_AIOMQTT_TIMEOUT)
-      except (aiomqtt.MqttError, aiomqtt.MqttCodeError) as e:
-        lg.error('%s', f'({self.mac} => {broker.hostname}) MQTT publish error. {e}.')
-        return
-      #: endtry
-      lg.debug('%s',  f'({self.mac} => {broker.hostname}) Successful MQTT publishment of payload '\
-                      f'\'{mqtt_payload}\' to topic "{full_topic}".')
-    #: enddef publish_to_broker ------------------------------------------------
 
+  # ****************************************************************************
+  async def publish(self, measurements: dict[str, tuple[bool | str | float, None | str | int]],
+                    broker_pool: BrokerPool):
+    '''Publishes measurements to all MQTT brokers of a BTHome v2 device, thru the
+        connections of a broker pool'''
     if not measurements:
-      lg.warning('%s', f'({self.mac} => broker) No measurements to publish.')
+      lg.warning('(%s => broker) No measurements to publish.', self.mac)
       return
     #: endif
-    mqtt_payload = json.dumps(measurements)
+    mqtt_payload = encode_measurements(measurements)
     async with asyncio.TaskGroup() as tg_broker:
       for broker in self.brokers:
-        tg_broker.create_task(connect_to_broker(broker))
+        tg_broker.create_task(self.publish_to_broker(broker, mqtt_payload, broker_pool,
+                                                      measurements))
       #: endfor broker
     #: endwith tg_broker
   #: enddef publish ////////////////////////////////////////////////////////////
 
 
-#: endclass BTHomeDevice  ######################################################
+  # ****************************************************************************
+  def to_outbox(self, broker: Broker, mqtt_payload: str | bytes, broker_pool: BrokerPool,
+                measurements: dict | None = None) -> bool:
+    '''Stores an (already JSON encoded) payload (or the measurements, for
+        brokers in split mode) for all topics of one of the brokers of a
+        BTHome v2 device, into the outbox of its connection, to be published
+        later. Returns False if there is no outbox.'''
+    connection = broker_pool.get(broker)
+    outbox = connection.outbox if broker.outbox else None
+    if outbox is None:
+      return False
+    #: endif
+    if broker.split and measurements is not None and connection.split is not None:
+      messages = connection.split.messages(self.mac, self.topics_of(broker), measurements,
+                                           broker.discovery)
+    else:
+      messages = [(topic, mqtt_payload, broker.retain) for topic in self.topics_of(broker)]
+    #: endif
+    self._store(outbox, broker, messages)
+    return True
+  #: enddef to_outbox //////////////////////////////////////////////////////////
 
 
+  # ****************************************************************************
+  def _store(self, outbox: 'Outbox', broker: Broker,
+             messages: Iterable[tuple[str, str | bytes, bool]]):
+    '''Stores messages (topic, payload and retain flag) to one of the brokers
+        of a BTHome v2 device into an outbox (failures to write them are
+        logged by the outbox)'''
+    for topic, payload, retain in messages:
+      outbox.append(topic, payload, broker.qos, retain)
+    #: endfor topic, payload, retain
+  #: enddef _store /////////////////////////////////////////////////////////////
 
-# Read YAML configuration file  ################################################
-def get_bthome_devices_from_yaml_file(config_file_name: str) -> dict[str, BTHomeDevice] | None:
-  '''Gets a dict of BTHome v2 devices to listen to (indexed by their MAC address)
-      from a YAML file. See the example YAML file for a description.'''
-  try:
-    lg.info('%s', f'Reading "{config_file_name}" YAML configuration file.')
-    with open(config_file_name, 'rt', encoding='utf-8-sig') as config_file:
+
+  # ****************************************************************************
+  async def publish_to_broker(self, broker: Broker, mqtt_payload: str | bytes,
+                              broker_pool: BrokerPool, measurements: dict | None = None):
+    '''Publishes an (already JSON encoded) payload on all topics of one of the
+        brokers of a BTHome v2 device, or, for brokers in split mode, the
+        changed properties of the measurements, each to its own subtopic (see
+        bthome_split). With an outbox, messages are stored there if the
+        broker is not connected, or they cannot be published, and behind the
+        messages not replayed yet, if any, to keep their order.'''
+    import  aiomqtt
+
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    async def publish_to_topic(full_topic: str, payload: str | bytes = mqtt_payload,
+                               retain: bool = broker.retain):
+      '''MQTT publish to topic of a pooled broker connection.'''
+      if HOT_LOG.debug:
+        lg.debug('(%s => %s) MQTT publishment with payload \'%s\' to topic "%s".',
+                 self.mac, connection.name, payload, full_topic)
+      #: endif
+      start = perf_counter() if METRICS.enabled else 0.0
       try:
-        devices_from_yaml = yaml.safe_load(config_file)
-        assert isinstance(devices_from_yaml, dict)
-      except (yaml.YAMLError, AssertionError) as e:
-        lg.critical('%s', f'Cannot parse "{config_file_name}" YAML configuration file '\
-                          f'(bad syntax?). {e}. Exiting.')
-        return None
+        await connection.publish(full_topic, payload, timeout=AIOMQTT_TIMEOUT,
+                                 qos=broker.qos, retain=retain)
+      except aiomqtt.MqttError as e:
+        if outbox is not None:
+          self._store(outbox, broker, ((full_topic, payload, retain), ))
+          lg.warning('(%s => %s) MQTT publish error, stored in outbox. %s.', self.mac,
+                     connection.name, e)
+        else:
+          lg.error('(%s => %s) MQTT publish error. %s.', self.mac, connection.name, e)
+          if split is not None:
+            split.forget(full_topic)    # publish it next time
+          #: endif
+        #: endif
+        if METRICS.enabled:
+          METRICS.publish_seconds.observe(perf_counter() - start, connection.name, self.label)
+          METRICS.publish_failures.inc(connection.name)
+        #: endif
+        return
       #: endtry
-      devices = {}  # devices to monitor, indexed by MAC address
-      for mac, device_data in devices_from_yaml.items():
-        # remove :-_. and spaces from MAC address
-        mac = mac.translate({ord(c): None for c in ':-_. '}).upper()
-        bthomedevice = BTHomeDevice(mac=mac)
-        key = bytes.fromhex(device_data.get('key', ''))
-        if len(key) != 16 and key != b'':
-          lg.error('%s', f'Decrypting key for device "{mac}" not 128 bits in length.')
-          key = b''
+      if METRICS.enabled:
+        METRICS.publish_seconds.observe(perf_counter() - start, connection.name, self.label)
+        METRICS.publishes.inc(connection.name)
+      #: endif
+      if HOT_LOG.debug:
+        lg.debug('(%s => %s) Successful MQTT publishment of payload \'%s\' to topic "%s".',
+                 self.mac, connection.name, payload, full_topic)
+      #: endif
+    #: enddef publish_to_topic -------------------------------------------------
+
+    connection = broker_pool.get(broker)
+    outbox = connection.outbox if broker.outbox else None
+    split = connection.split if broker.split and measurements is not None else None
+    if split is not None:
+      messages = split.messages(self.mac, self.topics_of(broker), measurements, broker.discovery)
+      if outbox is not None and (outbox.backlog or not connection.connected):
+        self._store(outbox, broker, messages)
+        return
+      #: endif
+      if len(messages) == 1:
+        await publish_to_topic(*messages[0])
+      elif messages:
+        async with asyncio.TaskGroup() as tg_message:
+          for message in messages:
+            tg_message.create_task(publish_to_topic(*message))
+          #: endfor message
+        #: endwith tg_message
+      #: endif
+      return
+    #: endif
+    if (outbox is not None and (outbox.backlog or not connection.connected)
+        and self.to_outbox(broker, mqtt_payload, broker_pool)):
+      return
+    #: endif
+    topics = self.topics_of(broker)
+    if len(topics) == 1:
+      await publish_to_topic(topics[0])   # no tasks needed
+      return
+    #: endif
+    async with asyncio.TaskGroup() as tg_topic:
+      for topic in topics:
+        tg_topic.create_task(publish_to_topic(topic))
+      #: endfor topic
+    #: endwith tg_topic
+  #: enddef publish_to_broker //////////////////////////////////////////////////
+
+
+#: endclass BTHomeDevice  ######################################################
+
+
+
+# ##############################################################################
+def _decrypt_batch(jobs: list[tuple]) -> list[bytes | None]:
+  '''Runs a batch of decryption jobs (see BTHomeDevice.decryption_job)'''
+  return [_ccm_decrypt(*job) for job in jobs]
+#: enddef _decrypt_batch #######################################################
+
+
+
+# ##############################################################################
+class DecryptionStage:
+  '''Optional pipeline stage decrypting encrypted payloads in a thread pool, so
+      that several cores can be used when many encrypted devices are in range.
+      Payloads arriving during the same event loop iteration are decrypted in
+      batches (of up to batch_size payloads). Checks against duplicates and
+      replay attacks, and device state updates, still run in the event loop,
+      in the order the payloads of each device arrived.'''
+
+
+  # ****************************************************************************
+  def __init__(self, threads: int, batch_size: int = 64):
+    self._executor = ThreadPoolExecutor(threads, thread_name_prefix='decrypt')
+    self._batch_size = batch_size
+    # batch being filled: decryption jobs and futures for their results
+    self._jobs: list[tuple] = []
+    self._results: list[asyncio.Future] = []
+    # per device (MAC address), done when its last payload is processed
+    self._tails: dict[str, asyncio.Future] = {}
+    self.batches = 0    # number of batches sent to the thread pool
+  #: enddef __init__ ///////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  async def decrypt(self, device: BTHomeDevice, ciphertext: bytes) -> bytes | None:
+    '''As BTHomeDevice.decrypt, but decrypting in the thread pool. Returns the
+        payload, or None on failure'''
+    if HOT_LOG.debug:
+      lg.debug('Decrypting ciphertext "%r" for device "%s".', ciphertext, device.mac)
+    #: endif
+    previous = self._tails.get(device.mac)
+    if previous is None:
+      # nothing pending for this device, check now to not waste a decryption
+      new_counter = device.check_ciphertext(ciphertext)
+      if new_counter is None:
+        return None
+      #: endif
+    #: endif
+    loop = asyncio.get_running_loop()
+    result = loop.create_future()
+    self._submit(device.decryption_job(ciphertext), result)
+    done = loop.create_future()
+    self._tails[device.mac] = done
+    try:
+      if previous is not None:
+        # decryption goes on meanwhile, but checks need the updated state
+        await previous
+        new_counter = device.check_ciphertext(ciphertext)
+        if new_counter is None:
+          return None
         #: endif
-        bthomedevice.key = key
-        bthomedevice.deduplicate = device_data.get('deduplicate', bthomedevice.deduplicate)
-        for broker_data in device_data.get('brokers'):
-          broker = Broker()
-          broker.hostname = broker_data.get('hostname', broker.hostname)
-          broker.port = broker_data.get('port', broker.port)
-          broker.user = broker_data.get('user', broker.user)
-          broker.password = broker_data.get('password', broker.password)
-          broker.encrypt = broker_data.get('encrypt', broker.encrypt)
-          broker.insecure = broker_data.get('insecure', broker.insecure)
-          for topic in broker_data.get('topics'):
-            # topics cannot be empty
-            if topic:
-              broker.topics.append(str(topic))
-            else:
-              lg.warning('%s',  f'Invalid empty topic for broker "{broker.hostname}" '\
-                                f'for device "{mac}".')
-            #: endif
-          #: endfor topic
-          # do not add a broker without valid topics
-          if broker.topics:
-            bthomedevice.brokers.append(broker)
-          else:
-            lg.warning('%s',  f'Broker "{broker.hostname}" for device "{mac}" not added, '\
-                              f'as does not have any valid topic.')
-          #: endif
-        #: endfor broker
-        # do not add a device without valid brokers
-        if bthomedevice.brokers:
-          devices[mac] = bthomedevice
+      #: endif
+      return device.accept_payload(ciphertext, new_counter, await result)
+    finally:
+      done.set_result(None)
+      if self._tails.get(device.mac) is done:
+        del self._tails[device.mac]
+      #: endif
+    #: endtry
+  #: enddef decrypt ////////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  def _submit(self, job: tuple, result: asyncio.Future):
+    '''Adds a decryption job to the batch being filled, which is sent to the
+        thread pool when full or at the next event loop iteration'''
+    if not self._jobs:
+      asyncio.get_running_loop().call_soon(self._flush)
+    #: endif
+    self._jobs.append(job)
+    self._results.append(result)
+    if len(self._jobs) >= self._batch_size:
+      self._flush()
+    #: endif
+  #: enddef _submit ////////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  def _flush(self):
+    '''Sends the batch being filled to the thread pool'''
+    if not self._jobs:
+      return
+    #: endif
+    jobs, results = self._jobs, self._results
+    self._jobs, self._results = [], []
+    self.batches += 1
+    batch = asyncio.get_running_loop().run_in_executor(self._executor, _decrypt_batch, jobs)
+    batch.add_done_callback(functools.partial(self._deliver, results))
+  #: enddef _flush /////////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  @staticmethod
+  def _deliver(results: list[asyncio.Future], batch: asyncio.Future):
+    '''Hands over the decrypted payloads of a batch'''
+    if batch.cancelled():
+      payloads: list[bytes | None] = [None] * len(results)
+    elif batch.exception() is not None:
+      payloads = [None] * len(results)
+      lg.error('Decryption batch failed. %s.', batch.exception())
+    else:
+      payloads = batch.result()
+    #: endif
+    for result, payload in zip(results, payloads):
+      if not result.done():
+        result.set_result(payload)
+      #: endif
+    #: endfor result, payload
+  #: enddef _deliver ///////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  def stats(self) -> dict[str, int]:
+    '''Returns the number of batches sent to the thread pool, and of devices
+        with payloads being decrypted'''
+    return {'batches': self.batches, 'pending_devices': len(self._tails)}
+  #: enddef stats //////////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  def close(self):
+    '''Stops the thread pool'''
+    self._executor.shutdown(wait=True, cancel_futures=True)
+  #: enddef close //////////////////////////////////////////////////////////////
+
+
+#: endclass DecryptionStage ####################################################
+
+
+
+# ##############################################################################
+class DeviceRegistry:
+  '''Registry of the BTHome v2 devices being listened to: the configured ones
+      and, in promiscuous mode, those added on the fly for unknown MAC
+      addresses. The latter are bounded: they are evicted when idle (not
+      advertising) for longer than ttl seconds, or, least recently seen
+      first, when there are more than max_promiscuous of them. Added devices
+      share the configuration (key, brokers...) of the promiscuous device.'''
+
+
+  # ****************************************************************************
+  def __init__(self, bthome_devices: dict[str, DeviceConfig], max_promiscuous: int = 1000,
+               ttl: float = 3600.0):
+    # configuration shared by all devices added in promiscuous mode
+    self._template = bthome_devices.get('PROMISCUOUS')
+    if self._template is not None:
+      self._template = replace(self._template, promiscuous=True)
+    #: endif
+    self._devices = {mac: BTHomeDevice(config) for mac, config in bthome_devices.items()
+                     if mac != 'PROMISCUOUS'}
+    self._max_promiscuous = max_promiscuous
+    self._ttl = ttl
+    # devices added in promiscuous mode, and when were they last seen, least
+    # recently seen first
+    self._promiscuous: OrderedDict[str, tuple[BTHomeDevice, float]] = OrderedDict()
+    self.evicted = 0    # number of evicted devices
+  #: enddef __init__ ///////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  @property
+  def promiscuous(self) -> bool:
+    '''True if devices with unknown MAC addresses are accepted'''
+    return self._template is not None
+  #: enddef promiscuous ////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  def get(self, mac: str) -> BTHomeDevice | None:
+    '''Returns the device with a MAC address, None if not (yet) registered'''
+    device = self._devices.get(mac)
+    if device is not None:
+      return device
+    #: endif
+    entry = self._promiscuous.get(mac)
+    if entry is None:
+      return None
+    #: endif
+    self._promiscuous[mac] = (entry[0], time())
+    self._promiscuous.move_to_end(mac)
+    return entry[0]
+  #: enddef get ////////////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  def add(self, mac: str) -> BTHomeDevice:
+    '''Registers a new device in promiscuous mode. Evicts idle devices and,
+        if still too many, the least recently seen ones.'''
+    assert self._template is not None
+    device = BTHomeDevice(self._template, mac)
+    now = time()
+    self._promiscuous[mac] = (device, now)
+    self._evict(now)
+    return device
+  #: enddef add ////////////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  def reload(self, bthome_devices: dict[str, DeviceConfig]) -> dict[str, int]:
+    '''Swaps in a new configuration (as returned by
+        get_bthome_devices_from_yaml_file). Only devices whose configuration
+        changed are updated, and all of them keep their runtime state
+        (counters, packet ids...). Devices added in promiscuous mode are kept
+        (with the new promiscuous configuration) while in promiscuous mode,
+        and adopted if now configured. Returns the number of added, changed
+        and removed configured devices.'''
+    template = bthome_devices.get('PROMISCUOUS')
+    if template is not None:
+      template = replace(template, promiscuous=True)
+    #: endif
+    counts = {'added': 0, 'changed': 0, 'removed': 0}
+    devices: dict[str, BTHomeDevice] = {}
+    for mac, config in bthome_devices.items():
+      if mac == 'PROMISCUOUS':
+        continue
+      #: endif
+      device = self._devices.get(mac)
+      if device is None:
+        entry = self._promiscuous.pop(mac, None)
+        if entry is None:
+          device = BTHomeDevice(config)
         else:
-          lg.warning('%s', f'Device "{mac}" not added, as does not have any valid broker.')
+          device = entry[0]   # adopted, keeping its state
+          device.configure(config)
         #: endif
-      #: endfor device
+        counts['added'] += 1
+      elif device.config != config:
+        device.configure(config)
+        counts['changed'] += 1
+      #: endif
+      devices[mac] = device
+    #: endfor mac, config
+    counts['removed'] = len(self._devices.keys() - devices.keys())
+    if template is None:
+      self.evicted += len(self._promiscuous)
+      self._promiscuous.clear()
+    elif template != self._template:
+      for device, _ in self._promiscuous.values():
+        device.configure(template)
+      #: endfor device, _
+    #: endif
+    self._devices = devices
+    self._template = template
+    return counts
+  #: enddef reload /////////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  def brokers(self) -> set[Broker]:
+    '''Returns all the brokers where devices publish to'''
+    configs = [device.config for device in self._devices.values()]
+    if self._template is not None:
+      configs.append(self._template)
+    #: endif
+    return {broker for config in configs for broker in config.brokers}
+  #: enddef brokers ////////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  def _evict(self, now: float):
+    '''Evicts idle devices and, if still too many, the least recently seen'''
+    promiscuous = self._promiscuous
+    while promiscuous:
+      mac, (_, last_seen) = next(iter(promiscuous.items()))
+      if now - last_seen <= self._ttl and len(promiscuous) <= self._max_promiscuous:
+        break
+      #: endif
+      del promiscuous[mac]
+      self.evicted += 1
+      if HOT_LOG.debug:
+        lg.debug('Evicted BLE device %s, added in promiscuous mode.', mac)
+      #: endif
+    #: endwhile
+  #: enddef _evict /////////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  def stats(self) -> dict[str, int]:
+    '''Returns the number of configured and promiscuous (live) devices, and of
+        evicted devices'''
+    self._evict(time())
+    return {'configured': len(self._devices), 'promiscuous': len(self._promiscuous),
+            'evicted': self.evicted}
+  #: enddef stats //////////////////////////////////////////////////////////////
+
+
+#: endclass DeviceRegistry #####################################################
+
+
+
+# ##############################################################################
+def is_event(name: str) -> bool:
+  '''True if a measurement (by name) is an event (from a button, dimmer...)'''
+  # from the second instance and up, properties are suffixed with "_<number>"
+  return name.partition('_')[0] in _EVENT_PROPERTIES
+#: enddef is_event #############################################################
+
+
+
+# ##############################################################################
+def holds_events(measurements: dict[str, tuple[bool | str | float, None | str | int]]) -> bool:
+  '''True if measurements contain any event (from a button, dimmer...). These
+      must never be superseded by later measurements, as every event matters.'''
+  return any(map(is_event, measurements))
+#: enddef holds_events #########################################################
+
+
+
+# ##############################################################################
+def _encode_json(measurements: dict[str, tuple[bool | str | float, None | str | int]]
+    ) -> bytes:
+  '''JSON encodes measurements with the standard library'''
+  return json.dumps(measurements).encode()
+#: enddef _encode_json #########################################################
+
+
+
+# ##############################################################################
+def _encode_value(value: bool | str | float | int | None) -> str:
+  '''JSON encodes a measured value or unit, as json.dumps does'''
+  value_type = type(value)
+  if value_type is float:
+    text = float.__repr__(value)
+    return _FLOAT_SPECIALS.get(text, text)
+  #: endif
+  if value_type is str:
+    return _encode_string(value)
+  #: endif
+  if value is None:
+    return 'null'
+  #: endif
+  if value_type is bool:
+    return 'true' if value else 'false'
+  #: endif
+  return int.__repr__(value)
+#: enddef _encode_value ########################################################
+
+
+
+# JSON encoded property names, followed by the start of their [value, unit] pair
+_KEY_PREFIXES: dict[str, str] = {}
+
+
+
+# ##############################################################################
+def _encode_fast(measurements: dict[str, tuple[bool | str | float, None | str | int]]
+    ) -> bytes:
+  '''Hand-rolled JSON encoding of measurements, for their fixed shape (a dict
+      of [value, unit] pairs). Same output as json.dumps, but faster.'''
+  prefixes = _KEY_PREFIXES
+  parts = []
+  for name, (value, unit) in measurements.items():
+    prefix = prefixes.get(name)
+    if prefix is None:
+      prefix = prefixes[name] = _encode_string(name) + ': ['
+    #: endif
+    parts.append(f'{prefix}{_encode_value(value)}, {_encode_value(unit)}]')
+  #: endfor name, (value, unit)
+  return ('{' + ', '.join(parts) + '}').encode()
+#: enddef _encode_fast #########################################################
+
+
+
+# JSON encoder in use
+_encode: Callable[[dict], bytes] = _encode_json
+
+
+
+# ##############################################################################
+def use_json_encoder(name: str) -> str:
+  '''Selects the JSON encoder of measurements (see JSON_ENCODERS): "json", the
+      standard library one, or "fast": orjson if installed (its output is
+      compact and UTF-8, not ASCII, encoded), otherwise the hand-rolled one
+      (same output as json). Returns the name of the encoder in use.'''
+  global _encode
+  if name not in JSON_ENCODERS:
+    raise ValueError(f'Unknown JSON encoder "{name}"')
+  #: endif
+  if name == 'json':
+    _encode = _encode_json
+    return 'json'
+  #: endif
+  try:
+    import  orjson                          # optional, imported only if selected
+  except ImportError:
+    _encode = _encode_fast
+    return 'hand-rolled'
+  #: endtry
+  _encode = orjson.dumps
+  return 'orjson'
+#: enddef use_json_encoder #####################################################
+
+
+
+# ##############################################################################
+def encode_measurements(measurements: dict[str, tuple[bool | str | float, None | str | int]]
+    ) -> bytes:
+  '''JSON encodes measurements, as published to MQTT brokers, with the
+      selected encoder (see use_json_encoder)'''
+  return _encode(measurements)
+#: enddef encode_measurements ##################################################
+
+
+
+# ##############################################################################
+def append_rssi(encoded: bytes, rssi: float) -> bytes:
+  '''Appends the RSSI property to JSON encoded measurements (as encoded by
+      encode_measurements)'''
+  return encoded[:-1] + b', "RSSI": [' + repr(rssi).encode() + b', "dBm"]}'
+#: enddef append_rssi ##########################################################
+
+
+
+# ##############################################################################
+def append_adapter(encoded: bytes, adapter: str) -> bytes:
+  '''Appends the adapter property to JSON encoded measurements (as encoded by
+      encode_measurements)'''
+  return encoded[:-1] + b', "adapter": [' + _encode_string(adapter).encode() + b', null]}'
+#: enddef append_adapter #######################################################
+
+
+
+# Read YAML configuration file  ################################################
+def get_bthome_devices_from_yaml_file(config_file_name: str, cache_file_name: str | None = None
+    ) -> dict[str, DeviceConfig] | None:
+  '''Gets a dict of the configurations of the BTHome v2 devices to listen to
+      (indexed by their MAC address) from a YAML file. See the example YAML
+      file for a description. If a cache file is given, the configuration is
+      loaded from it, skipping YAML parsing, as long as the YAML file is the
+      one it was compiled from; otherwise it is (re)written.'''
+  try:
+    lg.info('%s', f'Reading "{config_file_name}" YAML configuration file.')
+    with open(config_file_name, 'rb') as config_file:
+      raw = config_file.read()
+      stat = os.fstat(config_file.fileno())
     #: endwith config_file
-  except (FileNotFoundError, PermissionError, OSError) as e:
+  except OSError as e:
     lg.critical('%s', f'Cannot read "{config_file_name}" configuration file. {e}. Exiting.')
     return None
   #: endtry
+  if cache_file_name is not None:
+    devices = _read_config_cache(cache_file_name, stat, raw)
+    if devices is not None:
+      lg.info('%s', f'Configuration file "{config_file_name}" loaded from cache '\
+                    f'"{cache_file_name}".')
+      return devices
+    #: endif
+  #: endif
+  try:
+    devices_from_yaml = yaml.load(raw.decode('utf-8-sig'), Loader=_YAML_LOADER)
+    assert isinstance(devices_from_yaml, dict)
+  except (yaml.YAMLError, UnicodeDecodeError, AssertionError) as e:
+    lg.critical('%s', f'Cannot parse "{config_file_name}" YAML configuration file '\
+                      f'(bad syntax?). {e}. Exiting.')
+    return None
+  #: endtry
+  devices = {}  # devices to monitor, indexed by MAC address
+  for mac, device_data in devices_from_yaml.items():
+    # remove :-_. and spaces from MAC address
+    mac = mac.translate({ord(c): None for c in ':-_. '}).upper()
+    key = bytes.fromhex(device_data.get('key', ''))
+    if len(key) != 16 and key != b'':
+      lg.error('%s', f'Decrypting key for device "{mac}" not 128 bits in length.')
+      key = b''
+    #: endif
+    deduplicate = device_data.get('deduplicate', DeviceConfig().deduplicate)
+    window, aggregates = _get_aggregation(mac, device_data)
+    brokers = []
+    for broker_data in device_data.get('brokers'):
+      default = Broker()
+      hostname = broker_data.get('hostname', default.hostname)
+      topics = []
+      for topic in broker_data.get('topics'):
+        # topics cannot be empty, remove duplicated '/', just in case...
+        if topic:
+          topics.append(_SLASHES_RE.sub('/', str(topic)))
+        else:
+          lg.warning('%s',  f'Invalid empty topic for broker "{hostname}" '\
+                            f'for device "{mac}".')
+        #: endif
+      #: endfor topic
+      qos = broker_data.get('qos', default.qos)
+      if qos not in (0, 1, 2) or isinstance(qos, bool):
+        lg.warning('%s',  f'Invalid QoS "{qos}" for broker "{hostname}" for device "{mac}", '\
+                          f'using {default.qos}.')
+        qos = default.qos
+      #: endif
+      if broker_data.get('discovery') and not broker_data.get('split'):
+        lg.warning('%s',  f'Discovery for broker "{hostname}" for device "{mac}" ignored, '\
+                          f'as only published in split mode.')
+      #: endif
+      # do not add a broker without valid topics
+      if topics:
+        brokers.append(Broker(hostname=hostname,
+                              port=broker_data.get('port', default.port),
+                              user=broker_data.get('user', default.user),
+                              password=broker_data.get('password', default.password),
+                              encrypt=broker_data.get('encrypt', default.encrypt),
+                              insecure=broker_data.get('insecure', default.insecure),
+                              qos=qos,
+                              retain=bool(broker_data.get('retain', default.retain)),
+                              outbox=bool(broker_data.get('outbox', default.outbox)),
+                              split=bool(broker_data.get('split', default.split)),
+                              discovery=bool(broker_data.get('discovery', default.discovery)),
+                              topics=tuple(topics)))
+      else:
+        lg.warning('%s',  f'Broker "{hostname}" for device "{mac}" not added, '\
+                          f'as does not have any valid topic.')
+      #: endif
+    #: endfor broker
+    # do not add a device without valid brokers
+    if brokers:
+      devices[mac] = DeviceConfig(mac=mac, key=key, deduplicate=deduplicate,
+                                  brokers=tuple(brokers), window=window, aggregates=aggregates)
+    else:
+      lg.warning('%s', f'Device "{mac}" not added, as does not have any valid broker.')
+    #: endif
+  #: endfor device
   lg.info('%s', f'Configuration file "{config_file_name}" successfully parsed.')
   if not devices:
     lg.critical('%s', 'No valid BTHome devices to listen to, exiting.')
     return None
   #endif
+  if cache_file_name is not None:
+    _write_config_cache(cache_file_name, stat, raw, devices)
+  #: endif
   return devices
 #: enddef get_bthome_devices_from_yaml_file ####################################
 
 
 
 # ##############################################################################
-def create_bthome_decoder(bthome_devices: dict[str, BTHomeDevice], meas_log_lvl: int):
-  '''Factory for decoder callbacks for the BLE scanner. Such callbacks decrypt,
-      parse and publish BTHome measurements.'''
-  _devices = deepcopy(bthome_devices)
+def _get_aggregation(mac: str, device_data: dict
+    ) -> tuple[float, tuple[tuple[str, tuple[str, ...]], ...]]:
+  '''Gets the aggregation window (0 if none) and the aggregate functions by
+      property of a device, from its YAML configuration (fields "window" and
+      "aggregate"). Invalid values are logged and ignored.'''
+  default = DeviceConfig()
+  window = device_data.get('window', default.window) or 0.0
+  if isinstance(window, bool) or not isinstance(window, (int, float)) or window < 0:
+    lg.warning('%s', f'Invalid aggregation window "{window}" for device "{mac}", ignored.')
+    window = 0.0
+  #: endif
+  aggregate_data = device_data.get('aggregate') or {}
+  if not isinstance(aggregate_data, dict):
+    lg.warning('%s', f'Invalid aggregate functions "{aggregate_data}" for device "{mac}", '\
+                     f'ignored.')
+    aggregate_data = {}
+  #: endif
+  if aggregate_data and not window:
+    lg.warning('%s',  f'Aggregate functions for device "{mac}" ignored, as it has no '\
+                      f'aggregation window.')
+  #: endif
+  if not window:
+    return 0.0, default.aggregates
+  #: endif
+  aggregates = dict(default.aggregates)
+  for name, functions in aggregate_data.items():
+    valid = []
+    for function in functions if isinstance(functions, list) else [functions]:
+      if function in AGGREGATE_FUNCTIONS:
+        valid.append(function)
+      else:
+        lg.warning('%s',  f'Invalid aggregate function "{function}" of "{name}" for device '\
+                          f'"{mac}", ignored.')
+      #: endif
+    #: endfor function
+    if valid:
+      aggregates[str(name)] = tuple(dict.fromkeys(valid))   # unique, in order
+    #: endif
+  #: endfor name, functions
+  return float(window), tuple(aggregates.items())
+#: enddef _get_aggregation #####################################################
+
+
+
+# ##############################################################################
+def _read_config_cache(cache_file_name: str, stat: os.stat_result, raw: bytes
+    ) -> dict[str, DeviceConfig] | None:
+  '''Loads the configurations of the devices from a cache file, written by
+      _write_config_cache. Returns None if the cache cannot be read or is not
+      for the contents of the YAML file (same modification time and size, or
+      same hash).'''
+  try:
+    with open(cache_file_name, 'rb') as cache_file:
+      cache_key, devices_data = marshal.loads(cache_file.read())
+    #: endwith cache_file
+    version, marshal_version, mtime_ns, size, digest = cache_key
+    if (version, marshal_version) != (_CONFIG_CACHE_VERSION, marshal.version):
+      lg.debug('%s', f'Configuration cache "{cache_file_name}" in an old format.')
+      return None
+    #: endif
+    # same modification time and size, or else same contents
+    if ((mtime_ns, size) != (stat.st_mtime_ns, stat.st_size)
+        and digest != hashlib.sha256(raw).digest()):
+      lg.debug('%s', f'Configuration cache "{cache_file_name}" out of date.')
+      return None
+    #: endif
+    return {mac: DeviceConfig(mac, key, deduplicate,
+                              tuple(Broker(*broker[:-1], topics=tuple(broker[-1]))
+                                    for broker in brokers),
+                              window=window, aggregates=aggregates)
+            for mac, key, deduplicate, brokers, window, aggregates in devices_data}
+  except (OSError, EOFError, ValueError, TypeError) as e:
+    lg.debug('%s', f'Cannot read configuration cache "{cache_file_name}". {e}.')
+    return None
+  #: endtry
+#: enddef _read_config_cache ###################################################
+
+
+
+# ##############################################################################
+def _write_config_cache(cache_file_name: str, stat: os.stat_result, raw: bytes,
+                        devices: dict[str, DeviceConfig]):
+  '''Writes the (already validated) configurations of the devices to a cache
+      file, in marshal format, keyed by the modification time, size and hash
+      of the YAML file they were read from. Failures are only logged.'''
+  devices_data = tuple((config.mac, config.key, config.deduplicate,
+                        tuple((broker.hostname, broker.port, broker.user, broker.password,
+                               broker.encrypt, broker.insecure, broker.qos, broker.retain,
+                               broker.outbox, broker.split, broker.discovery, broker.topics)
+                              for broker in config.brokers),
+                        config.window, config.aggregates)
+                       for config in devices.values())
+  temp_file_name = f'{cache_file_name}.{os.getpid()}.tmp'
+  try:
+    with open(temp_file_name, 'wb') as cache_file:
+      cache_key = (_CONFIG_CACHE_VERSION, marshal.version, stat.st_mtime_ns, stat.st_size,
+                   hashlib.sha256(raw).digest())
+      marshal.dump((cache_key, devices_data), cache_file)
+    #: endwith cache_file
+    os.replace(temp_file_name, cache_file_name)
+  except (OSError, ValueError) as e:
+    lg.warning('%s', f'Cannot write configuration cache "{cache_file_name}". {e}.')
+    try:
+      os.remove(temp_file_name)
+    except OSError:
+      pass
+    #: endtry
+  else:
+    lg.debug('%s', f'Configuration cache "{cache_file_name}" written.')
+  #: endtry
+#: enddef _write_config_cache ##################################################
+
+
+
+# ##############################################################################
+def create_bthome_decoder(bthome_devices: dict[str, DeviceConfig] | DeviceRegistry,
+                          meas_log_lvl: int,
+                          publish_queue: PublishQueue, payload_cache: PayloadCache | None = None,
+                          decryption_stage: DecryptionStage | None = None,
+                          recorder: Callable | None = None,
+                          state_store: 'StateStore | None' = None,
+                          aggregator: 'Aggregator | None' = None):
+  '''Factory for decoder callbacks for the BLE scanner. Such callbacks decrypt
+      (thru the decryption stage, if any) and parse BTHome measurements (thru
+      the payload cache, if any), then hand them over to the publish queue, so
+      that slow brokers never delay the processing of advertisements. The
+      recorder, if any, is called (and must not block) with every
+      advertisement holding service data, before any processing (see
+      bthome_capture.CaptureWriter.record). When the adapter that heard an
+      advertisement is given (see bthome_scan.AdapterMerger), it is recorded
+      and published as property "adapter". With a state store, measurements
+      are only published if this node wins the claim of their reading (see
+      bthome_state.StateStore.claim). Measurements of devices with an
+      aggregation window are handed over to the aggregator, if any, instead
+      of the publish queue. Devices are either a registry or a dict of
+      device configurations (then registered with the default bounds).'''
+  _registry = (bthome_devices if isinstance(bthome_devices, DeviceRegistry)
+               else DeviceRegistry(bthome_devices))
   _meas_log_lvl = meas_log_lvl
+  _publish_queue = publish_queue
+  _payload_cache = payload_cache
+  _decryption_stage = decryption_stage
+  _recorder = recorder
+  _state_store = state_store
+  _aggregator = aggregator
 
 
   # processor for each received BLE advertisement ******************************
-  async def decoder(ble_device, advertisement_data):
-    '''Decoder callback for the BLE scanner. Decrypts, parses and publishes.'''
+  async def decoder(ble_device, advertisement_data, adapter: str | None = None):
+    '''Decoder callback for the BLE scanner. Decrypts, parses and queues for
+        publishing.'''
     if not advertisement_data.service_data:
       return      # skip no-UUID advertisements
     #: endif
-    lg.debug('%s', f'Detected advertising BLE device {ble_device}.')
+    if _recorder is not None:
+      _recorder(ble_device, advertisement_data, adapter)
+    #: endif
+    if METRICS.enabled:
+      METRICS.advertisements.inc()
+    #: endif
+    if HOT_LOG.debug:
+      lg.debug('Detected advertising BLE device %s.', ble_device)
+    #: endif
     mac = ble_device.address.replace(':', '').upper()
-    bthome_device = _devices.get(mac)
-    if (bthome_device is None) and ('PROMISCUOUS' not in _devices.keys()):
-      lg.debug('%s', f'Skipping unwanted BLE device {ble_device}.')
+    bthome_device = _registry.get(mac)
+    if (bthome_device is None) and not _registry.promiscuous:
+      if HOT_LOG.debug:
+        lg.debug('Skipping unwanted BLE device %s.', ble_device)
+      #: endif
+      if METRICS.enabled:
+        METRICS.skipped.inc('unknown_device', '')
+      #: endif
       return      # skip new devices in non-promiscuous mode
     #: endif
     # walk UUIDs
     for uuid, data in advertisement_data.service_data.items():
       if uuid[4:8].lower() != _BTHOME_UUID:
+        if METRICS.enabled:
+          METRICS.skipped.inc('not_bthome', '' if bthome_device is None else bthome_device.label)
+        #: endif
         continue  # skip non BTHome UUIDs
       #: endif
       device_info = data[0]
       if device_info >> 5 != 0b010:
+        if METRICS.enabled:
+          METRICS.skipped.inc('not_v2', '' if bthome_device is None else bthome_device.label)
+        #: endif
         continue  # skip non v2 BTHome protocols
       #: endif
       if bthome_device is None:
         # create new device in promiscuous mode
-        bthome_device = deepcopy(_devices['PROMISCUOUS'])
-        bthome_device.mac = mac
-        bthome_device.promiscuous = True
-        _devices[mac] = bthome_device
-        lg.debug('%s', f'Added new BLE device {ble_device} in promiscuous mode.')
+        bthome_device = _registry.add(mac)
+        if HOT_LOG.debug:
+          lg.debug('Added new BLE device %s in promiscuous mode.', ble_device)
+        #: endif
       #: endif
       # check for encryption
       if not bool(device_info & 0b1):
         # not encrypted
-        if bthome_device.deduplicate and bthome_device.payload == data[1:]:
+        payload: bytes | None = data[1:]
+        if not bthome_device.check_payload(payload):
           continue  # skip repeated payloads (if instructed to do so)
         #: endif
-        bthome_device.payload = data[1:]
-      elif not bthome_device.decrypt(data): # decrypt if encrypted
-        continue    # skip if decryption fails
-      #: endif
-      measurements = bthome_device.parse()
-      if measurements:
-        measurements['RSSI'] = (float(advertisement_data.rssi), 'dBm')
-        lg.log(_meas_log_lvl, '%s', f'Data from device {ble_device}: {measurements}.')
-        await bthome_device.publish(measurements)
       else:
-        lg.warning('%s', f'BLE device {ble_device} does not report any valid BTHome v2 data.')
+        # decrypt if encrypted
+        start = perf_counter() if METRICS.enabled else 0.0
+        if _decryption_stage is None:
+          payload = bthome_device.decrypt(data)
+        else:
+          payload = await _decryption_stage.decrypt(bthome_device, data)
+        #: endif
+        if METRICS.enabled:
+          METRICS.stage_seconds.observe(perf_counter() - start, 'decrypt', bthome_device.label)
+        #: endif
+        if payload is None:
+          continue  # skip if decryption fails
+        #: endif
+      #: endif
+      start = perf_counter() if METRICS.enabled else 0.0
+      decoded = bthome_device.decode(payload, _payload_cache)
+      if METRICS.enabled:
+        METRICS.stage_seconds.observe(perf_counter() - start, 'decode', bthome_device.label)
+      #: endif
+      if decoded:
+        if _state_store is not None and not await _state_store.claim(mac, data):
+          if HOT_LOG.debug:
+            lg.debug('Skipping reading of device %s claimed by another node.', ble_device)
+          #: endif
+          if METRICS.enabled:
+            METRICS.skipped.inc('claimed', bthome_device.label)
+          #: endif
+          continue  # skip readings published by other nodes
+        #: endif
+        measurements, mqtt_payload = decoded
+        if METRICS.enabled:
+          METRICS.measurements.inc(bthome_device.label)
+        #: endif
+        rssi = float(advertisement_data.rssi)
+        measurements['RSSI'] = (rssi, 'dBm')
+        mqtt_payload = append_rssi(mqtt_payload, rssi)
+        if adapter is not None:
+          measurements['adapter'] = (adapter, None)
+          mqtt_payload = append_adapter(mqtt_payload, adapter)
+        #: endif
+        if HOT_LOG.enabled(_meas_log_lvl):
+          lg.log(_meas_log_lvl, 'Data from device %s: %s.', ble_device, measurements)
+        #: endif
+        if _aggregator is not None and bthome_device.config.window:
+          _aggregator.submit(bthome_device, measurements)
+        else:
+          _publish_queue.submit(bthome_device, measurements, mqtt_payload,
+                                not holds_events(measurements))
+        #: endif
+      else:
+        lg.warning('BLE device %s does not report any valid BTHome v2 data.', ble_device)
       #: endif
     #: endfor uuid
   #: enddef decoder ////////////////////////////////////////////////////////////
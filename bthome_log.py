@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''Logging helpers for the hot path of the BTHome v2 pipeline.'''
+
+
+
+# ##############################################################################
+import  logging as lg
+from    logging.handlers import QueueHandler, QueueListener
+import  queue
+# ##############################################################################
+
+
+
+# ##############################################################################
+class HotPathLog:
+  '''Cached results of isEnabledFor (for the root logger) used to guard log
+      calls in the hot path of the pipeline, so that disabled messages cost a
+      single attribute test, with no formatting at all. Messages themselves
+      are lazily formatted by logging ('%s' style arguments).
+      Must be refreshed whenever log levels change.'''
+
+
+  # ****************************************************************************
+  def __init__(self):
+    self.debug = False
+    self.info = False
+    self._enabled: dict[int, bool] = {}
+    self.refresh()
+  #: enddef __init__ ///////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  def refresh(self):
+    '''Re-reads the enabled log levels'''
+    logger = lg.getLogger()
+    self._enabled = {level: logger.isEnabledFor(level)
+                     for level in (lg.DEBUG, lg.INFO, lg.WARNING, lg.ERROR, lg.CRITICAL)}
+    self.debug = self._enabled[lg.DEBUG]
+    self.info = self._enabled[lg.INFO]
+  #: enddef refresh ////////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  def enabled(self, level: int) -> bool:
+    '''Cached isEnabledFor(level)'''
+    enabled = self._enabled.get(level)
+    return lg.getLogger().isEnabledFor(level) if enabled is None else enabled
+  #: enddef enabled ////////////////////////////////////////////////////////////
+
+
+#: endclass HotPathLog #########################################################
+
+
+
+# ##############################################################################
+# the (shared) cached log levels
+HOT_LOG = HotPathLog()
+# ##############################################################################
+
+
+
+# ##############################################################################
+class _DroppingQueueHandler(QueueHandler):
+  '''QueueHandler that never blocks: records arriving while its (bounded) queue
+      is full are dropped, and counted. The number of dropped records is
+      logged as soon as there is room again.'''
+
+
+  # ****************************************************************************
+  def __init__(self, log_queue: queue.Queue):
+    super().__init__(log_queue)
+    self.dropped = 0    # number of dropped records
+    self._reported = 0  # number of dropped records already logged
+  #: enddef __init__ ///////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  def enqueue(self, record: lg.LogRecord):
+    try:
+      self.queue.put_nowait(record)
+    except queue.Full:
+      self.dropped += 1
+      return
+    #: endtry
+    if self.dropped != self._reported:
+      report = lg.makeLogRecord({
+          'levelno': lg.WARNING, 'levelname': lg.getLevelName(lg.WARNING),
+          'msg': '%d log records dropped (log queue full).',
+          'args': (self.dropped - self._reported, )})
+      try:
+        self.queue.put_nowait(report)
+      except queue.Full:
+        return  # will be reported later
+      #: endtry
+      self._reported = self.dropped
+    #: endif
+  #: enddef enqueue ////////////////////////////////////////////////////////////
+
+
+#: endclass _DroppingQueueHandler ##############################################
+
+
+
+# ##############################################################################
+class _FlushingQueueListener(QueueListener):
+  '''QueueListener that, when stopped, waits for room in a full queue, so that
+      all pending records are written'''
+
+
+  # ****************************************************************************
+  def enqueue_sentinel(self):
+    self.queue.put(self._sentinel)
+  #: enddef enqueue_sentinel ///////////////////////////////////////////////////
+
+
+#: endclass _FlushingQueueListener #############################################
+
+
+
+# ##############################################################################
+class AsyncLogOutput:
+  '''Asynchronous log output: the handlers of the root logger (console, rotating
+      log file...) are moved to a background thread, fed thru a bounded queue,
+      so that writing log records never blocks the event loop. Records are
+      dropped (and counted) when the queue is full. When stopped, all pending
+      records are written and the handlers are moved back to the root logger.'''
+
+
+  # ****************************************************************************
+  def __init__(self, maxsize: int = 10000):
+    self._queue: queue.Queue = queue.Queue(maxsize)
+    self._handler = _DroppingQueueHandler(self._queue)
+    self._handlers: list[lg.Handler] = []
+    self._listener: QueueListener | None = None
+  #: enddef __init__ ///////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  @property
+  def dropped(self) -> int:
+    '''Number of log records dropped as the queue was full'''
+    return self._handler.dropped
+  #: enddef dropped ////////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  def stats(self) -> dict[str, int]:
+    '''Returns the queue length and drop counter'''
+    return {'queued': self._queue.qsize(), 'dropped': self.dropped}
+  #: enddef stats //////////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  def start(self):
+    '''Moves the handlers of the root logger to the background thread'''
+    if self._listener is not None:
+      return
+    #: endif
+    root = lg.getLogger()
+    self._handlers = list(root.handlers)
+    self._listener = _FlushingQueueListener(self._queue, *self._handlers,
+                                            respect_handler_level=True)
+    self._listener.start()
+    for handler in self._handlers:
+      root.removeHandler(handler)
+    #: endfor handler
+    root.addHandler(self._handler)
+  #: enddef start //////////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  def stop(self):
+    '''Writes all pending records and moves the handlers back to the root
+        logger'''
+    if self._listener is None:
+      return
+    #: endif
+    root = lg.getLogger()
+    root.removeHandler(self._handler)
+    self._listener.stop()
+    self._listener = None
+    for handler in self._handlers:
+      root.addHandler(handler)
+    #: endfor handler
+    if self.dropped:
+      lg.warning('%d log records dropped (log queue full) in total.', self.dropped)
+    #: endif
+  #: enddef stop ///////////////////////////////////////////////////////////////
+
+
+#: endclass AsyncLogOutput #####################################################
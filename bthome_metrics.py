@@ -0,0 +1,423 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''Instrumentation of the BTHome v2 pipeline: counters and latency histograms,
+    exported in Prometheus text format over a local HTTP endpoint and,
+    optionally, as periodic $SYS-style MQTT messages.'''
+
+
+
+# ##############################################################################
+import  logging as lg
+import  asyncio
+from    bisect import bisect_left
+from    typing import Callable, Iterable
+# ##############################################################################
+
+
+
+# some constants  ##############################################################
+# upper bounds (in s) of the buckets of latency histograms
+LATENCY_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025,
+                   0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# timeout (in s) reading HTTP requests
+_HTTP_TIMEOUT = 5
+# ##############################################################################
+
+
+
+# a metric family: (name, type, help, samples), samples being indexed by their
+# labels (a tuple of (label name, label value) pairs)
+Family = tuple[str, str, str, dict[tuple[tuple[str, str], ...], float]]
+
+
+
+# ##############################################################################
+def _format_labels(labels: tuple[tuple[str, str], ...]) -> str:
+  '''Formats labels as in the Prometheus text format: {name="value",...}'''
+  if not labels:
+    return ''
+  #: endif
+  return '{' + ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"')
+                                                        .replace('\n', '\\n'))
+                        for name, value in labels) + '}'
+#: enddef _format_labels #######################################################
+
+
+
+# ##############################################################################
+class Counter:
+  '''Monotonic counter, with a value per combination of label values'''
+  __slots__ = ('name', 'help', 'labelnames', 'values')
+
+
+  # ****************************************************************************
+  def __init__(self, name: str, help: str, labelnames: tuple[str, ...] = ()):
+    self.name = name
+    self.help = help
+    self.labelnames = labelnames
+    self.values: dict[tuple[str, ...], float] = {}
+  #: enddef __init__ ///////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  def inc(self, *labelvalues: str, amount: float = 1):
+    '''Increases the counter for some label values'''
+    self.values[labelvalues] = self.values.get(labelvalues, 0) + amount
+  #: enddef inc ////////////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  def families(self) -> list[Family]:
+    '''Returns the metric family of the counter'''
+    return [(self.name, 'counter', self.help,
+             {tuple(zip(self.labelnames, labelvalues)): value
+              for labelvalues, value in self.values.items()})]
+  #: enddef families ///////////////////////////////////////////////////////////
+
+
+#: endclass Counter ############################################################
+
+
+
+# ##############################################################################
+class Histogram:
+  '''Histogram of observed values (latencies), with a distribution per
+      combination of label values. Each distribution is a list holding the
+      count of each bucket (the last one being +Inf), then the sum of all
+      observed values.'''
+  __slots__ = ('name', 'help', 'labelnames', 'buckets', 'values')
+
+
+  # ****************************************************************************
+  def __init__(self, name: str, help: str, labelnames: tuple[str, ...] = (),
+               buckets: tuple[float, ...] = LATENCY_BUCKETS):
+    self.name = name
+    self.help = help
+    self.labelnames = labelnames
+    self.buckets = buckets
+    self.values: dict[tuple[str, ...], list[float]] = {}
+  #: enddef __init__ ///////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  def observe(self, value: float, *labelvalues: str):
+    '''Adds an observed value for some label values'''
+    distribution = self.values.get(labelvalues)
+    if distribution is None:
+      distribution = self.values[labelvalues] = [0] * (len(self.buckets) + 2)
+    #: endif
+    distribution[bisect_left(self.buckets, value)] += 1
+    distribution[-1] += value
+  #: enddef observe ////////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  def families(self) -> list[Family]:
+    '''Returns the metric families of the histogram: cumulative buckets, sum
+        and count (as Prometheus does)'''
+    buckets: dict = {}
+    sums: dict = {}
+    counts: dict = {}
+    bounds = [repr(bound) for bound in self.buckets] + ['+Inf']
+    for labelvalues, distribution in self.values.items():
+      labels = tuple(zip(self.labelnames, labelvalues))
+      cumulative = 0
+      for bound, count in zip(bounds, distribution):
+        cumulative += count
+        buckets[labels + (('le', bound), )] = cumulative
+      #: endfor bound, count
+      sums[labels] = distribution[-1]
+      counts[labels] = cumulative
+    #: endfor labelvalues, distribution
+    return [(self.name + '_bucket', 'histogram', self.help, buckets),
+            (self.name + '_sum', '', '', sums),
+            (self.name + '_count', '', '', counts)]
+  #: enddef families ///////////////////////////////////////////////////////////
+
+
+#: endclass Histogram ##########################################################
+
+
+
+# ##############################################################################
+def stats_collector(prefix: str, stats: Callable[[], dict], label: str = '') -> Callable:
+  '''Adapts the stats() method of a pipeline component into a collector of
+      gauges named "<prefix>_<counter>". Stats are either a dict of counters,
+      or a dict of such dicts indexed by the value of label.'''
+
+  # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+  def collect() -> list[Family]:
+    '''Reads the stats at scrape time'''
+    families: dict[str, Family] = {}
+    current = stats()
+    nested = {(): current} if not label else {((label, key), ): value
+                                              for key, value in current.items()}
+    for labels, counters in nested.items():
+      for counter, value in counters.items():
+        name = f'{prefix}_{counter}'
+        if name not in families:
+          families[name] = (name, 'gauge', f'{prefix.replace("_", " ")} {counter}', {})
+        #: endif
+        families[name][3][labels] = value
+      #: endfor counter, value
+    #: endfor labels, counters
+    return list(families.values())
+  #: enddef collect ------------------------------------------------------------
+
+  return collect
+#: enddef stats_collector ######################################################
+
+
+
+# ##############################################################################
+class PipelineMetrics:
+  '''Metrics of the BTHome v2 pipeline. Instrumented code must check enabled
+      before updating them, so that they cost nothing when disabled. Other
+      components are read at scrape time thru collectors (callables returning
+      metric families, see stats_collector).'''
+
+
+  # ****************************************************************************
+  def __init__(self):
+    self.enabled = False
+    self.advertisements = Counter('bthome_advertisements_total',
+        'BLE advertisements with service data received.')
+    self.skipped = Counter('bthome_skipped_total',
+        'Service data skipped, by reason and device (empty if not a known BTHome device, '
+        '"promiscuous" for all devices added in promiscuous mode).',
+        ('reason', 'device'))
+    self.measurements = Counter('bthome_measurements_total',
+        'Sets of measurements decoded, by device ("promiscuous" for all devices added in '
+        'promiscuous mode).', ('device', ))
+    self.stage_seconds = Histogram('bthome_stage_seconds',
+        'Processing time of BTHome payloads, by pipeline stage (decrypt, decode) and device '
+        '("promiscuous" for all devices added in promiscuous mode).', ('stage', 'device'))
+    self.publishes = Counter('bthome_mqtt_publishes_total',
+        'Successful MQTT publishments, by broker.', ('broker', ))
+    self.publish_failures = Counter('bthome_mqtt_publish_failures_total',
+        'Failed MQTT publishments, by broker.', ('broker', ))
+    self.publish_seconds = Histogram('bthome_mqtt_publish_seconds',
+        'Time taken by MQTT publishments (successful or not), by broker and device '
+        '("promiscuous" for all devices added in promiscuous mode).', ('broker', 'device'))
+    self._metrics = (self.advertisements, self.skipped, self.measurements, self.stage_seconds,
+                     self.publishes, self.publish_failures, self.publish_seconds)
+    self._collectors: list[Callable[[], Iterable[Family]]] = []
+  #: enddef __init__ ///////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  def add_collector(self, collector: Callable[[], Iterable[Family]]):
+    '''Adds a collector, called at scrape time'''
+    self._collectors.append(collector)
+  #: enddef add_collector //////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  def families(self) -> list[Family]:
+    '''Returns all metric families'''
+    families = [family for metric in self._metrics for family in metric.families()]
+    for collector in self._collectors:
+      try:
+        families.extend(collector())
+      except Exception as e:  # a broken collector must not break the others
+        lg.error('Metrics collector failed. %s.', e)
+      #: endtry
+    #: endfor collector
+    return families
+  #: enddef families ///////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  def render(self) -> str:
+    '''Returns all metrics in Prometheus text format'''
+    lines = []
+    for name, kind, help, samples in self.families():
+      if kind:
+        base_name = name.removesuffix('_bucket') if kind == 'histogram' else name
+        lines.append(f'# HELP {base_name} {help}')
+        lines.append(f'# TYPE {base_name} {kind}')
+      #: endif
+      for labels, value in samples.items():
+        lines.append(f'{name}{_format_labels(labels)} {value!r}')
+      #: endfor labels, value
+    #: endfor name, kind, help, samples
+    return '\n'.join(lines) + '\n'
+  #: enddef render /////////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  def snapshot(self) -> dict[str, float]:
+    '''Returns all metrics (but histogram buckets) indexed by a topic-like name:
+        "<metric>/<label value>/..."'''
+    snapshot = {}
+    for name, kind, _, samples in self.families():
+      if kind == 'histogram':
+        continue  # only sums and counts
+      #: endif
+      for labels, value in samples.items():
+        snapshot['/'.join([name.removeprefix('bthome_')]
+                          + [str(value).replace('/', '_') or '-' for _, value in labels])] = value
+      #: endfor labels, value
+    #: endfor name, kind, _, samples
+    return snapshot
+  #: enddef snapshot ///////////////////////////////////////////////////////////
+
+
+#: endclass PipelineMetrics ####################################################
+
+
+
+# ##############################################################################
+class MetricsServer:
+  '''Minimal HTTP server (in the event loop, no extra threads) exporting
+      metrics in Prometheus text format at /metrics.'''
+
+
+  # ****************************************************************************
+  def __init__(self, metrics: PipelineMetrics, host: str, port: int):
+    self._metrics = metrics
+    self._host = host
+    self._port = port
+    self._server: asyncio.Server | None = None
+  #: enddef __init__ ///////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  async def start(self):
+    '''Starts listening'''
+    self._server = await asyncio.start_server(self._handle, self._host, self._port)
+    lg.info('Metrics available at http://%s:%d/metrics.', self._host, self._port)
+  #: enddef start //////////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  async def close(self):
+    '''Stops listening'''
+    if self._server is not None:
+      self._server.close()
+      await self._server.wait_closed()
+      self._server = None
+    #: endif
+  #: enddef close //////////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    '''Serves a single HTTP request'''
+    try:
+      request = await asyncio.wait_for(reader.readline(), _HTTP_TIMEOUT)
+      while True:   # skip headers
+        header = await asyncio.wait_for(reader.readline(), _HTTP_TIMEOUT)
+        if header in (b'\r\n', b'\n', b''):
+          break
+        #: endif
+      #: endwhile
+      method, path, *_ = request.decode('latin-1').split() + ['', '']
+      if method not in ('GET', 'HEAD'):
+        status, body = '405 Method Not Allowed', b''
+      elif path.partition('?')[0] in ('/', '/metrics'):
+        status, body = '200 OK', self._metrics.render().encode()
+      else:
+        status, body = '404 Not Found', b''
+      #: endif
+      writer.write(f'HTTP/1.0 {status}\r\n'
+                   f'Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+                   f'Content-Length: {len(body)}\r\n'
+                   f'Connection: close\r\n\r\n'.encode()
+                   + (body if method == 'GET' else b''))
+      await writer.drain()
+    except (OSError, TimeoutError, UnicodeError):
+      pass  # client gone or too slow
+    finally:
+      writer.close()
+    #: endtry
+  #: enddef _handle ////////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  async def __aenter__(self):
+    await self.start()
+    return self
+  #: enddef __aenter__ /////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  async def __aexit__(self, exc_type, exc, tb):
+    await self.close()
+  #: enddef __aexit__ //////////////////////////////////////////////////////////
+
+
+#: endclass MetricsServer ######################################################
+
+
+
+# ##############################################################################
+class StatsPublisher:
+  '''Periodically publishes metrics to all pooled MQTT broker connections, one
+      value per topic ("<topic>/<metric>/<label value>/..."), as brokers do
+      with their $SYS topics.'''
+
+
+  # ****************************************************************************
+  def __init__(self, metrics: PipelineMetrics, broker_pool, topic: str, interval: float):
+    self._metrics = metrics
+    self._broker_pool = broker_pool
+    self._topic = topic.rstrip('/')
+    self._interval = interval
+    self._task: asyncio.Task | None = None
+  #: enddef __init__ ///////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  async def _run(self):
+    '''Publishing task'''
+    import  aiomqtt                         # not needed before publishing
+    while True:
+      await asyncio.sleep(self._interval)
+      snapshot = self._metrics.snapshot()
+      for connection in self._broker_pool.connections():
+        if not connection.connected:
+          continue  # do not wait for it
+        #: endif
+        try:
+          for name, value in snapshot.items():
+            await connection.publish(f'{self._topic}/{name}', repr(value))
+          #: endfor name, value
+        except aiomqtt.MqttError as e:
+          lg.error('(=> %s) MQTT stats publish error. %s.', connection.name, e)
+        #: endtry
+      #: endfor connection
+    #: endwhile
+  #: enddef _run ///////////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  async def __aenter__(self):
+    self._task = asyncio.create_task(self._run(), name='MQTT stats')
+    return self
+  #: enddef __aenter__ /////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  async def __aexit__(self, exc_type, exc, tb):
+    if self._task is not None:
+      self._task.cancel()
+      try:
+        await self._task
+      except asyncio.CancelledError:
+        pass
+      #: endtry
+      self._task = None
+    #: endif
+  #: enddef __aexit__ //////////////////////////////////////////////////////////
+
+
+#: endclass StatsPublisher #####################################################
+
+
+
+# ##############################################################################
+# the (shared) pipeline metrics
+METRICS = PipelineMetrics()
+# ##############################################################################
@@ -0,0 +1,863 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''Long-lived MQTT broker connections, shared by all BTHome v2 devices, and the
+    queues feeding them. Connections may hold a durable outbox, replayed on
+    reconnection.'''
+
+
+
+# ##############################################################################
+import  logging as lg
+import  asyncio
+from    collections import deque
+from    typing import TYPE_CHECKING, Callable
+# ..............................................................................
+from    bthome_outbox import Outbox, outbox_directory
+from    bthome_split import SplitState, DEFAULT_DISCOVERY_PREFIX
+# ..............................................................................
+if TYPE_CHECKING:
+  import  aiomqtt                           # aiomqtt, imported on first connection
+#: endif
+# ##############################################################################
+
+
+
+# some constants  ##############################################################
+# timeouts
+AIOMQTT_TIMEOUT = 10  # s
+# delays between reconnection attempts (doubled after each failure)
+_RECONNECT_MIN_DELAY = 1    # s
+_RECONNECT_MAX_DELAY = 60   # s
+# QoS > 0 publishments waiting for acknowledgement before aiomqtt warns about them
+_PENDING_CALLS_THRESHOLD = 1000
+# QoS > 0 messages sent but not yet acknowledged, per connection (as paho-mqtt)
+DEFAULT_MAX_INFLIGHT = 20
+# what to do when a publish queue is full
+OVERFLOW_POLICIES = (
+  'drop-oldest',    # discard the oldest queued measurements
+  'drop-newest',    # discard the incoming measurements
+  'coalesce'        # replace queued measurements from the same device, if any
+)                   #   (and not holding events), otherwise discard the oldest
+# ##############################################################################
+
+
+
+# ##############################################################################
+def _ssl_context():
+  '''Returns a TLS context to verify MQTT brokers. ssl and certifi are only
+      imported if some broker is encrypted.'''
+  import  ssl
+  try:
+    import  certifi                         # certifi needed on MSYS2
+    cafile: str | None = certifi.where()
+  except ImportError:
+    cafile = None
+  #: endtry
+  return ssl.create_default_context(cafile=cafile, purpose=ssl.Purpose.SERVER_AUTH)
+#: enddef _ssl_context #########################################################
+
+
+
+# ##############################################################################
+def broker_key(broker) -> tuple:
+  '''Key identifying a distinct MQTT broker session: brokers with the same key
+      share a single connection, whatever their topics.'''
+  return (broker.hostname, broker.port, broker.user, broker.password,
+          broker.encrypt, broker.encrypt and broker.insecure)
+#: enddef broker_key ###########################################################
+
+
+
+# ##############################################################################
+class BrokerConnection:
+  '''Long-lived connection to an MQTT broker, automatically reconnected (with
+      exponential backoff) whenever the session is lost. Topics subscribed to
+      (on every connection) are delivered to on_message(topic, payload). Up
+      to max_inflight QoS > 0 messages may wait for acknowledgement at once,
+      further ones wait for their turn in the MQTT client. Messages stored in
+      its outbox, if any, are replayed (in order, at most replay_rate per
+      second) while connected.'''
+
+
+  # ****************************************************************************
+  def __init__(self, broker, subscriptions: tuple[str, ...] = (),
+               on_message: Callable[[str, bytes], None] | None = None,
+               max_inflight: int = DEFAULT_MAX_INFLIGHT):
+    self.name = f'{broker.hostname}:{broker.port}'
+    self._hostname = broker.hostname
+    self._port = broker.port
+    self._user = broker.user
+    self._password = broker.password
+    self._encrypt = broker.encrypt
+    self._insecure = broker.encrypt and broker.insecure
+    # TLS context is built once, then reused on every reconnection
+    self._ssl_context = None
+    if self._encrypt:
+      self._ssl_context = _ssl_context()
+    #: endif
+    self._subscriptions = subscriptions
+    self._on_message = on_message
+    self._max_inflight = max_inflight
+    self.outbox: Outbox | None = None
+    self.split: SplitState | None = None  # state of split publishing, if used
+    self._replay_interval = 0.0
+    self._replayer: asyncio.Task | None = None
+    self._client: aiomqtt.Client | None = None
+    self._connected = asyncio.Event()   # set while a session is open
+    self._lost = asyncio.Event()        # set to force a reconnection
+    self._stop = asyncio.Event()        # set to close the connection
+    self._task: asyncio.Task | None = None
+  #: enddef __init__ ///////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  @property
+  def connected(self) -> bool:
+    '''True while a session with the broker is open'''
+    return self._connected.is_set()
+  #: enddef connected //////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  def start(self):
+    '''Launches the background task managing the connection'''
+    if self._task is None:
+      self._task = asyncio.create_task(self._run(), name=f'MQTT {self.name}')
+    #: endif
+  #: enddef start //////////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  def attach_outbox(self, outbox: Outbox, replay_rate: float):
+    '''Attaches an (open) outbox, launching the background task replaying it'''
+    self.outbox = outbox
+    self._replay_interval = 1 / replay_rate
+    self._replayer = asyncio.create_task(self._replay(), name=f'MQTT {self.name} outbox')
+  #: enddef attach_outbox //////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  async def close(self):
+    '''Gracefully disconnects from the broker and stops reconnecting, then
+        closes the outbox, if any'''
+    self._stop.set()
+    if self._replayer is not None:
+      self._replayer.cancel()
+      await asyncio.gather(self._replayer, return_exceptions=True)
+      self._replayer = None
+    #: endif
+    if self._task is not None:
+      await self._task
+      self._task = None
+    #: endif
+    if self.outbox is not None:
+      if self.outbox.backlog:
+        lg.info('%s', f'(=> {self.name}) {self.outbox.backlog} bytes of messages kept in '\
+                      f'outbox "{self.outbox.directory}".')
+      #: endif
+      await self.outbox.close()
+    #: endif
+  #: enddef close //////////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  async def _replay(self):
+    '''Replays the messages stored in the outbox, oldest first, while
+        connected, without exceeding the replay rate. Messages are only
+        forgotten once published.'''
+    import  aiomqtt
+    outbox = self.outbox
+    assert outbox is not None
+    while True:
+      await outbox.wait()
+      await self._connected.wait()
+      lg.info('%s', f'(=> {self.name}) Replaying {outbox.backlog} bytes of messages from '\
+                    f'outbox.')
+      replayed = outbox.replayed
+      while (message := await outbox.next()) is not None:
+        topic, payload, qos, retain = message
+        try:
+          await self.publish(topic, payload, qos=qos, retain=retain)
+        except aiomqtt.MqttError as e:
+          lg.warning('%s', f'(=> {self.name}) Outbox replay interrupted. {e}.')
+          await asyncio.sleep(_RECONNECT_MIN_DELAY)
+          break
+        #: endtry
+        outbox.commit()
+        await asyncio.sleep(self._replay_interval)
+      else:
+        lg.info('%s', f'(=> {self.name}) {outbox.replayed - replayed} messages replayed '\
+                      f'from outbox.')
+      #: endwhile
+    #: endwhile
+  #: enddef _replay ////////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  async def _run(self):
+    '''Connects to the broker, then waits for the session to end, reconnecting
+        with backoff until asked to stop.'''
+    import  aiomqtt                         # not needed before the first connection
+    delay = _RECONNECT_MIN_DELAY
+    while not self._stop.is_set():
+      lg.debug('%s',  f'(=> {self.name}) Connecting '\
+                      f'({"with" if self._encrypt else "without"} encryption, '\
+                      f'{"insecure, " if self._insecure else ""}'\
+                      f'{"with" if self._user != "" else "without"} authentication) '\
+                      f'to MQTT broker.')
+      client = aiomqtt.Client(
+          hostname = self._hostname,
+          username = self._user,
+          password = self._password,
+          port = self._port,
+          tls_context = self._ssl_context,
+          tls_insecure = self._insecure if self._encrypt else None,
+          max_inflight_messages = self._max_inflight,
+          timeout = AIOMQTT_TIMEOUT)
+      client.pending_calls_threshold = _PENDING_CALLS_THRESHOLD
+      try:
+        async with client:
+          lg.info('%s', f'(=> {self.name}) Connected to MQTT broker.')
+          for topic in self._subscriptions:
+            await client.subscribe(topic, qos=1)
+          #: endfor topic
+          delay = _RECONNECT_MIN_DELAY
+          self._client = client
+          self._lost.clear()
+          self._connected.set()
+          await self._wait_until_lost(client)
+        #: endwith client
+      except aiomqtt.MqttError as e:
+        lg.error('%s', f'(=> {self.name}) MQTT connection error. {e}.')
+      finally:
+        self._connected.clear()
+        self._client = None
+      #: endtry
+      if self._stop.is_set():
+        break
+      #: endif
+      lg.info('%s', f'(=> {self.name}) Reconnecting to MQTT broker in {delay} s.')
+      try:
+        await asyncio.wait_for(self._stop.wait(), delay)
+      except TimeoutError:
+        pass
+      #: endtry
+      delay = min(2 * delay, _RECONNECT_MAX_DELAY)
+    #: endwhile
+    lg.debug('%s', f'(=> {self.name}) Done with MQTT broker.')
+  #: enddef _run ///////////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  async def _wait_until_lost(self, client: 'aiomqtt.Client'):
+    '''Returns when the session must be closed (reconnection forced or stop
+        requested). Raises MqttError if the broker drops the session.'''
+
+    on_message = self._on_message
+
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    async def watch_session():
+      '''Delivers the messages received, if any. The iterator only ends on
+          disconnection.'''
+      async for message in client.messages:
+        if on_message is not None:
+          on_message(message.topic.value, message.payload)
+        #: endif
+      #: endfor message
+    #: enddef watch_session ----------------------------------------------------
+
+    waiters = [asyncio.create_task(watch_session()),
+               asyncio.create_task(self._lost.wait()),
+               asyncio.create_task(self._stop.wait())]
+    try:
+      done, _ = await asyncio.wait(waiters, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+      for waiter in waiters:
+        waiter.cancel()
+      #: endfor waiter
+    #: endtry
+    if waiters[0] in done:
+      waiters[0].result()   # re-raises the disconnection error
+    #: endif
+  #: enddef _wait_until_lost ///////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  async def publish(self, topic: str, payload: str | bytes, timeout: float = AIOMQTT_TIMEOUT,
+                    qos: int = 0, retain: bool = False):
+    '''Publishes a payload to a topic, waiting (up to timeout seconds) for the
+        session to be open. Raises MqttError on failure.'''
+    import  aiomqtt
+    if not self._connected.is_set():
+      try:
+        await asyncio.wait_for(self._connected.wait(), timeout)
+      except TimeoutError:
+        raise aiomqtt.MqttError('Not connected to MQTT broker') from None
+      #: endtry
+    #: endif
+    client = self._client
+    assert client is not None
+    try:
+      await client.publish(topic=topic, payload=payload, qos=qos, retain=retain,
+                           timeout=timeout)
+    except aiomqtt.MqttError:
+      self._lost.set()    # the session looks broken, reconnect
+      raise
+    #: endtry
+  #: enddef publish ////////////////////////////////////////////////////////////
+
+
+#: endclass BrokerConnection ###################################################
+
+
+
+# ##############################################################################
+class BrokerPool:
+  '''Pool of MQTT connections, holding one long-lived connection per distinct
+      broker (see broker_key), shared by all devices that publish to it.
+      Connections are opened on first use. Connections to brokers with an
+      outbox get one (up to outbox_bytes bytes, replayed at outbox_rate
+      messages/s), in a directory inside outbox_dir, if given, once opened
+      (see open_outboxes). Connections to
+      brokers in split mode get a split state (see bthome_split.SplitState).'''
+
+
+  # ****************************************************************************
+  def __init__(self, max_inflight: int = DEFAULT_MAX_INFLIGHT, outbox_dir: str | None = None,
+               outbox_bytes: int = 64 << 20, outbox_rate: float = 50.0, deadband: int = 1,
+               discovery_prefix: str = DEFAULT_DISCOVERY_PREFIX):
+    self._max_inflight = max_inflight
+    self._outbox_dir = outbox_dir
+    self._outbox_bytes = outbox_bytes
+    self._outbox_rate = outbox_rate
+    self._deadband = deadband
+    self._discovery_prefix = discovery_prefix
+    self._connections: dict[tuple, BrokerConnection] = {}
+    self._outbox_keys: set[tuple] = set()   # keys of the outboxes opened (or tried)
+  #: enddef __init__ ///////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  def get(self, broker) -> BrokerConnection:
+    '''Returns the (started) connection to a broker, creating it if needed'''
+    key = broker_key(broker)
+    connection = self._connections.get(key)
+    if connection is None:
+      connection = BrokerConnection(broker, max_inflight=self._max_inflight)
+      self._connections[key] = connection
+      connection.start()
+    #: endif
+    if getattr(broker, 'split', False) and connection.split is None:
+      connection.split = SplitState(self._deadband, self._discovery_prefix)
+    #: endif
+    return connection
+  #: enddef get ////////////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  async def open_outboxes(self, brokers):
+    '''Opens (from threads) the outboxes of the brokers with an outbox not
+        open yet, opening their connections. Failures are logged (once).'''
+    if self._outbox_dir is None:
+      return
+    #: endif
+    await asyncio.gather(*(self._open_outbox(broker) for broker in set(brokers)
+                           if getattr(broker, 'outbox', False)))
+  #: enddef open_outboxes //////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  async def _open_outbox(self, broker):
+    '''Opens the outbox of the connection to a broker, if not tried yet'''
+    assert self._outbox_dir is not None
+    key = broker_key(broker)
+    connection = self.get(broker)
+    if key in self._outbox_keys:
+      return
+    #: endif
+    self._outbox_keys.add(key)
+    outbox = Outbox(outbox_directory(self._outbox_dir, broker), self._outbox_bytes)
+    try:
+      await asyncio.to_thread(outbox.open)
+    except OSError as e:
+      lg.error('%s',  f'(=> {connection.name}) Cannot open outbox "{outbox.directory}", '\
+                      f'undelivered messages will be lost. {e}.')
+      return
+    #: endtry
+    lg.info('%s', f'(=> {connection.name}) Outbox "{outbox.directory}" opened '\
+                  f'({outbox.backlog} bytes of messages to replay).')
+    connection.attach_outbox(outbox, self._outbox_rate)
+  #: enddef _open_outbox ///////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  def connections(self) -> list[BrokerConnection]:
+    '''Returns all pooled connections'''
+    return list(self._connections.values())
+  #: enddef connections ////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  def stats(self) -> dict[str, dict[str, int]]:
+    '''Returns the connection state (1 if connected), indexed by broker name'''
+    return {connection.name: {'connected': int(connection.connected)}
+            for connection in self._connections.values()}
+  #: enddef stats //////////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  def outbox_stats(self) -> dict[str, dict[str, int]]:
+    '''Returns the outbox counters, indexed by broker name'''
+    return {connection.name: connection.outbox.stats()
+            for connection in self._connections.values() if connection.outbox is not None}
+  #: enddef outbox_stats ///////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  def split_stats(self) -> dict[str, dict[str, int]]:
+    '''Returns the split publishing counters, indexed by broker name'''
+    return {connection.name: connection.split.stats()
+            for connection in self._connections.values() if connection.split is not None}
+  #: enddef split_stats ////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  async def close_unused(self, brokers):
+    '''Closes the connections not used by any of the brokers (e.g. after a
+        configuration reload). Connections in use are kept.'''
+    keys = {broker_key(broker) for broker in brokers}
+    unused = [self._connections.pop(key) for key in list(self._connections) if key not in keys]
+    self._outbox_keys &= keys     # outboxes opened again if brokers come back
+    await asyncio.gather(*(connection.close() for connection in unused))
+  #: enddef close_unused ///////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  async def close(self):
+    '''Closes all pooled connections'''
+    connections = list(self._connections.values())
+    self._connections.clear()
+    await asyncio.gather(*(connection.close() for connection in connections))
+  #: enddef close //////////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  async def __aenter__(self):
+    return self
+  #: enddef __aenter__ /////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  async def __aexit__(self, exc_type, exc, tb):
+    await self.close()
+  #: enddef __aexit__ //////////////////////////////////////////////////////////
+
+
+#: endclass BrokerPool #########################################################
+
+
+
+# ##############################################################################
+class _Entry:
+  '''Measurements of a device waiting to be published to one of its brokers,
+      updated in place when coalesced'''
+  __slots__ = ('device', 'broker', 'measurements', 'mqtt_payload', 'coalescible')
+
+
+  # ****************************************************************************
+  def __init__(self, device, broker, measurements: dict, mqtt_payload: bytes,
+               coalescible: bool):
+    self.device = device
+    self.broker = broker
+    self.measurements = measurements
+    self.mqtt_payload = mqtt_payload
+    self.coalescible = coalescible
+  #: enddef __init__ ///////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  @property
+  def key(self) -> tuple[str, int]:
+    '''Coalescing key: (device MAC, broker)'''
+    return (self.device.mac, id(self.broker))
+  #: enddef key ////////////////////////////////////////////////////////////////
+
+
+#: endclass _Entry #############################################################
+
+
+
+# ##############################################################################
+class _BrokerQueue:
+  '''Bounded queue of pending publishments to one broker connection, drained in
+      micro-batches by its own task: queued entries are taken together (up to
+      batch_size of them, waiting up to batch_delay seconds for a batch to
+      fill), then published by up to max_inflight publisher tasks at once,
+      without waiting for each other. The next batch is taken once the
+      current one is all being published, so entries wait (and may be
+      coalesced) in the queue meanwhile.'''
+
+
+  # ****************************************************************************
+  def __init__(self, connection: BrokerConnection, broker_pool: BrokerPool,
+               maxsize: int, overflow: str, coalesce: bool, max_inflight: int,
+               batch_size: int, batch_delay: float):
+    self.connection = connection
+    self._broker_pool = broker_pool
+    self._overflow = overflow
+    self._coalesce = coalesce
+    self._batch_size = batch_size
+    self._batch_delay = batch_delay
+    self._queue: asyncio.Queue[_Entry] = asyncio.Queue(maxsize)
+    # entries still in the queue, indexed by their key
+    self._pending: dict[tuple[str, int], _Entry] = {}
+    self._max_inflight = max_inflight
+    self._batch_ready = asyncio.Event()     # set when a whole batch is queued
+    # entries of the current batch not being published yet
+    self._ready: deque[_Entry] = deque()
+    self._drained = asyncio.Event()         # set when all are being published
+    self._publishers: set[asyncio.Task] = set()
+    self.inflight = 0                       # running publisher tasks
+    self._drainer: asyncio.Task | None = None
+    # counters
+    self.batches = 0
+    self.spilled = 0                        # stored in the outbox instead of queued
+    self.dropped_oldest = 0
+    self.dropped_newest = 0
+    self.coalesced = 0
+  #: enddef __init__ ///////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  def start(self):
+    '''Launches the task draining the queue'''
+    self._drainer = asyncio.create_task(self._drain(), name=f'MQTT {self.connection.name}')
+  #: enddef start //////////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  async def close(self):
+    '''Stops draining the queue, discarding pending publishments (but those
+        stored in the outbox of their broker)'''
+    spilled = self.spilled
+    while not self._queue.empty():
+      self._spill(self._queue.get_nowait())
+      self._queue.task_done()
+    #: endwhile
+    while self._ready:
+      self._spill(self._ready.popleft())
+      self._queue.task_done()
+    #: endwhile
+    if self.spilled > spilled:
+      lg.info('%s', f'(=> {self.connection.name}) {self.spilled - spilled} pending '\
+                    f'publishments stored in outbox.')
+    #: endif
+    tasks = list(self._publishers)
+    if self._drainer is not None:
+      tasks.append(self._drainer)
+      self._drainer = None
+    #: endif
+    for task in tasks:
+      task.cancel()
+    #: endfor task
+    await asyncio.gather(*tasks, return_exceptions=True)
+  #: enddef close //////////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  async def join(self):
+    '''Waits until all queued publishments are done'''
+    await self._queue.join()
+  #: enddef join ///////////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  def put(self, entry: _Entry):
+    '''Queues measurements of a device for publishing to one of its brokers.
+        Coalescible measurements replace those still queued from the same
+        device (if also coalescible), so only the latest reading is published.
+        Applies the overflow policy if the queue is full: measurements to be
+        dropped are stored in the outbox of the broker instead, if any.'''
+    key = entry.key
+    pending = self._pending.get(key)
+    coalesce = entry.coalescible and (pending is not None) and pending.coalescible
+    if coalesce and self._coalesce:
+      self._replace(pending, entry)
+      return
+    #: endif
+    if self._queue.full():
+      match self._overflow:
+        case 'drop-newest':
+          if not self._spill(entry):
+            self.dropped_newest += 1
+            self._log_drop('newest')
+          #: endif
+          return
+        case 'coalesce' if coalesce:
+          self._replace(pending, entry)
+          return
+        case _:   # 'drop-oldest', or 'coalesce' for a device not yet queued
+          oldest = self._queue.get_nowait()
+          self._queue.task_done()
+          oldest_key = oldest.key
+          if self._pending.get(oldest_key) is oldest:
+            del self._pending[oldest_key]
+          #: endif
+          if not self._spill(oldest):
+            self.dropped_oldest += 1
+            self._log_drop('oldest')
+          #: endif
+      #: endmatch
+    #: endif
+    self._pending[key] = entry
+    self._queue.put_nowait(entry)
+    if self._queue.qsize() >= self._batch_size:
+      self._batch_ready.set()
+    #: endif
+  #: enddef put ////////////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  def _spill(self, entry: _Entry) -> bool:
+    '''Stores the measurements of an entry, not to be published now, in the
+        outbox of its broker. Returns False if it has none.'''
+    if not entry.broker.outbox or self.connection.outbox is None:
+      return False
+    #: endif
+    if not entry.device.to_outbox(entry.broker, entry.mqtt_payload, self._broker_pool,
+                                  entry.measurements):
+      return False
+    #: endif
+    self.spilled += 1
+    return True
+  #: enddef _spill /////////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  def _replace(self, pending: _Entry, entry: _Entry):
+    '''Replaces the reading of a queued entry by a newer one'''
+    pending.measurements = entry.measurements
+    pending.mqtt_payload = entry.mqtt_payload
+    self.coalesced += 1
+  #: enddef _replace ///////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  def _log_drop(self, which: str):
+    '''Logs dropped publishments, without flooding the log'''
+    dropped = self.dropped_oldest + self.dropped_newest
+    if dropped == 1 or dropped % 1000 == 0:
+      lg.warning('%s',  f'(=> {self.connection.name}) Publish queue full, dropping {which} '\
+                        f'measurements ({dropped} dropped so far).')
+    #: endif
+  #: enddef _log_drop //////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  async def _drain(self):
+    '''Draining task, publishing queued measurements in micro-batches'''
+    queue = self._queue
+    while True:
+      batch = [await queue.get()]
+      # let a batch fill, unless already there (entries queued meanwhile may
+      #   still be coalesced or dropped)
+      if self._batch_delay > 0 and queue.qsize() + 1 < self._batch_size:
+        self._batch_ready.clear()
+        try:
+          await asyncio.wait_for(self._batch_ready.wait(), self._batch_delay)
+        except TimeoutError:
+          pass
+        except asyncio.CancelledError:
+          self._spill(batch[0])
+          raise
+        #: endtry
+      #: endif
+      while len(batch) < self._batch_size and not queue.empty():
+        batch.append(queue.get_nowait())
+      #: endwhile
+      self.batches += 1
+      for entry in batch:
+        key = entry.key
+        if self._pending.get(key) is entry:
+          del self._pending[key]
+        #: endif
+      #: endfor entry
+      self._drained.clear()
+      self._ready.extend(batch)
+      # running publishers go on with the batch, add those missing
+      for _ in range(min(len(batch), self._max_inflight - self.inflight)):
+        self.inflight += 1
+        publisher = asyncio.create_task(self._publish())
+        self._publishers.add(publisher)
+        publisher.add_done_callback(self._publishers.discard)
+      #: endfor _
+      await self._drained.wait()
+    #: endwhile
+  #: enddef _drain /////////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  async def _publish(self):
+    '''Publisher task, publishing entries of the current batch until none is
+        left'''
+    ready = self._ready
+    try:
+      while ready:
+        entry = ready.popleft()
+        if not ready:
+          self._drained.set()
+        #: endif
+        try:
+          await entry.device.publish_to_broker(entry.broker, entry.mqtt_payload,
+                                               self._broker_pool, entry.measurements)
+        except Exception as e:  # keep the publisher alive whatever happens
+          lg.error('%s',  f'({entry.device.mac} => {self.connection.name}) Unexpected '\
+                          f'publish error. {e}.')
+        except asyncio.CancelledError:
+          self._spill(entry)    # maybe published already, but better twice than never
+          raise
+        finally:
+          self._queue.task_done()
+        #: endtry
+      #: endwhile
+    finally:
+      self.inflight -= 1
+    #: endtry
+  #: enddef _publish ///////////////////////////////////////////////////////////
+
+
+#: endclass _BrokerQueue #######################################################
+
+
+
+# ##############################################################################
+class PublishQueue:
+  '''Publishing stage of the pipeline: measurements handed over by the decoder
+      are queued (one bounded queue per broker connection) and published by
+      background tasks, so that slow or unreachable brokers never delay the
+      processing of BLE advertisements. When a queue is full, its overflow
+      policy applies (see OVERFLOW_POLICIES).
+      Publishments are pipelined: queues are drained in micro-batches, whose
+      entries are published concurrently (up to max_inflight at once per
+      broker connection), so that a burst of measurements costs a few broker
+      round trips, not one per measurement.
+      While a broker is slow or down, coalescing keeps only the latest reading
+      queued for each device, so that recovery publishes the current state of
+      each device instead of a backlog of obsolete readings.'''
+
+
+  # ****************************************************************************
+  def __init__(self, broker_pool: BrokerPool, maxsize: int = 1000,
+               max_inflight: int = DEFAULT_MAX_INFLIGHT, overflow: str = 'drop-oldest',
+               coalesce: bool = True, batch_size: int = 64, batch_delay: float = 0.0):
+    if overflow not in OVERFLOW_POLICIES:
+      raise ValueError(f'Unknown overflow policy "{overflow}"')
+    #: endif
+    self._broker_pool = broker_pool
+    self._maxsize = maxsize
+    self._max_inflight = max_inflight
+    self._overflow = overflow
+    self._coalesce = coalesce
+    self._batch_size = batch_size
+    self._batch_delay = batch_delay
+    self._queues: dict[tuple, _BrokerQueue] = {}
+  #: enddef __init__ ///////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  def submit(self, device, measurements: dict, mqtt_payload: bytes, coalescible: bool = True):
+    '''Queues measurements of a device (and their JSON encoding, shared by all
+        brokers) for publishing to all of its brokers. Measurements holding
+        events must not be coalescible, as every event matters (as are those
+        to brokers with an outbox). Never blocks.'''
+    for broker in device.brokers:
+      key = broker_key(broker)
+      queue = self._queues.get(key)
+      if queue is None:
+        queue = _BrokerQueue(self._broker_pool.get(broker), self._broker_pool,
+                             self._maxsize, self._overflow, self._coalesce,
+                             self._max_inflight, self._batch_size, self._batch_delay)
+        self._queues[key] = queue
+        queue.start()
+      #: endif
+      queue.put(_Entry(device, broker, measurements, mqtt_payload,
+                       coalescible and not broker.outbox))
+    #: endfor broker
+  #: enddef submit /////////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  def stats(self) -> dict[str, dict[str, int]]:
+    '''Returns queue lengths, publishments in flight, batches, publishments
+        stored in outboxes and drop counters, indexed by broker name'''
+    return {queue.connection.name: {
+                'queued': queue._queue.qsize(),
+                'inflight': queue.inflight,
+                'batches': queue.batches,
+                'spilled': queue.spilled,
+                'dropped_oldest': queue.dropped_oldest,
+                'dropped_newest': queue.dropped_newest,
+                'coalesced': queue.coalesced}
+            for queue in self._queues.values()}
+  #: enddef stats //////////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  async def join(self):
+    '''Waits until all queued publishments are done'''
+    await asyncio.gather(*(queue.join() for queue in list(self._queues.values())))
+  #: enddef join ///////////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  @staticmethod
+  async def _close_queues(queues: list[_BrokerQueue], timeout: float):
+    '''Stops draining some queues, once their pending publishments are done
+        (or after timeout seconds)'''
+    if not queues:
+      return
+    #: endif
+    try:
+      await asyncio.wait_for(asyncio.gather(*(queue.join() for queue in queues)), timeout)
+    except TimeoutError:
+      pass
+    #: endtry
+    await asyncio.gather(*(queue.close() for queue in queues))
+  #: enddef _close_queues //////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  async def close_unused(self, brokers, timeout: float = AIOMQTT_TIMEOUT):
+    '''Stops draining the queues not used by any of the brokers
+        (e.g. after a configuration reload), once their pending publishments
+        are done (or after timeout seconds)'''
+    keys = {broker_key(broker) for broker in brokers}
+    await self._close_queues([self._queues.pop(key) for key in list(self._queues)
+                              if key not in keys], timeout)
+  #: enddef close_unused ///////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  async def close(self, timeout: float = AIOMQTT_TIMEOUT):
+    '''Stops draining all queues, once their pending publishments (e.g. the
+        last aggregates) are done (or after timeout seconds)'''
+    queues = list(self._queues.values())
+    self._queues.clear()
+    await self._close_queues(queues, timeout)
+  #: enddef close //////////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  async def __aenter__(self):
+    return self
+  #: enddef __aenter__ /////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  async def __aexit__(self, exc_type, exc, tb):
+    await self.close()
+  #: enddef __aexit__ //////////////////////////////////////////////////////////
+
+
+#: endclass PublishQueue #######################################################
@@ -0,0 +1,464 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''Durable outboxes, where MQTT messages that could not be delivered to a broker
+    are stored (surviving restarts of the program) until replayed, in order,
+    once the broker is reachable again.'''
+
+
+
+# ##############################################################################
+import  logging as lg
+import  os
+import  re
+import  struct
+import  zlib
+import  asyncio
+from    concurrent.futures import ThreadPoolExecutor
+from    time import monotonic
+# ##############################################################################
+
+
+
+# some constants  ##############################################################
+# outbox record: CRC-32 (of the rest of the record); then a header (length of
+# the topic, length of the payload, flags: QoS level and retain), the (UTF-8)
+# topic and the payload
+_CRC = struct.Struct('<I')
+_HEADER = struct.Struct('<HIB')
+_RECORD_HEADER_SIZE = _CRC.size + _HEADER.size
+_RETAIN_FLAG = 0x04
+# checkpoint: number of the segment and offset (in it) of the oldest record
+# not replayed yet
+_CHECKPOINT = struct.Struct('<QQ')
+_CHECKPOINT_FILE_NAME = 'checkpoint'
+# segment files, named after their (increasing) number
+_SEGMENT_SUFFIX = '.seg'
+_SEGMENT_RE = re.compile(r'^(\d{16})\.seg$')
+# max. size of a segment (in bytes), but for small outboxes
+_SEGMENT_BYTES = 1 << 20
+# max. time (in s) replayed records may wait to be checkpointed
+_CHECKPOINT_INTERVAL = 1.0
+# ##############################################################################
+
+
+
+# ##############################################################################
+def outbox_directory(base_directory: str, broker) -> str:
+  '''Returns the directory of the outbox of a broker (session), inside a base
+      directory'''
+  name = f'{broker.hostname}_{broker.port}' + (f'_{broker.user}' if broker.user else '')
+  return os.path.join(base_directory, re.sub(r'[^\w.-]', '_', name))
+#: enddef outbox_directory #####################################################
+
+
+
+# ##############################################################################
+class Outbox:
+  '''Durable FIFO of MQTT messages (topic, payload, QoS level and retain flag),
+      stored in a directory as append-only segment files. Messages are read
+      (next) and, once delivered, committed; the position of the oldest
+      message not committed yet is checkpointed (at least every second, and
+      on close), so that, after a restart, replay goes on from there (maybe
+      replaying again the messages committed last). Fully committed segments
+      are deleted. When the outbox grows beyond max_bytes, its oldest
+      segments are evicted, losing their messages.
+      Appended messages are written right away (surviving a crash of the
+      program), but only synced to disk when a segment is full, and on
+      close. Once open, all file I/O is done by a thread of the outbox, in
+      order, not to block the event loop: appends and checkpoints are only
+      queued to it (their failures are logged), while reads are awaited.'''
+
+
+  # ****************************************************************************
+  def __init__(self, directory: str, max_bytes: int = 64 << 20):
+    self.directory = directory
+    self._max_bytes = max_bytes
+    # segments of at least 4 KiB, but for the outbox to hold several of them
+    self._segment_bytes = max(4096, min(_SEGMENT_BYTES, max_bytes // 8))
+    self._segments: list[int] = []          # numbers of the segments, oldest first
+    self._sizes: dict[int, int] = {}        # size of each segment
+    self._executor: ThreadPoolExecutor | None = None  # thread doing the file I/O
+    # files, only used by the thread
+    self._writer = None                     # file of the last segment
+    self._writer_segment = -1
+    self._reader = None                     # file of the first segment read
+    self._reader_segment = -1
+    self._read_offset = 0                   # offset of the next record to read
+    self._next_offset = 0                   # offset of the record after it, once read
+    self._checkpointed = 0.0                # monotonic time of the last checkpoint
+    self._appended = asyncio.Event()        # set when messages are appended
+    # counters
+    self.backlog = 0                        # bytes not committed yet
+    self.stored = 0                         # messages appended
+    self.replayed = 0                       # messages committed
+    self.evicted = 0                        # bytes evicted
+  #: enddef __init__ ///////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  def _path(self, segment: int) -> str:
+    '''Returns the file name of a segment'''
+    return os.path.join(self.directory, f'{segment:016d}{_SEGMENT_SUFFIX}')
+  #: enddef _path //////////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  def open(self):
+    '''Opens (creating it, if needed) the outbox, going on from its checkpoint.
+        A truncated or corrupted last record (the program crashed while
+        appending it) is discarded. Raises OSError on failure. Blocking, to be
+        called from a thread (see bthome_mqtt.BrokerPool.open_outboxes).'''
+    os.makedirs(self.directory, exist_ok=True)
+    self._segments = sorted(int(match[1]) for match in map(_SEGMENT_RE.match,
+                                                           os.listdir(self.directory))
+                            if match)
+    first, offset = 0, 0
+    try:
+      with open(os.path.join(self.directory, _CHECKPOINT_FILE_NAME), 'rb') as checkpoint:
+        first, offset = _CHECKPOINT.unpack(checkpoint.read(_CHECKPOINT.size))
+      #: endwith checkpoint
+    except (OSError, struct.error):
+      pass        # no checkpoint yet, replay all segments
+    #: endtry
+    # segments before the checkpoint were fully replayed
+    while self._segments and self._segments[0] < first:
+      os.remove(self._path(self._segments.pop(0)))
+    #: endwhile
+    if not self._segments or self._segments[0] != first:
+      offset = 0
+    #: endif
+    for segment in self._segments:
+      self._sizes[segment] = os.path.getsize(self._path(segment))
+    #: endfor segment
+    if self._segments:
+      last = self._segments[-1]
+      self._sizes[last] = self._valid_size(last)
+      os.truncate(self._path(last), self._sizes[last])
+    else:
+      self._segments.append(first)
+      self._sizes[first] = 0
+    #: endif
+    self._executor = ThreadPoolExecutor(1, thread_name_prefix='outbox')
+    self._executor.submit(self._open_writer, self._segments[-1])
+    self._read_offset = self._next_offset = min(offset, self._sizes[self._segments[0]])
+    self.backlog = sum(self._sizes.values()) - self._read_offset
+    self._checkpointed = monotonic()
+  #: enddef open ///////////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  def _valid_size(self, segment: int) -> int:
+    '''Returns the size of the valid records at the start of a segment'''
+    with open(self._path(segment), 'rb') as segment_file:
+      data = segment_file.read()
+    #: endwith segment_file
+    offset = 0
+    while self._record_at(data, offset) is not None:
+      offset += _RECORD_HEADER_SIZE + sum(_HEADER.unpack_from(data, offset + _CRC.size)[:2])
+    #: endwhile
+    return offset
+  #: enddef _valid_size ////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  @staticmethod
+  def _record_at(data: bytes, offset: int) -> tuple[str, bytes, int, bool] | None:
+    '''Returns the message of the record at an offset of some data, None if
+        truncated or corrupted'''
+    if len(data) - offset < _RECORD_HEADER_SIZE:
+      return None
+    #: endif
+    crc, = _CRC.unpack_from(data, offset)
+    topic_length, payload_length, flags = _HEADER.unpack_from(data, offset + _CRC.size)
+    start = offset + _RECORD_HEADER_SIZE
+    end = start + topic_length + payload_length
+    if len(data) < end or zlib.crc32(data[offset + _CRC.size:end]) != crc:
+      return None
+    #: endif
+    try:
+      topic = data[start:start + topic_length].decode()
+    except UnicodeDecodeError:
+      return None
+    #: endtry
+    return topic, data[start + topic_length:end], flags & 0x03, bool(flags & _RETAIN_FLAG)
+  #: enddef _record_at /////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  def append(self, topic: str, payload: str | bytes, qos: int = 0, retain: bool = False):
+    '''Appends a message, queuing it to be written by the thread of the
+        outbox'''
+    topic_bytes = topic.encode()
+    if isinstance(payload, str):
+      payload = payload.encode()
+    #: endif
+    rest = (_HEADER.pack(len(topic_bytes), len(payload), qos | (_RETAIN_FLAG if retain else 0))
+            + topic_bytes + payload)
+    record = _CRC.pack(zlib.crc32(rest)) + rest
+    last = self._segments[-1]
+    if self._sizes[last] and self._sizes[last] + len(record) > self._segment_bytes:
+      last = self._rotate()
+    #: endif
+    self._executor.submit(self._write, last, self._sizes[last], record)
+    self._sizes[last] += len(record)
+    self.backlog += len(record)
+    self.stored += 1
+    self._appended.set()
+    if self.backlog > self._max_bytes:
+      self._evict()
+    #: endif
+  #: enddef append /////////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  def _rotate(self) -> int:
+    '''Starts a new segment, the last one being synced and closed. Returns
+        the number of the new segment.'''
+    last = self._segments[-1] + 1
+    self._segments.append(last)
+    self._sizes[last] = 0
+    self._executor.submit(self._open_writer, last)
+    return last
+  #: enddef _rotate ////////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  def _evict(self):
+    '''Deletes the oldest segments (but the last one) while the outbox is too
+        large'''
+    evicted = 0
+    while self.backlog > self._max_bytes and len(self._segments) > 1:
+      lost = self._sizes[self._segments[0]] - self._read_offset
+      self._next_segment()
+      self.backlog -= lost
+      evicted += lost
+    #: endwhile
+    if evicted:
+      self.evicted += evicted
+      lg.warning('%s',  f'(outbox {self.directory}) Full, {evicted} bytes of the oldest '\
+                        f'messages evicted ({self.evicted} bytes so far).')
+    #: endif
+  #: enddef _evict /////////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  def _next_segment(self):
+    '''Deletes the first segment, reading on from the next one'''
+    first = self._segments.pop(0)
+    del self._sizes[first]
+    self._executor.submit(self._remove, first)
+    self._read_offset = self._next_offset = 0
+    self._checkpoint()
+  #: enddef _next_segment //////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  async def next(self) -> tuple[str, bytes, int, bool] | None:
+    '''Returns the oldest message not committed yet (topic, payload, QoS level
+        and retain flag), None if none. The same message is returned until
+        committed.'''
+    while self.backlog:
+      first, offset = self._segments[0], self._read_offset
+      if offset < self._sizes[first]:
+        data = await asyncio.get_running_loop().run_in_executor(self._executor, self._read,
+                                                                first, offset)
+        if self._segments[0] != first or self._read_offset != offset:
+          continue      # evicted meanwhile
+        #: endif
+        message = self._record_at(data, 0)
+        if message is not None:
+          self._next_offset = offset + len(data)
+          return message
+        #: endif
+        lg.error('%s',  f'(outbox {self.directory}) Corrupted segment {first}, '\
+                        f'{self._sizes[first] - offset} bytes skipped.')
+        self.backlog -= self._sizes[first] - offset
+        self._read_offset = self._sizes[first]
+      #: endif
+      if first == self._segments[-1]:
+        break     # nothing more appended
+      #: endif
+      self._next_segment()
+    #: endwhile
+    return None
+  #: enddef next ///////////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  def commit(self):
+    '''Forgets the message last returned by next, once delivered'''
+    self.backlog -= self._next_offset - self._read_offset
+    self._read_offset = self._next_offset
+    self.replayed += 1
+    if monotonic() - self._checkpointed >= _CHECKPOINT_INTERVAL or not self.backlog:
+      self._checkpoint()
+    #: endif
+  #: enddef commit /////////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  def _checkpoint(self):
+    '''Records (in the thread of the outbox) the position of the oldest
+        message not committed yet'''
+    self._executor.submit(self._write_checkpoint, self._segments[0], self._read_offset)
+    self._checkpointed = monotonic()
+  #: enddef _checkpoint ////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  def _open_writer(self, segment: int):
+    '''Syncs and closes the file of the last segment, if any, then opens that
+        of a (new) last segment. Runs in the thread of the outbox.'''
+    self._close_writer()
+    try:
+      self._writer = open(self._path(segment), 'ab', buffering=0)
+    except OSError as e:
+      lg.error('%s', f'(outbox {self.directory}) Cannot open segment {segment}. {e}.')
+      return
+    #: endtry
+    self._writer_segment = segment
+  #: enddef _open_writer ///////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  def _close_writer(self):
+    '''Syncs and closes the file of the last segment, if open. Runs in the
+        thread of the outbox.'''
+    if self._writer is None:
+      return
+    #: endif
+    try:
+      os.fsync(self._writer.fileno())
+    except OSError as e:
+      lg.warning('%s', f'(outbox {self.directory}) Cannot sync. {e}.')
+    #: endtry
+    self._writer.close()
+    self._writer, self._writer_segment = None, -1
+  #: enddef _close_writer //////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  def _write(self, segment: int, offset: int, record: bytes):
+    '''Writes a record at an offset of the last segment. Failures are only
+        logged (the rest of the segment would be skipped as corrupted when
+        replayed). Runs in the thread of the outbox.'''
+    try:
+      if self._writer_segment != segment:
+        raise OSError(f'segment {segment} not open')
+      #: endif
+      if self._writer.tell() != offset:
+        self._writer.truncate(offset)   # drop what a failed write left, if any
+      #: endif
+      self._writer.write(record)
+    except OSError as e:
+      lg.error('%s', f'(outbox {self.directory}) Cannot store message, lost. {e}.')
+    #: endtry
+  #: enddef _write /////////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  def _read(self, segment: int, offset: int) -> bytes:
+    '''Returns the record at an offset of a segment (maybe truncated or
+        corrupted, empty on failure). Runs in the thread of the outbox.'''
+    try:
+      if self._reader_segment != segment:
+        if self._reader is not None:
+          self._reader.close()
+        #: endif
+        self._reader, self._reader_segment = None, -1
+        self._reader = open(self._path(segment), 'rb')
+        self._reader_segment = segment
+      #: endif
+      self._reader.seek(offset)
+      data = self._reader.read(_RECORD_HEADER_SIZE)
+      if len(data) == _RECORD_HEADER_SIZE:
+        data += self._reader.read(sum(_HEADER.unpack_from(data, _CRC.size)[:2]))
+      #: endif
+    except OSError as e:
+      lg.warning('%s', f'(outbox {self.directory}) Cannot read segment {segment}. {e}.')
+      return b''
+    #: endtry
+    return data
+  #: enddef _read //////////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  def _remove(self, segment: int):
+    '''Deletes a segment, closing its file first, if being read. Runs in the
+        thread of the outbox.'''
+    if self._reader_segment == segment:
+      self._reader.close()
+      self._reader, self._reader_segment = None, -1
+    #: endif
+    try:
+      os.remove(self._path(segment))
+    except OSError as e:
+      lg.warning('%s', f'(outbox {self.directory}) Cannot delete segment {segment}. {e}.')
+    #: endtry
+  #: enddef _remove ////////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  def _write_checkpoint(self, segment: int, offset: int):
+    '''Records the position of the oldest message not committed yet. Failures
+        are only logged (messages would be replayed again). Runs in the thread
+        of the outbox.'''
+    file_name = os.path.join(self.directory, _CHECKPOINT_FILE_NAME)
+    try:
+      with open(f'{file_name}.tmp', 'wb') as checkpoint:
+        checkpoint.write(_CHECKPOINT.pack(segment, offset))
+      #: endwith checkpoint
+      os.replace(f'{file_name}.tmp', file_name)
+    except OSError as e:
+      lg.warning('%s', f'(outbox {self.directory}) Cannot write checkpoint. {e}.')
+    #: endtry
+  #: enddef _write_checkpoint //////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  async def wait(self):
+    '''Waits until there are messages not committed yet'''
+    while not self.backlog:
+      self._appended.clear()
+      await self._appended.wait()
+    #: endwhile
+  #: enddef wait ///////////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  def stats(self) -> dict[str, int]:
+    '''Returns the bytes not replayed yet, the messages stored and replayed,
+        and the bytes evicted'''
+    return {'backlog_bytes': self.backlog, 'stored': self.stored, 'replayed': self.replayed,
+            'evicted_bytes': self.evicted}
+  #: enddef stats //////////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  def _close_files(self):
+    '''Syncs and closes the files of the segments. Runs in the thread of the
+        outbox.'''
+    self._close_writer()
+    if self._reader is not None:
+      self._reader.close()
+      self._reader, self._reader_segment = None, -1
+    #: endif
+  #: enddef _close_files ///////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  async def close(self):
+    '''Checkpoints, syncs and closes the outbox, once its thread is done with
+        the writes queued'''
+    if self._executor is None:
+      return
+    #: endif
+    self._checkpoint()
+    await asyncio.get_running_loop().run_in_executor(self._executor, self._close_files)
+    self._executor.shutdown()
+    self._executor = None
+  #: enddef close //////////////////////////////////////////////////////////////
+
+
+#: endclass Outbox #############################################################
@@ -0,0 +1,384 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''Scheduling of BLE scan cycles: when to restart the BLE scanner, so that
+    backends reporting each device only once keep on reporting advertisements,
+    with as little dead time (not scanning) as possible. Merging of the
+    advertisements heard by several BLE adapters.'''
+
+
+
+# ##############################################################################
+import  logging as lg
+import  asyncio
+import  inspect
+from    time import monotonic
+from    typing import Callable
+# ##############################################################################
+
+
+
+# some constants  ##############################################################
+# shorter gaps between reports of a device are bursts, not advertising intervals
+_BURST_GAP = 0.5          # s
+# a device is overdue when not reported for this many advertising intervals...
+_OVERDUE_FACTOR = 3
+# ...plus this margin
+_OVERDUE_MARGIN = 2.0     # s
+# min. length of scan cycles, in adaptive mode
+_MIN_CYCLE = 1.0          # s
+# min. timeout of scan cycles, once detected that the backend reports each
+# device only once
+_MIN_REPORT_ONCE_CYCLE = 10.0   # s
+# a scan cycle this long, with several devices reported but none of them
+# reported again, means that the backend reports each device only once
+_DETECT_TIME = 30.0       # s
+# how often the need to restart the scanner is checked, in adaptive mode
+_CHECK_INTERVAL = 0.5     # s
+# devices not reported for longer are forgotten
+_HORIZON = 600.0          # s
+# ##############################################################################
+
+
+
+# ##############################################################################
+class _Device:
+  '''Reports of a BLE device'''
+  __slots__ = ('last_seen', 'interval', 'cycle')
+
+
+  # ****************************************************************************
+  def __init__(self, last_seen: float, cycle: int):
+    self.last_seen = last_seen              # when last reported
+    self.interval: float | None = None      # advertising interval (estimated)
+    self.cycle = cycle                      # scan cycle when last reported
+  #: enddef __init__ ///////////////////////////////////////////////////////////
+
+
+#: endclass _Device ############################################################
+
+
+
+# ##############################################################################
+class ScanScheduler:
+  '''Keeps a BLE scanner scanning, restarting it when needed, as some backends
+      (Linux with some chipsets) report each device only once per scan.
+      Periodically (scanning for scan_time seconds, then pausing for
+      scan_pause seconds) or, if adaptive, without pauses and only when
+      needed (see stalled). The dead time of every restart (from stopping to
+      started again) is measured.'''
+
+
+  # ****************************************************************************
+  def __init__(self, scan_time: float, scan_pause: float, adaptive: bool = False,
+               name: str = 'BLE scanner'):
+    self._scan_time = scan_time       # max. length of scan cycles, inf if none
+    self._scan_pause = 0.0 if adaptive else scan_pause
+    self._adaptive = adaptive
+    self.name = name
+    self._devices: dict[str, _Device] = {}
+    self._reports_once: bool | None = None  # unknown until detected
+    # current scan cycle
+    self._cycle = 0
+    self._cycle_start = monotonic()
+    self._cycle_devices = 0     # devices reported
+    self._repeats = 0           # reports of devices already reported
+    self._returned = 0          # devices reported that were in the previous cycle
+    self._last_new = 0.0        # time into the cycle of the last newly reported device
+    # previous scan cycle
+    self._expected = 0          # devices reported
+    self._spread = 0.0          # time into the cycle of the last newly reported device
+    # counters
+    self._started = monotonic()
+    self.restarts = 0
+    self.dead_time = 0.0        # s, not scanning
+  #: enddef __init__ ///////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  def wrap(self, callback: Callable) -> Callable:
+    '''Returns a scanner detection callback that records reports (see seen),
+        then calls callback. Reports are only needed if adaptive.'''
+    if not self._adaptive:
+      return callback
+    #: endif
+    seen = self.seen
+
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    def detection_callback(ble_device, advertisement_data):
+      seen(ble_device.address)
+      callback(ble_device, advertisement_data)
+    #: enddef detection_callback -----------------------------------------------
+
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    async def async_detection_callback(ble_device, advertisement_data):
+      seen(ble_device.address)
+      await callback(ble_device, advertisement_data)
+    #: enddef async_detection_callback -----------------------------------------
+
+    # the scanner only awaits coroutine functions
+    return (async_detection_callback if inspect.iscoroutinefunction(callback)
+            else detection_callback)
+  #: enddef wrap ///////////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  def seen(self, mac: str):
+    '''Records a report of a device, estimating its advertising interval from
+        the gaps between its reports within scan cycles'''
+    now = monotonic()
+    device = self._devices.get(mac)
+    if device is None:
+      self._devices[mac] = _Device(now, self._cycle)
+      self._cycle_devices += 1
+      self._last_new = now - self._cycle_start
+      return
+    #: endif
+    if device.cycle == self._cycle:
+      gap = now - device.last_seen
+      if gap >= _BURST_GAP:
+        self._repeats += 1
+        device.interval = gap if device.interval is None else 0.7 * device.interval + 0.3 * gap
+      #: endif
+    else:
+      if device.cycle == self._cycle - 1:
+        self._returned += 1
+      #: endif
+      device.cycle = self._cycle
+      self._cycle_devices += 1
+      self._last_new = now - self._cycle_start
+    #: endif
+    device.last_seen = now
+  #: enddef seen ///////////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  def stalled(self, now: float) -> str | None:
+    '''Returns why the scanner must be restarted, None if it must not (yet).
+        While the backend reports devices again and again, only when most of
+        the devices with a known advertising interval (reported in this scan
+        cycle or in the previous one) are overdue, as the backend stopped
+        reporting them. Once detected that the backend reports each device
+        only once, as soon as all the devices of the previous scan cycle are
+        reported again, or when the cycle lasts twice as long as it took to
+        report them all in the previous cycle.'''
+    age = now - self._cycle_start
+    if age >= self._scan_time:
+      return 'scan time elapsed'
+    #: endif
+    if age < _MIN_CYCLE:
+      return None
+    #: endif
+    if self._repeats:
+      self._reports_once = False
+    elif (self._reports_once is None and age >= _DETECT_TIME and self._cycle_devices >= 2):
+      self._reports_once = True
+      lg.info('%s', f'{self.name} reports each device only once, restarting scans as '\
+                    f'soon as all devices are reported.')
+    #: endif
+    # devices not reported for long are forgotten (whatever the backend), so
+    # that rotating MAC addresses do not pile up
+    known = overdue = 0
+    forgotten = []
+    for mac, device in self._devices.items():
+      if now - device.last_seen > _HORIZON:
+        forgotten.append(mac)
+      elif device.interval is not None and device.cycle >= self._cycle - 1:
+        known += 1
+        # not reported since (the later of) its last report or the restart
+        idle = now - max(device.last_seen, self._cycle_start)
+        if idle > _OVERDUE_FACTOR * device.interval + _OVERDUE_MARGIN:
+          overdue += 1
+        #: endif
+      #: endif
+    #: endfor mac, device
+    for mac in forgotten:
+      del self._devices[mac]
+    #: endfor mac
+    if self._reports_once:
+      if self._expected and self._returned >= self._expected:
+        return 'all devices reported'
+      #: endif
+      if age >= max(_MIN_REPORT_ONCE_CYCLE, 2 * self._spread):
+        return 'devices missing'
+      #: endif
+      return None
+    #: endif
+    if overdue and 2 * overdue >= known:
+      return f'{overdue} of {known} devices overdue'
+    #: endif
+    return None
+  #: enddef stalled ////////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  def _new_cycle(self, now: float):
+    '''Starts a new scan cycle'''
+    self._expected = self._cycle_devices
+    self._spread = self._last_new
+    self._cycle += 1
+    self._cycle_start = now
+    self._cycle_devices = self._repeats = self._returned = 0
+    self._last_new = 0.0
+  #: enddef _new_cycle /////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  async def run(self, scanner, stop_event: asyncio.Event):
+    '''Keeps the (started) scanner scanning until stop_event is set'''
+    self._started = self._cycle_start = monotonic()
+    while True:
+      timeout = (_CHECK_INTERVAL if self._adaptive
+                 else self._cycle_start + self._scan_time - monotonic())
+      try:
+        await asyncio.wait_for(stop_event.wait(), timeout)
+      except TimeoutError:
+        pass
+      else:
+        return
+      #: endtry
+      now = monotonic()
+      reason = self.stalled(now) if self._adaptive else 'scan time elapsed'
+      if reason is None:
+        continue
+      #: endif
+      await scanner.stop()
+      lg.debug('%s stopped (%s).', self.name, reason)
+      if self._scan_pause > 0:
+        try:
+          await asyncio.wait_for(stop_event.wait(), self._scan_pause)
+        except TimeoutError:
+          pass
+        else:
+          return
+        #: endtry
+      #: endif
+      await scanner.start()
+      started = monotonic()
+      self.restarts += 1
+      self.dead_time += started - now
+      lg.debug('%s restarted, after a %.1f s scan cycle and %.0f ms dead time.',
+               self.name, now - self._cycle_start, (started - now) * 1000)
+      self._new_cycle(started)
+    #: endwhile
+  #: enddef run ////////////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  @property
+  def duty_cycle(self) -> float:
+    '''Fraction of the time scanning'''
+    elapsed = monotonic() - self._started
+    return 1.0 - self.dead_time / elapsed if elapsed > 0 else 1.0
+  #: enddef duty_cycle /////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  def stats(self) -> dict[str, float]:
+    '''Returns the number of restarts, the total dead time, the duty cycle and
+        the number of devices being tracked'''
+    return {'restarts': self.restarts, 'dead_seconds': self.dead_time,
+            'duty_cycle': self.duty_cycle, 'devices': len(self._devices)}
+  #: enddef stats //////////////////////////////////////////////////////////////
+
+
+#: endclass ScanScheduler ######################################################
+
+
+
+# ##############################################################################
+class AdapterMerger:
+  '''Merges the advertisements reported by several BLE scanners (one per
+      adapter) into a single stream. The copies of an advertisement (same
+      device and service data) heard by several adapters within window
+      seconds are handed over only once to the (async) callback, as
+      callback(ble_device, advertisement_data, adapter), with the best RSSI
+      and the name of the adapter that heard it so.'''
+
+
+  # ****************************************************************************
+  def __init__(self, callback: Callable, window: float = 0.1):
+    self._callback = callback
+    self._window = window         # s, copies are waited for
+    # pending advertisements: [ble_device, advertisement_data, adapter, timer],
+    # indexed by (address, service data)
+    self._pending: dict[tuple, list] = {}
+    self._tasks: set[asyncio.Task] = set()
+    # counters
+    self.forwarded = 0
+    self.duplicates = 0           # copies dropped
+    self.best: dict[str, int] = {}    # advertisements forwarded, by adapter
+  #: enddef __init__ ///////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  def wrap(self, adapter: str) -> Callable:
+    '''Returns the detection callback for the scanner of adapter'''
+    pending = self._pending
+    flush = self._flush
+    self.best.setdefault(adapter, 0)
+
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    def detection_callback(ble_device, advertisement_data):
+      if not advertisement_data.service_data:
+        return      # skip no-UUID advertisements
+      #: endif
+      key = (ble_device.address, tuple(advertisement_data.service_data.items()))
+      copy = pending.get(key)
+      if copy is None:
+        timer = asyncio.get_running_loop().call_later(self._window, flush, key)
+        pending[key] = [ble_device, advertisement_data, adapter, timer]
+        return
+      #: endif
+      self.duplicates += 1
+      if advertisement_data.rssi > copy[1].rssi:
+        copy[0], copy[1], copy[2] = ble_device, advertisement_data, adapter
+      #: endif
+    #: enddef detection_callback -----------------------------------------------
+
+    return detection_callback
+  #: enddef wrap ///////////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  def _flush(self, key: tuple):
+    '''Hands over the best copy of an advertisement, once its window elapsed'''
+    ble_device, advertisement_data, adapter, _ = self._pending.pop(key)
+    self.forwarded += 1
+    self.best[adapter] += 1
+    task = asyncio.create_task(self._callback(ble_device, advertisement_data, adapter))
+    self._tasks.add(task)
+    task.add_done_callback(self._tasks.discard)
+  #: enddef _flush /////////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  def stats(self) -> dict[str, int]:
+    '''Returns the number of advertisements forwarded, of copies dropped and
+        of advertisements waiting for copies'''
+    return {'forwarded': self.forwarded, 'duplicates': self.duplicates,
+            'pending': len(self._pending)}
+  #: enddef stats //////////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  def adapter_stats(self) -> dict[str, dict[str, int]]:
+    '''Returns, by adapter, the number of advertisements forwarded as heard
+        by it (with the best RSSI)'''
+    return {adapter: {'best': best} for adapter, best in self.best.items()}
+  #: enddef adapter_stats //////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  async def close(self):
+    '''Drops the advertisements still waiting for copies, then waits for those
+        already handed over to be processed'''
+    for copy in self._pending.values():
+      copy[3].cancel()
+    #: endfor copy
+    self._pending.clear()
+    await asyncio.gather(*self._tasks, return_exceptions=True)
+  #: enddef close //////////////////////////////////////////////////////////////
+
+
+#: endclass AdapterMerger ######################################################
@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''Split publishing mode: each property of the measurements of a BTHome v2
+    device is published to its own (retained) subtopic, only when changed
+    beyond a deadband, along with Home Assistant MQTT discovery
+    configurations.'''
+
+
+
+# ##############################################################################
+import  json
+import  re
+# ..............................................................................
+from    bthome_constants import SENSOR
+# ##############################################################################
+
+
+
+# some constants  ##############################################################
+# default topic prefix of Home Assistant MQTT discovery configurations
+DEFAULT_DISCOVERY_PREFIX = 'homeassistant'
+# resolution of properties not in SENSOR (added by bthome2mqtt)
+_EXTRA_RESOLUTIONS = {'RSSI': 1.0}
+# min. deadband (in resolution steps) of noisy properties
+_MIN_DEADBANDS = {'RSSI': 5}
+# max. subtopics whose last value is remembered, and discovery configurations
+# remembered as published (beyond, all are forgotten)
+_MAX_TOPICS = 100_000
+# Home Assistant device classes of (non binary) sensors, by property
+_DEVICE_CLASSES = {
+  'battery': 'battery', 'temperature': 'temperature', 'dewpoint': 'temperature',
+  'humidity': 'humidity', 'pressure': 'pressure', 'illuminance': 'illuminance',
+  'mass (kg)': 'weight', 'mass (lb)': 'weight', 'energy': 'energy', 'power': 'power',
+  'voltage': 'voltage', 'current': 'current', 'pm2.5': 'pm25', 'pm10': 'pm10',
+  'co2': 'carbon_dioxide', 'tvoc': 'volatile_organic_compounds', 'moisture': 'moisture',
+  'distance (mm)': 'distance', 'distance (m)': 'distance', 'duration': 'duration',
+  'speed': 'speed', 'gas': 'gas', 'volume': 'volume', 'volume storage': 'volume_storage',
+  'water': 'water', 'volume flow rate': 'volume_flow_rate', 'conductivity': 'conductivity',
+  'RSSI': 'signal_strength'}
+# properties only growing (meters), for Home Assistant long-term statistics
+_TOTAL_INCREASING = {'energy', 'gas', 'volume', 'water'}
+# Home Assistant spelling of units, where different
+_UNITS = {'lux': 'lx', 'ug/m3': 'µg/m³', 'm3': 'm³', 'm3/hr': 'm³/h'}
+# suffixes of repeated properties (as "button_3") and aggregates (as
+# "temperature_max", see bthome_aggregate)
+_SUFFIX_RE = re.compile(r'(_\d+)?(_(mean|min|max|last))?$')
+_SLUG_RE = re.compile(r'[^a-z0-9]+')
+# ##############################################################################
+
+
+
+# ##############################################################################
+def _property_tables() -> tuple[dict[str, float], dict[str, list[str]]]:
+  '''Returns the resolution (finest factor) of numeric properties, and the
+      event types of event properties, from SENSOR'''
+  resolutions: dict[str, float] = dict(_EXTRA_RESOLUTIONS)
+  events: dict[str, list[str]] = {}
+  for sensor in SENSOR.values():
+    if sensor.events:
+      events[sensor.property] = [event for event in sensor.events.values() if event]
+    elif not sensor.binary:
+      resolutions[sensor.property] = min(sensor.factor,
+                                         resolutions.get(sensor.property, sensor.factor))
+    #: endif
+  #: endfor sensor
+  return resolutions, events
+#: enddef _property_tables #####################################################
+
+
+
+_RESOLUTIONS, _EVENTS = _property_tables()
+
+
+
+# ##############################################################################
+def resolution(key: str) -> tuple[float, int]:
+  '''Returns the resolution of a numeric property (measurement name, 1 if
+      unknown), and its number of decimals'''
+  step = _RESOLUTIONS.get(_SUFFIX_RE.sub('', key), 0.0) or 1.0
+  return step, len(f'{step:g}'.partition('.')[2])
+#: enddef resolution ###########################################################
+
+
+
+# ##############################################################################
+class _Property:
+  '''How a property (measurement name and kind of value) is published'''
+  __slots__ = ('slug', 'name', 'base', 'component', 'resolution', 'decimals', 'deadband')
+
+
+  # ****************************************************************************
+  def __init__(self, key: str, value, deadband: int):
+    self.base = _SUFFIX_RE.sub('', key)     # property in SENSOR
+    self.slug = _SLUG_RE.sub('_', key.lower()).strip('_')
+    self.name = key.replace('_', ' ')
+    self.resolution = 0.0                   # only numbers are rounded...
+    self.decimals = 0
+    self.deadband = 0                       # ... and get a deadband (in steps)
+    if isinstance(value, bool):
+      self.component = 'binary_sensor'
+    elif isinstance(value, str) and self.base in _EVENTS:
+      self.component = 'event'
+    else:
+      self.component = 'sensor'
+      if isinstance(value, float):
+        self.resolution, self.decimals = resolution(key)
+        self.deadband = max(deadband, _MIN_DEADBANDS.get(self.base, 1))
+      #: endif
+    #: endif
+  #: enddef __init__ ///////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  def discovery(self, mac: str, state_topic: str, unit) -> dict:
+    '''Returns the Home Assistant MQTT discovery configuration of the property
+        of a device'''
+    config: dict = {
+        'name': self.name[:1].upper() + self.name[1:],
+        'unique_id': f'bthome_{mac}_{self.slug}',
+        'state_topic': state_topic,
+        'device': {'identifiers': [f'bthome_{mac}'], 'name': f'BTHome {mac}',
+                   'connections': [['bluetooth', ':'.join(mac[i:i + 2].lower()
+                                                          for i in range(0, 12, 2))]]}}
+    match self.component:
+      case 'binary_sensor':
+        if self.base != 'generic boolean':
+          config['device_class'] = self.base.replace(' ', '_')
+        #: endif
+      case 'event':
+        config['event_types'] = _EVENTS[self.base]
+      case _:
+        if self.base in _DEVICE_CLASSES:
+          config['device_class'] = _DEVICE_CLASSES[self.base]
+        #: endif
+        if isinstance(unit, str):
+          config['unit_of_measurement'] = _UNITS.get(unit, unit)
+        #: endif
+        if self.deadband:
+          config['state_class'] = ('total_increasing' if self.base in _TOTAL_INCREASING
+                                   else 'measurement')
+          config['suggested_display_precision'] = self.decimals
+        #: endif
+    #: endmatch
+    return config
+  #: enddef discovery //////////////////////////////////////////////////////////
+
+
+#: endclass _Property ##########################################################
+
+
+
+# ##############################################################################
+class SplitState:
+  '''Values last published to the property subtopics of a broker (connection),
+      and discovery configurations already published to it. Numbers are
+      published (rounded to the resolution of their property, the finest
+      factor in SENSOR) when they changed by at least deadband resolution
+      steps since last published, other states (binary, text) when changed,
+      and events always (not retained).'''
+
+
+  # ****************************************************************************
+  def __init__(self, deadband: int = 1, discovery_prefix: str = DEFAULT_DISCOVERY_PREFIX):
+    self._deadband = deadband
+    self._discovery_prefix = discovery_prefix.strip('/')
+    self._properties: dict[tuple[str, type], _Property] = {}
+    self._last: dict[str, bool | int | str] = {}    # indexed by subtopic
+    self._discovered: set[str] = set()              # configuration topics
+    # counters
+    self.published = 0        # property values published
+    self.suppressed = 0       # property values not published (unchanged)
+    self.configs = 0          # discovery configurations published
+  #: enddef __init__ ///////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  def messages(self, mac: str, topics: tuple[str, ...],
+               measurements: dict[str, tuple[bool | str | float, None | str | int]],
+               discovery: bool) -> list[tuple[str, str, bool]]:
+    '''Returns the messages (subtopic, payload and retain flag) publishing the
+        changed properties of the measurements of a device, under all its
+        topics, preceded by the discovery configurations of the properties
+        not published yet (if discovery), and remembers them as published
+        (see forget).'''
+    messages = []
+    last = self._last
+    if len(last) > _MAX_TOPICS:
+      last.clear()
+    #: endif
+    if len(self._discovered) > _MAX_TOPICS:
+      self._discovered.clear()    # published again, retained anyway
+    #: endif
+    for key, (value, extra) in measurements.items():
+      info = self._properties.get((key, type(value)))
+      if info is None:
+        info = self._properties[(key, type(value))] = _Property(key, value, self._deadband)
+      #: endif
+      state: bool | int | str | None
+      if info.component == 'event':
+        state = None
+        event = {'event_type': value} if extra is None else {'event_type': value, 'steps': extra}
+        payload = json.dumps(event)
+      elif info.component == 'binary_sensor':
+        state = value
+        payload = 'ON' if value else 'OFF'
+      elif info.deadband:
+        state = round(value / info.resolution)
+        payload = f'{value:.{info.decimals}f}'
+      else:
+        state = payload = str(value)
+      #: endif
+      for i, topic in enumerate(topics):
+        subtopic = f'{topic}/{info.slug}'
+        if discovery and i == 0:
+          config_topic = f'{self._discovery_prefix}/{info.component}/bthome_{mac}/'\
+                         f'{info.slug}/config'
+          if config_topic not in self._discovered:
+            self._discovered.add(config_topic)
+            messages.append((config_topic,
+                             json.dumps(info.discovery(mac, subtopic, extra), ensure_ascii=False),
+                             True))
+            self.configs += 1
+          #: endif
+        #: endif
+        if state is not None:
+          previous = last.get(subtopic)
+          if previous is not None and type(previous) is type(state):
+            if (previous == state if not info.deadband
+                else abs(state - previous) < info.deadband):    # type: ignore[operator]
+              self.suppressed += 1
+              continue
+            #: endif
+          #: endif
+          last[subtopic] = state
+        #: endif
+        messages.append((subtopic, payload, state is not None))
+        self.published += 1
+      #: endfor i, topic
+    #: endfor key, (value, extra)
+    return messages
+  #: enddef messages ///////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  def forget(self, topic: str):
+    '''Forgets a message as published (e.g. it could not be), so that its
+        property (or discovery configuration) is published again next time'''
+    self._last.pop(topic, None)
+    self._discovered.discard(topic)
+  #: enddef forget /////////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  def stats(self) -> dict[str, int]:
+    '''Returns the number of property values published and suppressed, and of
+        discovery configurations published'''
+    return {'published': self.published, 'suppressed': self.suppressed,
+            'configs': self.configs}
+  #: enddef stats //////////////////////////////////////////////////////////////
+
+
+#: endclass SplitState #########################################################
@@ -0,0 +1,393 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''State shared by a fleet of bthome2mqtt instances (nodes) scanning the same
+    BTHome v2 devices, so that each reading is published only once, whatever
+    the number of nodes hearing it.'''
+
+
+
+# ##############################################################################
+import  logging as lg
+import  asyncio
+import  hashlib
+from    collections import OrderedDict
+from    concurrent.futures import ThreadPoolExecutor
+from    time import monotonic, time
+from    urllib.parse import urlsplit, unquote
+# ..............................................................................
+from    bthome_decoder import Broker
+from    bthome_mqtt import BrokerConnection
+# ##############################################################################
+
+
+
+# some constants  ##############################################################
+# default topic prefix of claims, in MQTT state stores
+DEFAULT_PREFIX = 'bthome2mqtt/claims'
+# max. time (in s) an MQTT state store waits for the broker to arbitrate a claim
+_CLAIM_TIMEOUT = 1.0
+# max. readings remembered per device, in MQTT state stores
+_MAX_READINGS = 32
+# how often (in s) expired claims are deleted, in SQLite state stores
+_PURGE_INTERVAL = 60.0
+# ##############################################################################
+
+
+
+# ##############################################################################
+class StateStore:
+  '''Interface of state stores, where nodes claim the readings (identified by
+      the service data advertised, that holds their counter or packet id, if
+      any) of each device before publishing them. Claims expire after ttl
+      seconds, as devices may advertise the very same service data again
+      later on (same unencrypted measurements, packet ids wrapping around).
+      This base class is a store for a single node: every claim succeeds.'''
+
+
+  # ****************************************************************************
+  def __init__(self, node: str, ttl: float = 10.0):
+    self.name = 'local'
+    self._node = node           # name of this node, unique in the fleet
+    self._ttl = ttl
+    # counters
+    self.won = 0                # claims won
+    self.lost = 0               # claims lost (already claimed)
+    self.failed = 0             # claims failed (store unavailable), taken as won
+  #: enddef __init__ ///////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  async def claim(self, mac: str, reading: bytes) -> bool:
+    '''Claims a reading of a device. Returns True if this node must publish it,
+        False if some node (maybe this one) already claimed it. When the
+        store is unavailable, claims succeed, so that readings are published
+        (maybe more than once) rather than lost.'''
+    self.won += 1
+    return True
+  #: enddef claim //////////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  def stats(self) -> dict[str, int]:
+    '''Returns the number of claims won, lost and failed'''
+    return {'won': self.won, 'lost': self.lost, 'failed': self.failed}
+  #: enddef stats //////////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  async def start(self):
+    '''Opens the store'''
+  #: enddef start //////////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  async def close(self):
+    '''Closes the store'''
+  #: enddef close //////////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  async def __aenter__(self):
+    await self.start()
+    return self
+  #: enddef __aenter__ /////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  async def __aexit__(self, exc_type, exc, tb):
+    await self.close()
+  #: enddef __aexit__ //////////////////////////////////////////////////////////
+
+
+#: endclass StateStore #########################################################
+
+
+
+# ##############################################################################
+class SqliteStateStore(StateStore):
+  '''State store in an SQLite database file, shared by the nodes running in the
+      same host (or sharing a file system with proper locking). Claims are
+      atomic inserts: the first node inserting a reading wins it. The
+      database is only used from a thread of its own, so that the event loop
+      never waits for it (e.g. while another node holds its lock).'''
+
+
+  # ****************************************************************************
+  def __init__(self, file_name: str, node: str, ttl: float = 10.0):
+    super().__init__(node, ttl)
+    self.name = file_name
+    self._connection = None
+    self._executor: ThreadPoolExecutor | None = None
+    self._next_purge = 0.0
+  #: enddef __init__ ///////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  async def start(self):
+    '''Opens (creating it, if needed) the database. Raises sqlite3.Error on
+        failure.'''
+    self._executor = ThreadPoolExecutor(1, thread_name_prefix='state')
+    try:
+      self._connection = await asyncio.get_running_loop().run_in_executor(self._executor,
+                                                                          self._open)
+    except BaseException:
+      self._executor.shutdown(wait=False)
+      self._executor = None
+      raise
+    #: endtry
+  #: enddef start //////////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  def _open(self):
+    '''Opens the database (in the thread of the store)'''
+    import  sqlite3                         # only needed by SQLite stores
+    # short busy timeout, as readings wait for their claims
+    connection = None
+    try:
+      connection = sqlite3.connect(self.name, timeout=0.5, isolation_level=None)
+      connection.execute('PRAGMA journal_mode = WAL')
+      connection.execute('PRAGMA synchronous = NORMAL')
+      connection.execute('CREATE TABLE IF NOT EXISTS claims ('
+                         'mac TEXT NOT NULL, reading BLOB NOT NULL, node TEXT NOT NULL, '
+                         'claimed REAL NOT NULL, PRIMARY KEY (mac, reading)) WITHOUT ROWID')
+    except sqlite3.Error as e:
+      if connection is not None:
+        connection.close()
+      #: endif
+      raise sqlite3.Error(f'cannot open state store "{self.name}": {e}') from e
+    #: endtry
+    return connection
+  #: enddef _open //////////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  async def claim(self, mac: str, reading: bytes) -> bool:
+    '''See StateStore.claim. Once the store is closed, claims succeed.'''
+    import  sqlite3
+    if self._connection is None:
+      return True     # closed, publish rather than lose the reading
+    #: endif
+    try:
+      won = await asyncio.get_running_loop().run_in_executor(self._executor, self._claim,
+                                                             self._connection, mac, reading)
+    except sqlite3.Error as e:
+      lg.warning('%s', f'(state {self.name}) Claim failed. {e}.')
+      self.failed += 1
+      return True
+    #: endtry
+    if not won:
+      self.lost += 1
+      return False
+    #: endif
+    self.won += 1
+    return True
+  #: enddef claim //////////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  def _claim(self, connection, mac: str, reading: bytes) -> bool:
+    '''Claims a reading thru a connection (in the thread of the store),
+        purging expired claims from time to time. Returns True if won. Raises
+        sqlite3.Error on failure.'''
+    now = time()    # wall clock time, shared by all nodes
+    if now >= self._next_purge:
+      connection.execute('DELETE FROM claims WHERE claimed < ?', (now - self._ttl, ))
+      self._next_purge = now + _PURGE_INTERVAL
+    #: endif
+    # expired claims (not purged yet) are taken over
+    cursor = connection.execute(
+        'INSERT INTO claims VALUES (?, ?, ?, ?) ON CONFLICT (mac, reading) '\
+        'DO UPDATE SET node = excluded.node, claimed = excluded.claimed '\
+        'WHERE claimed < ?', (mac, reading, self._node, now, now - self._ttl))
+    return cursor.rowcount == 1
+  #: enddef _claim /////////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  async def close(self):
+    '''Closes the database'''
+    if self._executor is None:
+      return
+    #: endif
+    if self._connection is not None:
+      # claims made meanwhile must not reach the closed connection
+      connection, self._connection = self._connection, None
+      await asyncio.get_running_loop().run_in_executor(self._executor, connection.close)
+    #: endif
+    self._executor.shutdown()
+    self._executor = None
+  #: enddef close //////////////////////////////////////////////////////////////
+
+
+#: endclass SqliteStateStore ###################################################
+
+
+
+# ##############################################################################
+class MqttStateStore(StateStore):
+  '''State store in an MQTT broker, shared by all the nodes connected to it.
+      Nodes claim a reading by publishing it (as "<digest> <node>", QoS 1)
+      to the retained topic "<prefix>/<MAC>" of its device, and all of them
+      subscribe to these topics: as the broker delivers the messages of a
+      topic in the same order to all subscribers, the first claim delivered
+      wins the reading, everywhere. Retained messages let (re)starting nodes
+      know the last reading claimed from each device.'''
+
+
+  # ****************************************************************************
+  def __init__(self, broker: Broker, prefix: str, node: str, ttl: float = 10.0):
+    super().__init__(node, ttl)
+    self._prefix = prefix.strip('/')
+    self._connection = BrokerConnection(broker, (f'{self._prefix}/+', ), self._on_message)
+    self.name = f'{self._connection.name}/{self._prefix}'
+    # claimed readings of each device: (node, time) indexed by digest, oldest
+    # first; devices in order of their last claim, oldest first
+    self._claimed: OrderedDict[str, OrderedDict[str, tuple[str, float]]] = OrderedDict()
+    # own claims being arbitrated, indexed by (MAC, digest)
+    self._pending: dict[tuple[str, str], asyncio.Future] = {}
+  #: enddef __init__ ///////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  async def start(self):
+    '''Connects to the broker'''
+    self._connection.start()
+  #: enddef start //////////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  def _owner(self, mac: str, digest: str) -> str | None:
+    '''Returns the node that claimed a reading, None if not claimed (or
+        expired)'''
+    claimed = self._claimed.get(mac)
+    if not claimed:
+      return None
+    #: endif
+    owner = claimed.get(digest)
+    if owner is None or monotonic() - owner[1] > self._ttl:
+      return None
+    #: endif
+    return owner[0]
+  #: enddef _owner /////////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  def _on_message(self, topic: str, payload: bytes):
+    '''Records a claim, deciding the arbitration of own pending claims'''
+    try:
+      mac = topic[len(self._prefix) + 1:]
+      digest, node = payload.decode().split(' ', 1)
+    except (UnicodeDecodeError, ValueError):
+      return      # not a claim (e.g. cleared retained message)
+    #: endtry
+    owner = self._owner(mac, digest)
+    if owner is None:
+      owner = node
+      now = monotonic()
+      claimed = self._claimed.setdefault(mac, OrderedDict())
+      claimed[digest] = (node, now)
+      claimed.move_to_end(digest)
+      if len(claimed) > _MAX_READINGS:
+        claimed.popitem(last=False)
+      #: endif
+      self._claimed.move_to_end(mac)
+      self._expire(now)
+    #: endif
+    result = self._pending.get((mac, digest))
+    if result is not None and not result.done():
+      result.set_result(owner)
+    #: endif
+  #: enddef _on_message ////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  def _expire(self, now: float):
+    '''Forgets the devices whose last claim expired (e.g. stray devices added
+        in promiscuous mode), so that claims take bounded memory'''
+    devices = self._claimed
+    while devices:
+      claimed = next(iter(devices.values()))
+      if claimed and now - next(reversed(claimed.values()))[1] <= self._ttl:
+        break
+      #: endif
+      devices.popitem(last=False)
+    #: endwhile
+  #: enddef _expire ////////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  async def claim(self, mac: str, reading: bytes) -> bool:
+    '''See StateStore.claim'''
+    import  aiomqtt
+    digest = hashlib.blake2b(reading, digest_size=8).hexdigest()
+    key = (mac, digest)
+    if self._owner(mac, digest) is not None or key in self._pending:
+      self.lost += 1
+      return False
+    #: endif
+    result = asyncio.get_running_loop().create_future()
+    self._pending[key] = result
+    try:
+      await self._connection.publish(f'{self._prefix}/{mac}', f'{digest} {self._node}',
+                                     timeout=_CLAIM_TIMEOUT, qos=1, retain=True)
+      owner = await asyncio.wait_for(result, _CLAIM_TIMEOUT)
+    except (aiomqtt.MqttError, TimeoutError) as e:
+      lg.warning('%s', f'(state {self.name}) Claim failed. {e or "Timeout"}.')
+      self.failed += 1
+      return True
+    finally:
+      del self._pending[key]
+    #: endtry
+    if owner != self._node:
+      self.lost += 1
+      return False
+    #: endif
+    self.won += 1
+    return True
+  #: enddef claim //////////////////////////////////////////////////////////////
+
+
+  # ****************************************************************************
+  async def close(self):
+    '''Disconnects from the broker'''
+    await self._connection.close()
+  #: enddef close //////////////////////////////////////////////////////////////
+
+
+#: endclass MqttStateStore #####################################################
+
+
+
+# ##############################################################################
+def create_state_store(url: str, node: str, ttl: float = 10.0) -> StateStore | None:
+  '''Creates the state store at a URL, either "sqlite:FILE" (an SQLite database
+      file), or "mqtt[s]://[USER[:PASSWORD]@]HOST[:PORT][/PREFIX]" (an MQTT
+      broker, thru a TLS connection if mqtts, with topics under PREFIX).
+      Returns None if the URL is not valid.'''
+  try:
+    parts = urlsplit(url)
+    match parts.scheme:
+      case 'sqlite':
+        file_name = parts.netloc + parts.path
+        if not file_name:
+          return None
+        #: endif
+        return SqliteStateStore(file_name, node, ttl)
+      case 'mqtt' | 'mqtts':
+        encrypt = parts.scheme == 'mqtts'
+        broker = Broker(
+            hostname = parts.hostname or Broker().hostname,
+            port = parts.port or (8883 if encrypt else 1883),
+            user = unquote(parts.username or ''),
+            password = unquote(parts.password or ''),
+            encrypt = encrypt)
+        return MqttStateStore(broker, parts.path.strip('/') or DEFAULT_PREFIX, node, ttl)
+      case _:
+        return None
+    #: endmatch
+  except ValueError:    # e.g. invalid port
+    return None
+  #: endtry
+#: enddef create_state_store ###################################################